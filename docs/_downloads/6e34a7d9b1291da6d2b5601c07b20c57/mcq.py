@@ -333,7 +333,10 @@ Some aspect of the script are controlled by the following
 **ENVIRONMENT VARIABLES**::
 
     MCQRANDOMSEED [alternative random seed]
-    OMARSERVICE   [alternative Optical Mark Recognition remote service URL]
+    OMARSERVICE   [alternative Optical Mark Recognition remote service URL;
+                   ``omarscan.py --serve=<port>`` is a local one]
+    MCQXELATEXJOBS [number of parallel XeLaTeX runs of `exam`,
+                   default: number of CPUs; needs `qpdf` or pypdf]
     ANSI_COLORS_DISABLED [disable ANSI colors in some terminals]
 
 Unless you know what you are doing, you do not need to set them.
@@ -372,6 +375,9 @@ import cmd
 import datetime
 import time
 import hashlib
+import json
+import mmap
+import struct
 # ----------------------------------------------------------------------
 import xml.etree.ElementTree as ET
 import six
@@ -483,6 +489,7 @@ MERGEFILES = False
 ZIPPASSWORD = b'SECRET'
 OMARSERVICE = 'https://peano.matapp.unimib.it/omar/cgi-bin/omrgw.cgi'
 # OMARSERVICE='https://failsafe.matapp.unimib.it/cgi-bin/omrgw.cgi'
+OMARSERVICE_PART = 4 * 1024 * 1024  # bytes, parts of uploads/downloads (if supported)
 
 DOWNLOAD_SITE="https://www.dlfer.xyz/var/"
 GITHUB_REPO_URL='https://api.github.com/repos/dlfer/var'
@@ -490,6 +497,10 @@ __VERSION__='2022-11-15'
 
 ISUI = False
 UNSAFE_DVIPDFMX=None
+XELATEX_JOBS = int(os.environ.get('MCQXELATEXJOBS', os.cpu_count() or 1))
+XELATEX_MAX_PASSES = 4  # XeLaTeX runs of a build, if the aux files keep changing
+BUILD_AUX_FILES = ['.aux', '.lbl', '.pos']  # a build stops when they are stable
+BUILD_MANIFEST = '.mcqbuild'  # <base>.mcqbuild: inputs of the last good build
 MAX_HISTORY_LENGTH = 1024  # number of terms in the history of readline
 MCQXELATEXURL = 'https://www.dlfer.xyz/var/mcqxelatex.html'
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -543,9 +554,36 @@ def get_remote_last_commit(filename):
 
 # ----------------------------------------------------------------------
 
+OMARSCAN_MODULE = None # (path, mtime, module) of the loaded omarscan.py
+UPDATE_CHECK_FILE = os.path.join(os.path.expanduser("~"), ".mcq_update_check")
+UPDATE_CHECK_INTERVAL = 24 * 3600 # seconds between two update checks of omarscan.py
+
+
+def update_check_due():
+    """ True if the last update check is older than UPDATE_CHECK_INTERVAL;
+    the time of this one is written in UPDATE_CHECK_FILE """
+    try:
+        if time.time() - os.path.getmtime(UPDATE_CHECK_FILE) < UPDATE_CHECK_INTERVAL:
+            return False
+    except OSError:
+        pass
+    try:
+        with open(UPDATE_CHECK_FILE, 'w') as fd:
+            fd.write(datetime.datetime.now().strftime(DATETIME_FORMAT) + "\n")
+    except OSError:
+        pass
+    return True
+
+
 def find_omarscan():
+    """ the omarscan module, loaded once per session (again only if the
+    file changes) """
+    global OMARSCAN_MODULE
     script_dir = os.path.dirname(os.path.realpath(__file__))
     OMARSCAN_FILE = os.path.join(script_dir,'omarscan.py')
+    if OMARSCAN_MODULE is not None and OMARSCAN_MODULE[0] == OMARSCAN_FILE and \
+            os.path.exists(OMARSCAN_FILE) and os.path.getmtime(OMARSCAN_FILE) == OMARSCAN_MODULE[1]:
+        return OMARSCAN_MODULE[2]
     if not ( os.path.exists(OMARSCAN_FILE) and os.path.isfile(OMARSCAN_FILE) ):
         # if there is no omarscan.py (downloaded)
         sys.stderr.write("File <{}> does not exist!\nNo local omarscan.py found!\nI can try to download it from {}...\n".format(OMARSCAN_FILE,OMARSCAN_URL))
@@ -559,9 +597,10 @@ def find_omarscan():
     omarscan = importlib.util.module_from_spec(spec)
     sys.modules["omarscan"] = omarscan
     spec.loader.exec_module(omarscan)
-    # check that it is the most recent version
+    OMARSCAN_MODULE = (OMARSCAN_FILE, os.path.getmtime(OMARSCAN_FILE), omarscan)
+    # check that it is the most recent version (at most once a day)
     try:
-        if omarscan.check_update():
+        if update_check_due() and omarscan.check_update():
             sys.stderr.write("UPDATING omarscan.py first!\n")
             download_remote_file(OMARSCAN_URL)
     except:
@@ -597,6 +636,121 @@ def ssclient(basetexfile,scanfiles,outputtype='TXT',outputfile='omr-output.pdf')
 
 # ----------------------------------------------------------------------
 
+def ssclient_upload(my_service, zipname):
+    """ send the zip file in parts of OMARSERVICE_PART bytes, with its hmac
+    computed incrementally; the parts already received by the service (from
+    an interrupted upload of the same zip) are not sent again.
+    Return the job_id, or None if the service does not accept parts. """
+    import hashlib
+    import hmac
+    import six.moves.xmlrpc_client
+    hm = hmac.new(ZIPPASSWORD, digestmod=hashlib.sha256)
+    h = hashlib.sha256()
+    with open(zipname, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(OMARSERVICE_PART), b''):
+            hm.update(chunk)
+            h.update(chunk)
+    upload_id = h.hexdigest()
+    try:
+        done = set(my_service.upload_status(upload_id))
+    except six.moves.xmlrpc_client.Fault:
+        return None
+    if done:
+        sys.stderr.write("(resuming: %i parts already sent) " % len(done))
+    index = 0
+    with open(zipname, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(OMARSERVICE_PART), b''):
+            if index not in done:
+                my_service.upload_part(upload_id, index, six.moves.xmlrpc_client.Binary(chunk))
+                sys.stderr.write(".")
+            index += 1
+    return my_service.upload_commit(upload_id, index, hm.hexdigest(), 'TXT')
+
+
+def ssclient_download(my_service, job_id, outputfile):
+    """ write the annotated pdf to outputfile, in parts of OMARSERVICE_PART
+    bytes; return the answers, or None if the service does not send parts """
+    import six.moves.xmlrpc_client
+    try:
+        txt, size = my_service.get_result_info(job_id)
+    except six.moves.xmlrpc_client.Fault:
+        return None
+    fd = open(outputfile, 'wb')
+    offset = 0
+    while offset < size:
+        data = my_service.get_result_part(job_id, offset, OMARSERVICE_PART).data
+        if not data:
+            raise Exception("Download of %s truncated at %i/%i bytes" % (outputfile, offset, size))
+        fd.write(data)
+        offset += len(data)
+    fd.close()
+    return txt
+
+def parse_omr_status(status):
+    """ the progress in a status line of omarscan.main, as a dict with the
+    keys 'eta' (seconds), 'page' and 'pages' (those found), or None """
+    m = re.match(r"ETA:(\d+|\?\?) sec\s*(?:\[(\d+)/(\d+)\]|\((?:extracted )?(\d+)(?:/(\d+)| pages)\))?", status)
+    if not m:
+        return None
+    result = {}
+    if m.group(1) != '??':
+        result['eta'] = int(m.group(1))
+    if m.group(2):
+        result['page'], result['pages'] = int(m.group(2)), int(m.group(3))
+    elif m.group(5):
+        result['pages'] = int(m.group(5))
+    elif m.group(4):
+        result['pages'] = int(m.group(4))
+    return result
+
+
+def show_omr_status(status):
+    progress = parse_omr_status(status)
+    if progress is None:
+        sys.stderr.write("\n" + status.rstrip() + "\n")
+        return
+    line = "page %s/%s" % (progress.get('page', '-'), progress.get('pages', '?'))
+    if 'eta' in progress:
+        line += ", ETA %i sec" % progress['eta']
+    sys.stderr.write("\r%-40s" % line)
+
+
+def ssclient_wait(my_service, job_id):
+    """ wait until the job is done, showing its progress: with long polls
+    (wait_status), if the service has them; otherwise with check_status,
+    more and more rarely while nothing changes (0.2 to 3 seconds). The
+    ServerProxy keeps its connection open between the calls. """
+    import six.moves.xmlrpc_client
+    since = 0
+    try:
+        done = False
+        while not done:
+            lines, since, done = my_service.wait_status(job_id, since, 30.0)
+            for status in lines:
+                show_omr_status(status)
+    except six.moves.xmlrpc_client.Fault:
+        if since > 0:
+            raise
+        delay = 0.2
+        last_status = None
+        for x in range(20000):
+            status = my_service.check_status(job_id)
+            if status[:4] == 'FAIL' or status == 'DONE':
+                break
+            if status != last_status:
+                show_omr_status(status)
+                last_status = status
+                delay = 0.2
+            else:
+                delay = min(delay * 2, 3.0)
+            time.sleep(delay)
+    status = my_service.check_status(job_id)
+    sys.stderr.write("\n%s\n" % status.rstrip())
+    if status[:4] == 'FAIL':
+        exit_on_error('ERROR')
+
+# ----------------------------------------------------------------------
+
 def ssclient_remote(basetexfile, scanfiles, outputtype=None, outputfile='omr-output.pdf'):
     global ZIPPASSWORD, OMARSERVICE
     import os
@@ -624,20 +778,28 @@ def ssclient_remote(basetexfile, scanfiles, outputtype=None, outputfile='omr-out
     for f in files:
         zip.write(f)
     zip.close()
-    fd = open(TMPZIP, 'rb')
-    data = fd.read()
-    fd.close()
     os.close(fdtmp)
-    os.remove(TMPZIP)
-    hm = hmac.new(ZIPPASSWORD, data, digestmod=hashlib.sha256)
-    digest = hm.hexdigest()
     sys.stderr.write(aalogo % OMARSERVICE)
     sys.stderr.write("Sending data... ")
-    if outputtype == 'XML':
-        job_id = my_service.add_to_queue(
-            six.moves.xmlrpc_client.Binary(data), [digest, 'XML'])
-    else:
-        job_id = my_service.add_to_queue(six.moves.xmlrpc_client.Binary(data), digest)
+    try:
+        job_id = None
+        if outputtype != 'XML':
+            job_id = ssclient_upload(my_service, TMPZIP)
+        if job_id is None:
+            # the service does not accept parts: all at once
+            fd = open(TMPZIP, 'rb')
+            data = fd.read()
+            fd.close()
+            hm = hmac.new(ZIPPASSWORD, data, digestmod=hashlib.sha256)
+            digest = hm.hexdigest()
+            if outputtype == 'XML':
+                job_id = my_service.add_to_queue(
+                    six.moves.xmlrpc_client.Binary(data), [digest, 'XML'])
+            else:
+                job_id = my_service.add_to_queue(six.moves.xmlrpc_client.Binary(data), digest)
+            data = None
+    finally:
+        os.remove(TMPZIP)
     sys.stderr.write("Done!\n")
     if job_id[:4] != 'FAIL':
         sys.stderr.write("Working... \n")
@@ -645,23 +807,16 @@ def ssclient_remote(basetexfile, scanfiles, outputtype=None, outputfile='omr-out
         sys.stderr.write("%s failed\n" % job_id)
         # sys.exit(1)
         exit_on_error('ERROR')
-    for x in range(20000):
-        status = my_service.check_status(job_id)
-        sys.stderr.write(status)
-        if status[:4] == 'FAIL':
-            exit_on_error('ERROR')
-            # sys.exit(1)
-        if status == 'DONE':
-            break
-        else:
-            for x in range(20):
-                sys.stderr.write(".")
-                time.sleep(3.0 / 20)
-    txt, pdf = my_service.get_result(job_id)
-    # file('omr-output.pdf','w').write(pdf.data)
-    fd = open(outputfile, 'wb')
-    fd.write(pdf.data)
-    fd.close()
+    ssclient_wait(my_service, job_id)
+    txt = None
+    if outputtype != 'XML':
+        txt = ssclient_download(my_service, job_id, outputfile)
+    if txt is None:
+        txt, pdf = my_service.get_result(job_id)
+        # file('omr-output.pdf','w').write(pdf.data)
+        fd = open(outputfile, 'wb')
+        fd.write(pdf.data)
+        fd.close()
     sys.stderr.write("\nFile `%s' created.\n" % outputfile)
     end_time = time.time()
     sys.stderr.write("Elapsed time: %i seconds.\n" %
@@ -674,7 +829,7 @@ def ssclient_remote(basetexfile, scanfiles, outputtype=None, outputfile='omr-out
 
 # ----------------------------------------------------------------------
 #--BEGINSIG--
-import base64;eval(compile(base64.b64decode(b'CmRlZiBjaGVja19zZWxmKCk6CiAgICByZXR1cm4gVHJ1ZQoKZGVmIGNoZWNrX3VwZGF0ZSgpOgogICAgc2VsZl9uYW1lID0gb3MucGF0aC5zcGxpdChvcy5wYXRoLnJlYWxwYXRoKF9fZmlsZV9fKSlbMV0KICAgIGxhc3RfbW9kaWZpZWRfZGF0ZSA9IGdldF9yZW1vdGVfbGFzdF9jb21taXQoc2VsZl9uYW1lKQogICAgIyB0aGlzX3NjcmlwdF9kYXRlID0gZGF0ZXRpbWUuZGF0ZXRpbWUudG9kYXkoKQogICAgdHJ5OgogICAgICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZShfX1ZFUlNJT05fXywiJVktJW0tJWQiKQogICAgZXhjZXB0OgogICAgICAgIHN5cy5zdGRlcnIud3JpdGUoInRoaXNfc2NyaXB0X2RhdGUgX19WRVJTSU9OX18gZmFpbGVkLi4uXG4iKQogICAgICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS50b2RheSgpCiAgICBzeXMuc3RkZXJyLndyaXRlKCJDSEVDS19VUERBVEU6IHt9IGRheXMgb2xkLlxuIiAuZm9ybWF0KCAobGFzdF9tb2RpZmllZF9kYXRlIC0gdGhpc19zY3JpcHRfZGF0ZSkuZGF5cykpCiAgICByZXR1cm4gKGxhc3RfbW9kaWZpZWRfZGF0ZSAtIHRoaXNfc2NyaXB0X2RhdGUpLmRheXM+MAoKZGVmIGdldF9vcHQoKToKICAgIGdsb2JhbCBWRVJCT1NFLCBvdXRwdXQsIGV4cGxpY2l0X291dHB1dCwgTlVNQkVSX09GX0NPUElFUywgU09MVVRJT05TX0ZJTEUsIERCX0ZJTEUsIEVWQUxVQVRFLCBHSUZULCBYSFRNTCwgVkFMRklMRSwgTUFLRV9TVEFUUywgREJfU1RBVFNfRklMRSwgQkFTRU5BTUVGSUxFLCBNRVJHRUZJTEVTLCBJU1VJLCBVTlNBRkVfRFZJUERGTVgKICAgIGlmIG5vdCBjaGVja19zZWxmKCk6CiAgICAgICAgc3lzLnN0ZGVyci53cml0ZSgKICAgICAgICAgICAgIlNlbGYtaW50ZWdyaXR5IGNoZWNrc3VtIGZhaWxlZCEgQWJvcnRpbmcuLi5cbkluc3RhbGwgYSBuZXcgY2xlYW4gdmVyc2lvbiFcbiIpCiAgICAgICAgc3lzLmV4aXQoMSkKICAgIHRyeTogICAgCiAgICAgIGlmIGNoZWNrX3VwZGF0ZSgpOgogICAgICAgIHVzZXJfaW5wdXQgPSBpbnB1dCgiXG5cbiAgICoqKkEgbmV3IHZlcnNpb24gaXMgYXZhaWxhYmxlOiB7fSoqKlxuXG4gICAqKipQbGVhc2UgdXBkYXRlIG1jcS5weSBBU0FQISoqKlxuXG5QcmVzcyA8UmV0dXJuPiB0byBjb250aW51ZS4uLiIuZm9ybWF0KFNFTEZfVVJMKSkKICAgICAgaWYgY2hlY2tfbWNxX3N0eV91cGRhdGUoKToKICAgICAgICB1c2VyX2lucHV0ID0gaW5wdXQoIlxuXG4gICAqKipBIG5ldyB2ZXJzaW9uIG9mIG1jcS5zdHkgaXMgYXZhaWxhYmxlOiB7fSoqKlxuXG5QcmVzcyA8UmV0dXJuPiB0byBjb250aW51ZS4uLiIuZm9ybWF0KE1DUV9TVFlfVVJMKSkKICAgIGV4Y2VwdCBFeGNlcHRpb24gYXMgZXJyOgogICAgICAgIHN5cy5zdGRlcnIud3JpdGUoIldBUk5JTkc6IGNoZWNrX3VwZGF0ZSBmYWlsZWQgd2l0aCBlcnJvciB7fVxuIi5mb3JtYXQoZXJyKSApCiAgICBVTlNBRkVfRFZJUERGTVg9Y2hlY2tfc2FmZV9kdmlwZGZteCgpCiAgICBPTUFSU0NBTiA9IEZhbHNlCiAgICBDU1ZKT0lOID0gRmFsc2UKICAgIFJBTkRPTUNIT09TRSA9IEZhbHNlCiAgICB0cnk6CiAgICAgICAgb3B0cywgYXJncyA9IGdldG9wdC5nZXRvcHQoc3lzLmFyZ3ZbMTpdLCAiaGd4bjpvOnZzOiIsIFsKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAiaGVscCIsICJvdXRwdXQ9IiwgIm51bWJlcj0iLCAiZGI9IiwgCiAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgImdpZnQiLCAieGh0bWwiLCAic3RhdHM9IiwgInVpZD0iLCAKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAib21yPSIsICJqb2luIiwgImNob29zZT0iLCAKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAic3BsaXQtZm9yLW1vb2RsZT0iLCAidmVyYm9zZSJdKQogICAgZXhjZXB0IGdldG9wdC5HZXRvcHRFcnJvciBhcyBlcnI6CiAgICAgICAgcHJpbnQoc3RyKGVycikpCiAgICAgICAgcHJpbnQoIltvcHRpb24gLS1oZWxwIGZvciBoZWxwXSIpCiAgICAgICAgc3lzLmV4aXQoMikKICAgIGlmIGxlbihhcmdzKSA9PSAwOgogICAgICAgIElTVUkgPSBUcnVlCiAgICBmb3IgbywgYSBpbiBvcHRzOgogICAgICAgIGlmIG8gaW4gKCItdiIsICItLXZlcmJvc2UiKToKICAgICAgICAgICAgVkVSQk9TRSA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItaCIsICItLWhlbHAiKToKICAgICAgICAgICAgcHJpbnQoX19kb2NfXykKICAgICAgICAgICAgc3lzLmV4aXQoKQogICAgICAgIGVsaWYgbyBpbiAoIi1nIiwgIi0tZ2lmdCIpOgogICAgICAgICAgICBHSUZUID0gVHJ1ZQogICAgICAgIGVsaWYgbyBpbiAoIi14IiwgIi0teGh0bWwiKToKICAgICAgICAgICAgWEhUTUwgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLW8iLCAiLS1vdXRwdXQiKToKICAgICAgICAgICAgYiwgZSA9IG9zLnBhdGguc3BsaXRleHQoYSkKICAgICAgICAgICAgb3V0cHV0ID0gb3BlbihhLCAndycpCiAgICAgICAgICAgIFNPTFVUSU9OU19GSUxFID0gb3BlbihiICsgIl9leGFtLnNvbHMiLCAndycpCiAgICAgICAgICAgIERCX0ZJTEUgPSBvcGVuKGIgKyAiX2V4YW0uZGIiLCAnd2InKQogICAgICAgICAgICBleHBsaWNpdF9vdXRwdXQgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLS1kYiIsICk6CiAgICAgICAgICAgIGIsIGUgPSBvcy5wYXRoLnNwbGl0ZXh0KGEpCiAgICAgICAgICAgIERCX0ZJTEUgPSBvcGVuKGEsICdyYicpCiAgICAgICAgICAgIERCX1NUQVRTX0ZJTEUgPSBvcGVuKGIgKyAiX3N0YXRzLmRiIiwgJ3diJykKICAgICAgICAgICAgb3V0cHV0ID0gb3BlbihiICsgIi5jc3YiLCAndycpCiAgICAgICAgICAgIEVWQUxVQVRFID0gVHJ1ZQogICAgICAgIGVsaWYgbyBpbiAoIi0tdWlkIiwgKToKICAgICAgICAgICAgVUlERklMRSA9IGEKICAgICAgICAgICAgTUVSR0VGSUxFUyA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItLWNob29zZSIsICk6CiAgICAgICAgICAgIENIT09TRU5VTUJFUiA9IGludChhKQogICAgICAgICAgICBSQU5ET01DSE9PU0UgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLS1vbXIiLCApOgogICAgICAgICAgICBPTUFSQkFTRSwgXyA9IG9zLnBhdGguc3BsaXRleHQoYSkKICAgICAgICAgICAgT01BUlNDQU4gPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLS1qb2luIiwgKToKICAgICAgICAgICAgQ1NWSk9JTiA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItLXN0YXRzIiwgKToKICAgICAgICAgICAgYiwgZSA9IG9zLnBhdGguc3BsaXRleHQoYSkKICAgICAgICAgICAgREJfU1RBVFNfRklMRSA9IG9wZW4oYSwgJ3JiJykKICAgICAgICAgICAgIyBvdXRwdXQgPSBmaWxlKGIrIi50ZXgiLCd3JykKICAgICAgICAgICAgTUFLRV9TVEFUUyA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItbiIsICItLW51bWJlciIpOgogICAgICAgICAgICBOVU1CRVJfT0ZfQ09QSUVTID0gaW50KGEpCiAgICAgICAgZWxpZiBvIGluICgiLS1zcGxpdC1mb3ItbW9vZGxlIiwiLXMiKToKICAgICAgICAgICAgaWYgbGVuKGFyZ3MpID09IDE6CiAgICAgICAgICAgICAgICBzcGxpdF9mb3JfbW9vZGxlKGFyZ3NbMF0scXVlc3Rpb250ZXh0X2ZpbGU9YSkKICAgICAgICAgICAgICAgIHN5cy5leGl0KDApCiAgICAgICAgICAgIGVsc2U6CiAgICAgICAgICAgICAgICBhc3NlcnQgRmFsc2UsICJzcGxpdF9mb3JfbW9vZGxlIG5lZWRzIGFuZCBhcmd1bWVudCIKICAgICAgICBlbHNlOgogICAgICAgICAgICBhc3NlcnQgRmFsc2UsICJ1bmhhbmRsZWQgb3B0aW9uIgogICAgaWYgbGVuKGFyZ3MpID09IDA6CiAgICAgICAgdWlsb29wKCkKICAgICAgICBzeXMuZXhpdCgwKQogICAgICAgIHJldHVybiAoc3lzLnN0ZGluLnJlYWQoKSwgb3V0cHV0KQogICAgaWYgRVZBTFVBVEUgb3IgR0lGVCBvciBYSFRNTCBvciBNQUtFX1NUQVRTOgogICAgICAgIFZBTEZJTEUgPSBhcmdzWzBdCiAgICAgICAgcmV0dXJuIChvcGVuKGFyZ3NbMF0sICdyJykucmVhZCgpLCBvdXRwdXQpCiAgICBpZiBNRVJHRUZJTEVTOgogICAgICAgIG91dHB1dC53cml0ZShtZXJnZV9maWxlcyhvcGVuKGFyZ3NbMF0sICdyJykucmVhZGxpbmVzKCksIFVJREZJTEUpKQogICAgICAgIHN5cy5leGl0KDApCiAgICBpZiBPTUFSU0NBTjoKICAgICAgICBvdXRwdXQud3JpdGUoc3NjbGllbnQoT01BUkJBU0UsIGFyZ3MpKQogICAgICAgIHN5cy5leGl0KDApCiAgICBpZiBDU1ZKT0lOOgogICAgICAgIG91dHB1dC53cml0ZShjc3Zqb2luKGFyZ3MpKQogICAgICAgIHN5cy5leGl0KDApCiAgICBpZiBSQU5ET01DSE9PU0U6CiAgICAgICAgb3V0cHV0LndyaXRlKHJhbmRvbV9jaG9vc2UoQ0hPT1NFTlVNQkVSLCBhcmdzKSkKICAgICAgICBzeXMuZXhpdCgwKQogICAgaWYgb3MucGF0aC5leGlzdHMoYXJnc1swXSkgYW5kIG5vdCBleHBsaWNpdF9vdXRwdXQ6CiAgICAgICAgYiwgZSA9IG9zLnBhdGguc3BsaXRleHQoYXJnc1swXSkKICAgICAgICBCQVNFTkFNRUZJTEUgPSBiCiAgICAgICAgb3V0cHV0ID0gb3BlbihiICsgIl9leGFtLnRleCIsICd3JykKICAgICAgICBTT0xVVElPTlNfRklMRSA9IG9wZW4oYiArICJfZXhhbS5zb2xzIiwgJ3cnKQogICAgICAgIERCX0ZJTEUgPSBvcGVuKGIgKyAiX2V4YW0uZGIiLCAnd2InKQogICAgaWYgb3MucGF0aC5leGlzdHMoYXJnc1swXSk6CiAgICAgICAgcmV0dXJuIChvcGVuKGFyZ3NbMF0sICdyJykucmVhZCgpLCBvdXRwdXQpCiAgICBlbHNlOgogICAgICAgIHJhaXNlIEV4Y2VwdGlvbigiZmlsZSAlcyBkb2VzIG5vdCBleGlzdCEiICUgYXJnc1swXSkKCmRlZiBjaGVja191cGRhdGUoKToKICAgIGltcG9ydCBvcywgZGF0ZXRpbWUKICAgIHNlbGZfbmFtZSA9IG9zLnBhdGguc3BsaXQob3MucGF0aC5yZWFscGF0aChfX2ZpbGVfXykpWzFdCiAgICBsYXN0X21vZGlmaWVkX2RhdGUgPSBnZXRfcmVtb3RlX2xhc3RfY29tbWl0KHNlbGZfbmFtZSkKICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZSgnMjAyNC0xMS0xNicsICclWS0lbS0lZCcpCiAgICByZXR1cm4gKGxhc3RfbW9kaWZpZWRfZGF0ZSAtIHRoaXNfc2NyaXB0X2RhdGUpLmRheXMgPiAwIApkZWYgY2hlY2tfc2VsZigpOgogaW1wb3J0IG9zLCBoYXNobGliLCByZSwgc3lzLCBkYXRldGltZQogTUVfYmFzZSxNRV9leHQ9b3MucGF0aC5zcGxpdGV4dChvcy5wYXRoLmFic3BhdGgoX19maWxlX18pKQogTUU9TUVfYmFzZSsnLnB5JwogaWYgKGRhdGV0aW1lLmRhdGV0aW1lLnRvZGF5KCkgLSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZSgnMjAyNC0xMS0xNicsICclWS0lbS0lZCcpKS5kYXlzPiA3MjA6CiAgICAgc3lzLnN0ZGVyci53cml0ZSgiXG4gPj4+V0FSTklORyEhISBWZXJ5IG9sZCBzY3JpcHQhIENoZWNrIGlmIHlvdSBjYW4gZG93bmxvYWQgYSBuZXcgb25lITw8PFxuXG4iKQogICAgIGlucHV0KCdQcmVzcyA8UmV0dXJuPiB0byBDb250aW51ZS4uLicpCiBpZiBzeXMudmVyc2lvbl9pbmZvWzBdID4gMjoKICAgYWxsPW9wZW4oTUUsJ3InLGVuY29kaW5nPSd1dGYtOCcpLnJlYWQoKQogICBkZWYgbXlfaGFzaChpbnB1dF9jb250ZW50KToKICAgICByZXR1cm4gaGFzaGxpYi5zaGEyMjQoaW5wdXRfY29udGVudC5lbmNvZGUoZW5jb2Rpbmc9J3V0Zi04JykpLmhleGRpZ2VzdCgpCiBlbHNlOgogICBhbGw9b3BlbihNRSwncicpLnJlYWQoKQogICBkZWYgbXlfaGFzaChpbnB1dF9jb250ZW50KToKICAgICByZXR1cm4gaGFzaGxpYi5zaGEyMjQoaW5wdXRfY29udGVudCkuaGV4ZGlnZXN0KCkKIHA9YWxsLmluZGV4KCJcbiIpCiByZWc9cmUuY29tcGlsZSgiIy0tQkVHSU4iKyJTSUctLXwjLS1FTkQiKyJTSUctLSIscmUuTSBhbmQgcmUuRE9UQUxMICkKIGJvZHlfZmlyc3QsaGlkZGVuLGJvZHlfbGFzdD1yZXM9cmVnLnNwbGl0KGFsbFtwKzE6XSkKIGw9bXlfaGFzaChib2R5X2ZpcnN0LnN0cmlwKCkgKyBib2R5X2xhc3Quc3RyaXAoKSkKIGV4cGVjdF9sPSc3ODczOTE4ZGM0MTUxZDY3MDNmZDM2OGYxNThiYzdmOTY5MjM4ZGY2NGY5NTlhMjZhMGQ3ZjRjMycKIGlmIGwgIT0gZXhwZWN0X2w6CiAgcmV0dXJuIEZhbHNlCiBlbHNlOgogIHJldHVybiBUcnVlCg==').decode('utf-8'),'<string>','exec'))
+import base64;eval(compile(base64.b64decode(b'CmRlZiBjaGVja19zZWxmKCk6CiAgICByZXR1cm4gVHJ1ZQoKZGVmIGNoZWNrX3VwZGF0ZSgpOgogICAgc2VsZl9uYW1lID0gb3MucGF0aC5zcGxpdChvcy5wYXRoLnJlYWxwYXRoKF9fZmlsZV9fKSlbMV0KICAgIGxhc3RfbW9kaWZpZWRfZGF0ZSA9IGdldF9yZW1vdGVfbGFzdF9jb21taXQoc2VsZl9uYW1lKQogICAgIyB0aGlzX3NjcmlwdF9kYXRlID0gZGF0ZXRpbWUuZGF0ZXRpbWUudG9kYXkoKQogICAgdHJ5OgogICAgICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZShfX1ZFUlNJT05fXywiJVktJW0tJWQiKQogICAgZXhjZXB0OgogICAgICAgIHN5cy5zdGRlcnIud3JpdGUoInRoaXNfc2NyaXB0X2RhdGUgX19WRVJTSU9OX18gZmFpbGVkLi4uXG4iKQogICAgICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS50b2RheSgpCiAgICBzeXMuc3RkZXJyLndyaXRlKCJDSEVDS19VUERBVEU6IHt9IGRheXMgb2xkLlxuIiAuZm9ybWF0KCAobGFzdF9tb2RpZmllZF9kYXRlIC0gdGhpc19zY3JpcHRfZGF0ZSkuZGF5cykpCiAgICByZXR1cm4gKGxhc3RfbW9kaWZpZWRfZGF0ZSAtIHRoaXNfc2NyaXB0X2RhdGUpLmRheXM+MAoKZGVmIGdldF9vcHQoKToKICAgIGdsb2JhbCBWRVJCT1NFLCBvdXRwdXQsIGV4cGxpY2l0X291dHB1dCwgTlVNQkVSX09GX0NPUElFUywgU09MVVRJT05TX0ZJTEUsIERCX0ZJTEUsIEVWQUxVQVRFLCBHSUZULCBYSFRNTCwgVkFMRklMRSwgTUFLRV9TVEFUUywgREJfU1RBVFNfRklMRSwgQkFTRU5BTUVGSUxFLCBNRVJHRUZJTEVTLCBJU1VJLCBVTlNBRkVfRFZJUERGTVgKICAgIGlmIG5vdCBjaGVja19zZWxmKCk6CiAgICAgICAgc3lzLnN0ZGVyci53cml0ZSgKICAgICAgICAgICAgIlNlbGYtaW50ZWdyaXR5IGNoZWNrc3VtIGZhaWxlZCEgQWJvcnRpbmcuLi5cbkluc3RhbGwgYSBuZXcgY2xlYW4gdmVyc2lvbiFcbiIpCiAgICAgICAgc3lzLmV4aXQoMSkKICAgIHRyeTogICAgCiAgICAgIGlmIGNoZWNrX3VwZGF0ZSgpOgogICAgICAgIHVzZXJfaW5wdXQgPSBpbnB1dCgiXG5cbiAgICoqKkEgbmV3IHZlcnNpb24gaXMgYXZhaWxhYmxlOiB7fSoqKlxuXG4gICAqKipQbGVhc2UgdXBkYXRlIG1jcS5weSBBU0FQISoqKlxuXG5QcmVzcyA8UmV0dXJuPiB0byBjb250aW51ZS4uLiIuZm9ybWF0KFNFTEZfVVJMKSkKICAgICAgaWYgY2hlY2tfbWNxX3N0eV91cGRhdGUoKToKICAgICAgICB1c2VyX2lucHV0ID0gaW5wdXQoIlxuXG4gICAqKipBIG5ldyB2ZXJzaW9uIG9mIG1jcS5zdHkgaXMgYXZhaWxhYmxlOiB7fSoqKlxuXG5QcmVzcyA8UmV0dXJuPiB0byBjb250aW51ZS4uLiIuZm9ybWF0KE1DUV9TVFlfVVJMKSkKICAgIGV4Y2VwdCBFeGNlcHRpb24gYXMgZXJyOgogICAgICAgIHN5cy5zdGRlcnIud3JpdGUoIldBUk5JTkc6IGNoZWNrX3VwZGF0ZSBmYWlsZWQgd2l0aCBlcnJvciB7fVxuIi5mb3JtYXQoZXJyKSApCiAgICBVTlNBRkVfRFZJUERGTVg9Y2hlY2tfc2FmZV9kdmlwZGZteCgpCiAgICBPTUFSU0NBTiA9IEZhbHNlCiAgICBDU1ZKT0lOID0gRmFsc2UKICAgIFJBTkRPTUNIT09TRSA9IEZhbHNlCiAgICB0cnk6CiAgICAgICAgb3B0cywgYXJncyA9IGdldG9wdC5nZXRvcHQoc3lzLmFyZ3ZbMTpdLCAiaGd4bjpvOnZzOiIsIFsKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAiaGVscCIsICJvdXRwdXQ9IiwgIm51bWJlcj0iLCAiZGI9IiwgCiAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgImdpZnQiLCAieGh0bWwiLCAic3RhdHM9IiwgInVpZD0iLCAKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAib21yPSIsICJqb2luIiwgImNob29zZT0iLCAKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAic3BsaXQtZm9yLW1vb2RsZT0iLCAidmVyYm9zZSJdKQogICAgZXhjZXB0IGdldG9wdC5HZXRvcHRFcnJvciBhcyBlcnI6CiAgICAgICAgcHJpbnQoc3RyKGVycikpCiAgICAgICAgcHJpbnQoIltvcHRpb24gLS1oZWxwIGZvciBoZWxwXSIpCiAgICAgICAgc3lzLmV4aXQoMikKICAgIGlmIGxlbihhcmdzKSA9PSAwOgogICAgICAgIElTVUkgPSBUcnVlCiAgICBmb3IgbywgYSBpbiBvcHRzOgogICAgICAgIGlmIG8gaW4gKCItdiIsICItLXZlcmJvc2UiKToKICAgICAgICAgICAgVkVSQk9TRSA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItaCIsICItLWhlbHAiKToKICAgICAgICAgICAgcHJpbnQoX19kb2NfXykKICAgICAgICAgICAgc3lzLmV4aXQoKQogICAgICAgIGVsaWYgbyBpbiAoIi1nIiwgIi0tZ2lmdCIpOgogICAgICAgICAgICBHSUZUID0gVHJ1ZQogICAgICAgIGVsaWYgbyBpbiAoIi14IiwgIi0teGh0bWwiKToKICAgICAgICAgICAgWEhUTUwgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLW8iLCAiLS1vdXRwdXQiKToKICAgICAgICAgICAgYiwgZSA9IG9zLnBhdGguc3BsaXRleHQoYSkKICAgICAgICAgICAgb3V0cHV0ID0gb3BlbihhLCAndycpCiAgICAgICAgICAgIFNPTFVUSU9OU19GSUxFID0gb3BlbihiICsgIl9leGFtLnNvbHMiLCAndycpCiAgICAgICAgICAgIERCX0ZJTEUgPSBvcGVuKGIgKyAiX2V4YW0uZGIiLCAnd2InKQogICAgICAgICAgICBleHBsaWNpdF9vdXRwdXQgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLS1kYiIsICk6CiAgICAgICAgICAgIGIsIGUgPSBvcy5wYXRoLnNwbGl0ZXh0KGEpCiAgICAgICAgICAgIERCX0ZJTEUgPSBvcGVuKGEsICdyYicpCiAgICAgICAgICAgIERCX1NUQVRTX0ZJTEUgPSBvcGVuKGIgKyAiX3N0YXRzLmRiIiwgJ3diJykKICAgICAgICAgICAgb3V0cHV0ID0gb3BlbihiICsgIi5jc3YiLCAndycpCiAgICAgICAgICAgIEVWQUxVQVRFID0gVHJ1ZQogICAgICAgIGVsaWYgbyBpbiAoIi0tdWlkIiwgKToKICAgICAgICAgICAgVUlERklMRSA9IGEKICAgICAgICAgICAgTUVSR0VGSUxFUyA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItLWNob29zZSIsICk6CiAgICAgICAgICAgIENIT09TRU5VTUJFUiA9IGludChhKQogICAgICAgICAgICBSQU5ET01DSE9PU0UgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLS1vbXIiLCApOgogICAgICAgICAgICBPTUFSQkFTRSwgXyA9IG9zLnBhdGguc3BsaXRleHQoYSkKICAgICAgICAgICAgT01BUlNDQU4gPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLS1qb2luIiwgKToKICAgICAgICAgICAgQ1NWSk9JTiA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItLXN0YXRzIiwgKToKICAgICAgICAgICAgYiwgZSA9IG9zLnBhdGguc3BsaXRleHQoYSkKICAgICAgICAgICAgREJfU1RBVFNfRklMRSA9IG9wZW4oYSwgJ3JiJykKICAgICAgICAgICAgIyBvdXRwdXQgPSBmaWxlKGIrIi50ZXgiLCd3JykKICAgICAgICAgICAgTUFLRV9TVEFUUyA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItbiIsICItLW51bWJlciIpOgogICAgICAgICAgICBOVU1CRVJfT0ZfQ09QSUVTID0gaW50KGEpCiAgICAgICAgZWxpZiBvIGluICgiLS1zcGxpdC1mb3ItbW9vZGxlIiwiLXMiKToKICAgICAgICAgICAgaWYgbGVuKGFyZ3MpID09IDE6CiAgICAgICAgICAgICAgICBzcGxpdF9mb3JfbW9vZGxlKGFyZ3NbMF0scXVlc3Rpb250ZXh0X2ZpbGU9YSkKICAgICAgICAgICAgICAgIHN5cy5leGl0KDApCiAgICAgICAgICAgIGVsc2U6CiAgICAgICAgICAgICAgICBhc3NlcnQgRmFsc2UsICJzcGxpdF9mb3JfbW9vZGxlIG5lZWRzIGFuZCBhcmd1bWVudCIKICAgICAgICBlbHNlOgogICAgICAgICAgICBhc3NlcnQgRmFsc2UsICJ1bmhhbmRsZWQgb3B0aW9uIgogICAgaWYgbGVuKGFyZ3MpID09IDA6CiAgICAgICAgdWlsb29wKCkKICAgICAgICBzeXMuZXhpdCgwKQogICAgICAgIHJldHVybiAoc3lzLnN0ZGluLnJlYWQoKSwgb3V0cHV0KQogICAgaWYgRVZBTFVBVEUgb3IgR0lGVCBvciBYSFRNTCBvciBNQUtFX1NUQVRTOgogICAgICAgIFZBTEZJTEUgPSBhcmdzWzBdCiAgICAgICAgcmV0dXJuIChvcGVuKGFyZ3NbMF0sICdyJykucmVhZCgpLCBvdXRwdXQpCiAgICBpZiBNRVJHRUZJTEVTOgogICAgICAgIG91dHB1dC53cml0ZShtZXJnZV9maWxlcyhvcGVuKGFyZ3NbMF0sICdyJykucmVhZGxpbmVzKCksIFVJREZJTEUpKQogICAgICAgIHN5cy5leGl0KDApCiAgICBpZiBPTUFSU0NBTjoKICAgICAgICBvdXRwdXQud3JpdGUoc3NjbGllbnQoT01BUkJBU0UsIGFyZ3MpKQogICAgICAgIHN5cy5leGl0KDApCiAgICBpZiBDU1ZKT0lOOgogICAgICAgIG91dHB1dC53cml0ZShjc3Zqb2luKGFyZ3MpKQogICAgICAgIHN5cy5leGl0KDApCiAgICBpZiBSQU5ET01DSE9PU0U6CiAgICAgICAgb3V0cHV0LndyaXRlKHJhbmRvbV9jaG9vc2UoQ0hPT1NFTlVNQkVSLCBhcmdzKSkKICAgICAgICBzeXMuZXhpdCgwKQogICAgaWYgb3MucGF0aC5leGlzdHMoYXJnc1swXSkgYW5kIG5vdCBleHBsaWNpdF9vdXRwdXQ6CiAgICAgICAgYiwgZSA9IG9zLnBhdGguc3BsaXRleHQoYXJnc1swXSkKICAgICAgICBCQVNFTkFNRUZJTEUgPSBiCiAgICAgICAgb3V0cHV0ID0gb3BlbihiICsgIl9leGFtLnRleCIsICd3JykKICAgICAgICBTT0xVVElPTlNfRklMRSA9IG9wZW4oYiArICJfZXhhbS5zb2xzIiwgJ3cnKQogICAgICAgIERCX0ZJTEUgPSBvcGVuKGIgKyAiX2V4YW0uZGIiLCAnd2InKQogICAgaWYgb3MucGF0aC5leGlzdHMoYXJnc1swXSk6CiAgICAgICAgcmV0dXJuIChvcGVuKGFyZ3NbMF0sICdyJykucmVhZCgpLCBvdXRwdXQpCiAgICBlbHNlOgogICAgICAgIHJhaXNlIEV4Y2VwdGlvbigiZmlsZSAlcyBkb2VzIG5vdCBleGlzdCEiICUgYXJnc1swXSkKCmRlZiBjaGVja191cGRhdGUoKToKICAgIGltcG9ydCBvcywgZGF0ZXRpbWUKICAgIHNlbGZfbmFtZSA9IG9zLnBhdGguc3BsaXQob3MucGF0aC5yZWFscGF0aChfX2ZpbGVfXykpWzFdCiAgICBsYXN0X21vZGlmaWVkX2RhdGUgPSBnZXRfcmVtb3RlX2xhc3RfY29tbWl0KHNlbGZfbmFtZSkKICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZSgnMjAyNC0xMS0xNicsICclWS0lbS0lZCcpCiAgICByZXR1cm4gKGxhc3RfbW9kaWZpZWRfZGF0ZSAtIHRoaXNfc2NyaXB0X2RhdGUpLmRheXMgPiAwIApkZWYgY2hlY2tfc2VsZigpOgogaW1wb3J0IG9zLCBoYXNobGliLCByZSwgc3lzLCBkYXRldGltZQogTUVfYmFzZSxNRV9leHQ9b3MucGF0aC5zcGxpdGV4dChvcy5wYXRoLmFic3BhdGgoX19maWxlX18pKQogTUU9TUVfYmFzZSsnLnB5JwogaWYgKGRhdGV0aW1lLmRhdGV0aW1lLnRvZGF5KCkgLSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZSgnMjAyNC0xMS0xNicsICclWS0lbS0lZCcpKS5kYXlzPiA3MjA6CiAgICAgc3lzLnN0ZGVyci53cml0ZSgiXG4gPj4+V0FSTklORyEhISBWZXJ5IG9sZCBzY3JpcHQhIENoZWNrIGlmIHlvdSBjYW4gZG93bmxvYWQgYSBuZXcgb25lITw8PFxuXG4iKQogICAgIGlucHV0KCdQcmVzcyA8UmV0dXJuPiB0byBDb250aW51ZS4uLicpCiBpZiBzeXMudmVyc2lvbl9pbmZvWzBdID4gMjoKICAgYWxsPW9wZW4oTUUsJ3InLGVuY29kaW5nPSd1dGYtOCcpLnJlYWQoKQogICBkZWYgbXlfaGFzaChpbnB1dF9jb250ZW50KToKICAgICByZXR1cm4gaGFzaGxpYi5zaGEyMjQoaW5wdXRfY29udGVudC5lbmNvZGUoZW5jb2Rpbmc9J3V0Zi04JykpLmhleGRpZ2VzdCgpCiBlbHNlOgogICBhbGw9b3BlbihNRSwncicpLnJlYWQoKQogICBkZWYgbXlfaGFzaChpbnB1dF9jb250ZW50KToKICAgICByZXR1cm4gaGFzaGxpYi5zaGEyMjQoaW5wdXRfY29udGVudCkuaGV4ZGlnZXN0KCkKIHA9YWxsLmluZGV4KCJcbiIpCiByZWc9cmUuY29tcGlsZSgiIy0tQkVHSU4iKyJTSUctLXwjLS1FTkQiKyJTSUctLSIscmUuTSBhbmQgcmUuRE9UQUxMICkKIGJvZHlfZmlyc3QsaGlkZGVuLGJvZHlfbGFzdD1yZXM9cmVnLnNwbGl0KGFsbFtwKzE6XSkKIGw9bXlfaGFzaChib2R5X2ZpcnN0LnN0cmlwKCkgKyBib2R5X2xhc3Quc3RyaXAoKSkKIGV4cGVjdF9sPSdlZjI4ODYyNTIyNjI3NGY4MGVlMGRmMmM1NWUzZTNiMTRjMGZiOTk1NzRiYjJkZjA0MDcyNDJhMCcKIGlmIGwgIT0gZXhwZWN0X2w6CiAgcmV0dXJuIEZhbHNlCiBlbHNlOgogIHJldHVybiBUcnVlCg==').decode('utf-8'),'<string>','exec'))
 #--ENDSIG--
 # ----------------------------------------------------------------------
 
@@ -1117,6 +1272,7 @@ class Esercizio:
         self.fb = fb
         self.coda = coda
         self.general_feedback=extract_feedback(coda)
+        self.latex_rendered = None  # see latex_parts
 
     def __repr__(self):
         return self.__str__()
@@ -1138,28 +1294,38 @@ class Esercizio:
         else:
             return 0
 
+    def latex_parts(self):
+        """
+        return the latex representation of the exercise as
+        (head, answers, tail), rendered only once: latex_perm joins
+        them with the answers in the permuted order.
+        """
+        if self.latex_rendered is None:
+            head = "\\begin{exerm}\n" + self.testo + "\n"
+            if self.risposte:
+                head += "\\begin{rispm}[%i]\n" % self.numero_colonne
+                risposte = [x.latex() for x in self.risposte]
+                tail = "\\end{rispm}\n" + self.coda
+            else:
+                risposte = []
+                if self.type == "VERO":
+                    tail = "\\vero\n"
+                elif self.type == "FALSO":
+                    tail = "\\falso\n"
+                else:
+                    # tail = "%%BOH\n"
+                    raise Exception("boh")
+            tail += "\\end{exerm}\n"
+            self.latex_rendered = (head, risposte, tail)
+        return self.latex_rendered
+
     def latex_perm(self, perm):
         """
         return a latex representation of the exercise,
         with permuted answers.
         """
-        res = "\\begin{exerm}\n" + self.testo + "\n"
-        if self.risposte:
-            res += "\\begin{rispm}[%i]\n" % self.numero_colonne
-            n = len(self.risposte)
-            for i in range(n):
-                res += (self.risposte[perm[i]]).latex()
-            res += "\\end{rispm}\n" + self.coda
-        else:
-            if self.type == "VERO":
-                res += "\\vero\n"
-            elif self.type == "FALSO":
-                res += "\\falso\n"
-            else:
-                # res += "%%BOH\n"
-                raise Exception("boh")
-        res += "\\end{exerm}\n"
-        return res
+        head, risposte, tail = self.latex_parts()
+        return "".join([head] + [risposte[i] for i in perm[:len(risposte)]] + [tail])
 
     def latex_withstats(self, stats):
         """
@@ -1770,14 +1936,19 @@ def choose_variants(s,exe_type='exe'):
 # ----------------------------------------------------------------------
 
 
-def generate_copies(s, num_copies):
+def generate_copies(s, num_copies, output, shards=None):
+    """
+    Write the `num_copies` copies of the exam `s` to `output`, one copy
+    at a time, with their solution lines (SOLUTIONS_FILE) and their
+    answer keys (DB_FILE). If `shards` is a list of files, each one gets
+    also a complete document with its consecutive part of the copies.
+    """
     global SOLUTIONS_FILE, DB_FILE, DB_STATS_FILE
     DB_LIST = {}
     DB_LIST['__punti__'] = extract_punti(s)
     DB_LIST['__formula__'] = extract_formula(s)
     VARIANT_LABEL = extract_variant(s)
     DB_LIST['__variantlabel__'] = VARIANT_LABEL
-    DB_LIST['__permutations__'] = {}
     header, body = make_template(s)
     esercizi = [parse_esercizio(es) for es in extract_esercizi(s)]
     numero_esercizi = len(esercizi)
@@ -1826,22 +1997,29 @@ def generate_copies(s, num_copies):
             DOEXE=False
     reg = re.compile(r"%%__EXERM_REMOVED__%%", re.M)
     splitted_body = reg.split(body)
-    res = header + "\\checkhassol\\writelblfilefalse\n\\begin{document}\n"
+    width = 2
+    for ese in esercizi:
+        if isinstance(ese, MultiEsercizio):
+            width = max([width] + [x.numero_risposte() for x in ese.esercizi])
+        width = max(width, ese.numero_risposte())
+    keys = ExamKeysWriter(DB_FILE, numero_esercizi, width)
+    shards = shards or []
+    for fd in [output] + shards:
+        fd.write(header + "\\checkhassol\\writelblfilefalse\n\\begin{document}\n")
     gc = genera_codice(VARIANT_LABEL)
     for nperm in range(num_copies):
-        this_res=''
+        this_res = []
         codice = next(gc)
         solutionline = "%s: \t" % codice
         solutionarray = []
         DB_solutions = []
+        ese_perm = []
         if num_copies > 1:
             perm = random_permutation(numero_esercizi)
         else:
             perm = list(range(numero_esercizi))
-        DB_LIST['__permutations__'][codice.upper()] = {
-            'perm_esercizi': perm, 'ese_perm': []}
-        this_res += "\\setcodice{%s}\n" % codice
-        this_res += splitted_body[0]
+        this_res += ["\\setcodice{%s}\n" % codice]
+        this_res += [splitted_body[0]]
         # codice
         for i in range(numero_esercizi):
             ese = esercizi[perm[i]]
@@ -1851,28 +2029,30 @@ def generate_copies(s, num_copies):
                 eseperm = random_permutation(ese.numero_risposte())
             else:
                 eseperm = list(range(ese.numero_risposte()))
-            this_res += ese.latex_perm(eseperm)
-            this_res += splitted_body[i + 1]
+            this_res += [ese.latex_perm(eseperm)]
+            this_res += [splitted_body[i + 1]]
             solutionarray += [("(%i) " % (i + 1)) + ese.solution_perm(eseperm)]
             DB_solutions += [ese.solution_db_perm(eseperm)]
-            DB_LIST['__permutations__'][
-                codice.upper()]['ese_perm'] += [eseperm]
+            ese_perm += [eseperm]
         solutionline += "\t".join(solutionarray)
         if VERBOSE:
             sys.stderr.write("WRITING Solution Line: '%s' on file %s \n" %
                              (solutionline, SOLUTIONS_FILE.name))
         SOLUTIONS_FILE.write(solutionline + "\n")
-        DB_LIST[codice.upper()] = DB_solutions
-        this_res += "\\cleardoublepage\n"
+        keys.add(codice.upper(), perm, ese_perm, DB_solutions)
+        this_res += ["\\cleardoublepage\n"]
+        this_res = "".join(this_res)
         # now check if doexe? 
         if DOEXE:
             this_res=choose_variants(this_res)
-        res += this_res 
-    res += "\\end{document}\n"
-    pickle.dump(DB_LIST, DB_FILE)
+        output.write(this_res)
+        if shards:
+            shards[nperm * len(shards) // num_copies].write(this_res)
+    for fd in [output] + shards:
+        fd.write("\\end{document}\n")
+    keys.finish(DB_LIST)
     DB_FILE.close()
     SOLUTIONS_FILE.close()
-    return res
 # ----------------------------------------------------------------------
 
 
@@ -1909,15 +2089,216 @@ def number_of_items(dbl):
 # ----------------------------------------------------------------------
 
 
+# answer keys file of `exam`: header, JSON with the `__...__` items of
+# generate_copies, the sorted exam codes (fixed width) and one fixed
+# width row for each code (see ExamKeysWriter)
+EXAM_KEYS_MAGIC = b'MCQKEYS\n'
+EXAM_KEYS_VERSION = 1
+EXAM_KEYS_HEADER = struct.Struct('<8sII')
+
+
+def exam_keys_row(numq, width):
+    # perm_esercizi, ese_perm (255 = no answer) and the key of each answer:
+    # 0 = not in the keys, 1 = giusta, 2+j = the j-th value of `punti`
+    return struct.Struct('<%iH%iB%iB' % (numq, numq * width, numq * width))
+
+
+class ExamKeysWriter:
+    """
+    Write the answer keys file read by ExamKeys, one exam code at a time:
+    only the packed rows are kept until `finish`.
+    """
+
+    def __init__(self, fd, numq, width):
+        self.fd = fd
+        self.numq = numq
+        self.width = width
+        self.riga = exam_keys_row(numq, width)
+        self.punti = []
+        self.rows = {}
+
+    def add(self, codice, perm_esercizi, ese_perm, dbsols):
+        ese, tipi = [], []
+        for i in range(self.numq):
+            permutazione = ese_perm[i]
+            ese += list(permutazione) + [255] * (self.width - len(permutazione))
+            for k in range(self.width):
+                v = dbsols[i].get(lettere[k])
+                if v is None:
+                    tipi += [0]
+                elif v == 'giusta':
+                    tipi += [1]
+                else:
+                    if v not in self.punti:
+                        if len(self.punti) == 254:
+                            raise Exception("too many different points in the answers")
+                        self.punti += [v]
+                    tipi += [2 + self.punti.index(v)]
+        self.rows[codice.encode('utf-8')] = self.riga.pack(*(list(perm_esercizi) + ese + tipi))
+
+    def finish(self, meta):
+        """write the file; `meta` are the `__...__` items of generate_copies"""
+        codelen = max([1] + [len(x) for x in self.rows])
+        codici = sorted(self.rows)
+        body = b''.join([x.ljust(codelen, b'\0') for x in codici] +
+                        [self.rows[x] for x in codici])
+        header = {'meta': meta, 'numq': self.numq, 'width': self.width,
+                  'codelen': codelen, 'ncodes': len(codici), 'punti': self.punti,
+                  'chiave': hashlib.sha1(json.dumps([meta, self.punti]).encode('utf-8') + body).hexdigest()}
+        header = json.dumps(header).encode('utf-8')
+        self.fd.write(EXAM_KEYS_HEADER.pack(EXAM_KEYS_MAGIC, EXAM_KEYS_VERSION, len(header)))
+        self.fd.write(header)
+        self.fd.write(body)
+# ----------------------------------------------------------------------
+
+
+class ExamKeys:
+    """
+    The answer keys file of ExamKeysWriter, used as the DB_LIST dict of
+    generate_copies. The file is memory-mapped: the row of an exam code
+    is read (and decoded) only when it is asked for.
+    """
+
+    def __init__(self, fd):
+        self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = EXAM_KEYS_HEADER.unpack_from(self.mm, 0)
+        if magic != EXAM_KEYS_MAGIC or version != EXAM_KEYS_VERSION:
+            raise Exception(
+                "`%s`: unknown answer keys format (version %i), re-run `exam`" % (fd.name, version))
+        start = EXAM_KEYS_HEADER.size
+        header = json.loads(self.mm[start:start + size].decode('utf-8'))
+        self.meta = header['meta']
+        self.meta['__punti__'] = tuple(self.meta['__punti__'])
+        self.meta['__chiave__'] = header['chiave']
+        self.numq = header['numq']
+        self.width = header['width']
+        self.codelen = header['codelen']
+        self.ncodes = header['ncodes']
+        self.punti = header['punti']
+        self.riga = exam_keys_row(self.numq, self.width)
+        self.index = start + size
+        self.rows = self.index + self.ncodes * self.codelen
+        self.cache = {}
+
+    def __reduce__(self):
+        # pickled (as the stats DB) without the answer keys
+        return (dict, (self.meta,))
+
+    def __getitem__(self, k):
+        if k in self.meta:
+            return self.meta[k]
+        if k == '__permutations__':
+            return ExamPermutations(self)
+        return self.get_row(k)[0]
+
+    def __setitem__(self, k, v):
+        self.meta[k] = v
+
+    def __contains__(self, k):
+        return k in self.meta or k == '__permutations__' or self.find(k) is not None
+
+    def __iter__(self):
+        for k in self.meta:
+            yield k
+        yield '__permutations__'
+        for k in self.codes():
+            yield k
+
+    def codes(self):
+        for n in range(self.ncodes):
+            pos = self.index + n * self.codelen
+            yield self.mm[pos:pos + self.codelen].rstrip(b'\0').decode('utf-8')
+
+    def find(self, codice):
+        key = codice.encode('utf-8')
+        if len(key) > self.codelen:
+            return None
+        key = key.ljust(self.codelen, b'\0')
+        lo, hi = 0, self.ncodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.index + mid * self.codelen
+            if self.mm[pos:pos + self.codelen] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = self.index + lo * self.codelen
+        if lo < self.ncodes and self.mm[pos:pos + self.codelen] == key:
+            return lo
+        return None
+
+    def get_row(self, codice):
+        if codice in self.cache:
+            return self.cache[codice]
+        n = self.find(codice)
+        if n is None:
+            raise KeyError(codice)
+        v = self.riga.unpack_from(self.mm, self.rows + n * self.riga.size)
+        q, w = self.numq, self.width
+        ese, tipi = v[q:q + q * w], v[q + q * w:]
+        dbsols = []
+        ese_perm = []
+        for i in range(q):
+            res = {}
+            for k in range(w):
+                if tipi[i * w + k] == 1:
+                    res[lettere[k]] = 'giusta'
+                elif tipi[i * w + k] > 1:
+                    res[lettere[k]] = self.punti[tipi[i * w + k] - 2]
+            dbsols += [res]
+            ese_perm += [[x for x in ese[i * w:(i + 1) * w] if x != 255]]
+        self.cache[codice] = (dbsols, {'perm_esercizi': list(v[:q]), 'ese_perm': ese_perm})
+        return self.cache[codice]
+
+
+class ExamPermutations:
+    """The `__permutations__` item of ExamKeys."""
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __getitem__(self, codice):
+        return self.keys.get_row(codice)[1]
+
+    def __contains__(self, codice):
+        return self.keys.find(codice) is not None
+
+    def __iter__(self):
+        return self.keys.codes()
+
+    def __len__(self):
+        return self.keys.ncodes
+# ----------------------------------------------------------------------
+
+
+def load_exam_keys(fd):
+    """The answer keys in `fd`: ExamKeys, or the pickled dict written by the
+    older versions. `__chiave__` identifies the keys (see correggi_incrementale)."""
+    if fd.read(len(EXAM_KEYS_MAGIC)) == EXAM_KEYS_MAGIC:
+        return ExamKeys(fd)
+    fd.seek(0)
+    data = fd.read()
+    dbl = pickle.loads(data)
+    dbl['__chiave__'] = hashlib.sha1(data).hexdigest()
+    return dbl
+# ----------------------------------------------------------------------
+
+
 def correggi(dbl, data):
-    dbl['__stats_lista__'] = []
-    result = []
-    lista_corrette = []
-    # lettere='ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-    ptg, pts, pte = dbl['__punti__']
-    sys.stderr.write("pts: %2.2f %2.2f %2.2f\n" % (ptg, pts, pte))
-    combina_voti = make_combina_voti(dbl['__formula__'])
-    comment = ""
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is None or VERBOSE:
+        return correggi_righe(dbl, data)
+    return correggi_array(dbl, data, numpy)
+# ----------------------------------------------------------------------
+
+
+def leggi_risposte(dbl, data, controlla=None):
+    """Parse the answers lines: yield (codice, name, matr, risposte, voto,
+    line_number, line) for each line to mark. `controlla` is called before
+    reporting a wrong line."""
     line_number = 0
     for l in data.split("\n"):
         line_number += 1
@@ -1936,6 +2317,8 @@ def correggi(dbl, data):
                 else:
                     voto = 0
             except Exception as v:
+                if controlla:
+                    controlla()
                 sys.stderr.write(
                     "** riga %s : Errore %s (voto=%s)\n" % (l, v, voto))
                 exit_on_error('ERROR')  # sys.exit(1)
@@ -1946,72 +2329,384 @@ def correggi(dbl, data):
                             "WARNING! Codice %s not found!\n" % codice)
                     continue  # __HERE__
                 else:
+                    if controlla:
+                        controlla()
                     nono = [x for x in dbl if not x.startswith('__')]
                     nono.sort()
                     sys.stderr.write("Exam Code `%s` not found!\n" % codice)
                     sys.stderr.write(
                         "Available codes:\n%s\n" % (" ".join(nono),))
                     exit_on_error('ERROR')  # sys.exit(1)
-            dbsols = dbl[codice]
-            reversepermdb = dbl['__permutations__'][codice]
-            votoparziale = 0.0
-            if len(dbsols) != len(risposte):
+            if len(dbl[codice]) != len(risposte):
+                if controlla:
+                    controlla()
                 raise Exception("Not enough answers in valutfile `%s' for key %s (%i<>%i)! " %
-                                (VALFILE, codice, len(dbsols), len(risposte)))
-            corrette = []
-            for i in range(len(dbsols)):
-                cer = risposte[i].upper()
-                if cer == '0':
-                    dbl['__stats__'][
-                        reversepermdb['perm_esercizi'][i]]['0'] += 1
+                                (VALFILE, codice, len(dbl[codice]), len(risposte)))
+            yield codice, name, matr, risposte, voto, line_number, l
+# ----------------------------------------------------------------------
+
+
+def segna_risposte(dbl, codice, risposte, line_number, l):
+    """Mark one line: return the partial mark, the points of each question
+    (in the order of the exam file) and the (question, answer) pairs to
+    count in __stats__."""
+    ptg, pts, pte = dbl['__punti__']
+    dbsols = dbl[codice]
+    reversepermdb = dbl['__permutations__'][codice]
+    votoparziale = 0.0
+    corrette = []
+    conta = []
+    for i in range(len(dbsols)):
+        cer = risposte[i].upper()
+        if cer == '0':
+            conta += [(reversepermdb['perm_esercizi'][i], '0')]
+        else:
+            permutazione = (reversepermdb['ese_perm'][i])
+            if cer not in lettere:
+                sys.stderr.write(
+                    "answer key '%s' not valid (codice=%s):\n%s\n" % (str(cer), codice, l))
+                exit_on_error('ERROR')  # sys.exit(1)
+            if VERBOSE:
+                sys.stderr.write("perm= %s\n" % str(permutazione))
+            if len(permutazione) > 1:
+                if lettere.index(cer) in permutazione:
+                    origA = permutazione[lettere.index(cer)]
                 else:
-                    permutazione = (reversepermdb['ese_perm'][i])
-                    if cer not in lettere:
-                        sys.stderr.write(
-                            "answer key '%s' not valid (codice=%s):\n%s\n" % (str(cer), codice, l))
-                        exit_on_error('ERROR')  # sys.exit(1)
-                    if VERBOSE:
-                        sys.stderr.write("perm= %s\n" % str(permutazione))
-                    if len(permutazione) > 1:
-                        if lettere.index(cer) in permutazione:
-                            origA = permutazione[lettere.index(cer)]
-                        else:
-                            sys.stderr.write("FATAL ERROR: answer '%s' (n. %i at line %i) for key %s  not in range %s-%s\n" % (
-                                cer, i + 1, line_number, codice, lettere[0], lettere[len(permutazione) - 1]))
-                            sys.stderr.write(
-                                "** FIX THE DATA FILE and then re-run! **\n")
-                            exit_on_error('ERROR')  # sys.exit(1)
-                    else:
-                        origA = lettere.index(cer)
-                    try:
-                        dbl['__stats__'][(reversepermdb['perm_esercizi'])[i]][
-                            lettere[origA]] += 1
-                    except Exception:
-                        sys.stderr.write("stats are not working!\n")
+                    sys.stderr.write("FATAL ERROR: answer '%s' (n. %i at line %i) for key %s  not in range %s-%s\n" % (
+                        cer, i + 1, line_number, codice, lettere[0], lettere[len(permutazione) - 1]))
+                    sys.stderr.write(
+                        "** FIX THE DATA FILE and then re-run! **\n")
+                    exit_on_error('ERROR')  # sys.exit(1)
+            else:
+                origA = lettere.index(cer)
+            conta += [(reversepermdb['perm_esercizi'][i], lettere[origA])]
+        if cer in dbsols[i]:
+            if dbsols[i][cer] == 'giusta':
+                votoparziale += ptg
+                corrette += [ptg]
+            else:
+                votoparziale += dbsols[i][cer]  # *1.0 / 100.0
+                corrette += [dbsols[i][cer]]
+        elif cer != '0':
+            votoparziale += pts
+            corrette += [pts]
+        else:
+            votoparziale += pte
+            corrette += [pte]
+    corrette = [corrette[i]
+                for i in permutazione_inversa(reversepermdb['perm_esercizi'])]
+    return votoparziale, corrette, conta
+# ----------------------------------------------------------------------
+
+
+def conta_risposte(stats, conta, n=1):
+    for q, cer in conta:
+        try:
+            stats[q][cer] += n
+        except Exception:
+            sys.stderr.write("stats are not working!\n")
+# ----------------------------------------------------------------------
+
+
+def correggi_righe(dbl, data):
+    dbl['__stats_lista__'] = []
+    result = []
+    lista_corrette = []
+    ptg, pts, pte = dbl['__punti__']
+    sys.stderr.write("pts: %2.2f %2.2f %2.2f\n" % (ptg, pts, pte))
+    combina_voti = make_combina_voti(dbl['__formula__'])
+    for codice, name, matr, risposte, voto, line_number, l in leggi_risposte(dbl, data):
+        votoparziale, corrette, conta = segna_risposte(
+            dbl, codice, risposte, line_number, l)
+        conta_risposte(dbl['__stats__'], conta)
+        votototale = combina_voti(votoparziale, voto)
+        result += [(codice, name, matr, votoparziale, voto, votototale)]
+        dbl['__stats_lista__'] += [(votoparziale, voto, votototale)]
+        lista_corrette += [corrette]
+    riordina_somme(lista_corrette)
+    dbl['__indici__'] = calcola_indici(lista_corrette, ptg)
+    return result
+# ----------------------------------------------------------------------
+
+
+# answer codes of the array engine: 0 is '0' (no answer), 1..26 are the
+# letters and NOCODE is any other character
+NOCODE = len(lettere) + 1
+
+
+def compila_chiavi(dbl, codici, numpy):
+    """Dense tables of the exam codes `codici`: points, validity and stats
+    column of every answer code, and the inverse permutation of the
+    questions."""
+    ptg, pts, pte = dbl['__punti__']
+    n = number_of_items(dbl)
+    forma = (len(codici), n, NOCODE + 1)
+    punti = numpy.zeros(forma)
+    valide = numpy.zeros(forma, dtype=bool)
+    colonne = numpy.zeros(forma, dtype=numpy.intp)
+    righe = numpy.zeros(forma[:2], dtype=numpy.intp)
+    numrisposte = numpy.zeros(forma[:2], dtype=numpy.intp)
+    for c in range(len(codici)):
+        dbsols = dbl[codici[c]]
+        reversepermdb = dbl['__permutations__'][codici[c]]
+        righe[c] = reversepermdb['perm_esercizi']
+        for i in range(n):
+            permutazione = reversepermdb['ese_perm'][i]
+            numrisposte[c, i] = len(permutazione)
+            for k in range(NOCODE):
+                cer = lettere[k - 1] if k else '0'
                 if cer in dbsols[i]:
                     if dbsols[i][cer] == 'giusta':
-                        votoparziale += ptg
-                        corrette += [ptg]
+                        punti[c, i, k] = ptg
                     else:
-                        votoparziale += dbsols[i][cer]  # *1.0 / 100.0
-                        corrette += [dbsols[i][cer]]
+                        punti[c, i, k] = dbsols[i][cer]
                 elif cer != '0':
-                    votoparziale += pts
-                    corrette += [pts]
+                    punti[c, i, k] = pts
                 else:
-                    votoparziale += pte
-                    corrette += [pte]
-            votototale = combina_voti(votoparziale, voto)
-            result += [(codice, name, matr, votoparziale, voto, votototale)]
-            dbl['__stats_lista__'] += [(votoparziale, voto, votototale)]
-            lista_corrette += [[corrette[i]
-                                for i in permutazione_inversa(reversepermdb['perm_esercizi'])]]
-    riordina_somme(lista_corrette)
-    dbl['__indici__'] = calcola_indici(lista_corrette, ptg)
+                    punti[c, i, k] = pte
+                if k == 0:
+                    valide[c, i, k] = True
+                elif len(permutazione) <= 1:
+                    valide[c, i, k] = True
+                    colonne[c, i, k] = k
+                elif k <= len(permutazione):
+                    valide[c, i, k] = True
+                    colonne[c, i, k] = permutazione[k - 1] + 1
+    return {'codici': dict((codici[c], c) for c in range(len(codici))),
+            'punti': punti, 'valide': valide, 'colonne': colonne,
+            'righe': righe, 'inverse': numpy.argsort(righe, axis=1),
+            'numrisposte': numrisposte}
+# ----------------------------------------------------------------------
+
+
+def codifica_risposte(risposte, n, numpy):
+    tabella = numpy.full(256, NOCODE, dtype=numpy.intp)
+    tabella[ord('0')] = 0
+    for k in range(len(lettere)):
+        tabella[ord(lettere[k])] = k + 1
+        tabella[ord(lettere[k].lower())] = k + 1
+    testo = []
+    for x in risposte:
+        try:
+            x.encode('ascii')
+        except UnicodeEncodeError:
+            x = ''.join([y.upper() if len(y.upper()) == 1 else '?' for y in x])
+        testo += [x]
+    testo = ''.join(testo).encode('ascii', 'replace')
+    return tabella[numpy.frombuffer(testo, dtype=numpy.uint8)].reshape(len(risposte), n)
+# ----------------------------------------------------------------------
+
+
+def controlla_risposte(dbl, righe, numpy):
+    """Tables of the exam codes and answer codes of the parsed lines: stop
+    on the first answer that correggi_righe would reject, with the same
+    message."""
+    chiavi = compila_chiavi(dbl, sorted(set([x[0] for x in righe])), numpy)
+    n = chiavi['punti'].shape[1]
+    codici = codifica_risposte([x[3] for x in righe], n, numpy)
+    cidx = numpy.array([chiavi['codici'][x[0]] for x in righe], dtype=numpy.intp)
+    errate = ~chiavi['valide'][cidx[:, None], numpy.arange(n), codici]
+    if not errate.any():
+        return chiavi, cidx, codici
+    r = int(numpy.argmax(errate.any(axis=1)))
+    i = int(numpy.argmax(errate[r]))
+    codice, risposte, line_number, l = righe[r][0], righe[r][3], righe[r][5], righe[r][6]
+    cer = risposte[i].upper()
+    if codici[r, i] == NOCODE:
+        sys.stderr.write(
+            "answer key '%s' not valid (codice=%s):\n%s\n" % (str(cer), codice, l))
+    else:
+        sys.stderr.write("FATAL ERROR: answer '%s' (n. %i at line %i) for key %s  not in range %s-%s\n" % (
+            cer, i + 1, line_number, codice, lettere[0], lettere[chiavi['numrisposte'][cidx[r], i] - 1]))
+        sys.stderr.write(
+            "** FIX THE DATA FILE and then re-run! **\n")
+    exit_on_error('ERROR')  # sys.exit(1)
+# ----------------------------------------------------------------------
+
+
+def correggi_array(dbl, data, numpy):
+    """Same as correggi_righe, but all the lines are marked at once on the
+    tables of compila_chiavi (only for the exam codes in `data`)."""
+    dbl['__stats_lista__'] = []
+    result = []
+    ptg, pts, pte = dbl['__punti__']
+    sys.stderr.write("pts: %2.2f %2.2f %2.2f\n" % (ptg, pts, pte))
+    combina_voti = make_combina_voti(dbl['__formula__'])
+    righe = []
+    for riga in leggi_risposte(dbl, data, lambda: controlla_risposte(dbl, righe, numpy)):
+        righe += [riga]
+    chiavi, cidx, codici = controlla_risposte(dbl, righe, numpy)
+    n = codici.shape[1]
+    colonna = numpy.arange(n)
+    punti = chiavi['punti'][cidx[:, None], colonna, codici]
+    # the sums go question by question, as in correggi_righe
+    votoparziale = numpy.zeros(len(righe))
+    for i in range(n):
+        votoparziale += punti[:, i]
+    stats = dbl['__stats__']
+    posti = chiavi['righe'][cidx] * (NOCODE + 1) + \
+        chiavi['colonne'][cidx[:, None], colonna, codici]
+    conteggi = numpy.bincount(posti.ravel(), minlength=len(stats) * (NOCODE + 1))
+    conteggi = conteggi.reshape(len(stats), NOCODE + 1)
+    for q, k in zip(*numpy.nonzero(conteggi)):
+        cer = lettere[k - 1] if k else '0'
+        if cer in stats[q]:
+            stats[q][cer] += int(conteggi[q, k])
+        else:
+            sys.stderr.write("stats are not working!\n" * int(conteggi[q, k]))
+    votoparziale = votoparziale.tolist()
+    for r in range(len(righe)):
+        codice, name, matr, risposte, voto = righe[r][:5]
+        votototale = combina_voti(votoparziale[r], voto)
+        result += [(codice, name, matr, votoparziale[r], voto, votototale)]
+        dbl['__stats_lista__'] += [(votoparziale[r], voto, votototale)]
+    # questions back in the order of the exam file
+    corrette = numpy.take_along_axis(punti, chiavi['inverse'][cidx], axis=1)
+    dbl['__indici__'] = calcola_indici_ordinati(corrette, ptg, numpy)
+    return result
+# ----------------------------------------------------------------------
+
+
+def calcola_indici_ordinati(corrette, ptg, numpy):
+    """riordina_somme and calcola_indici of the rows of `corrette`"""
+    corrette = numpy.asarray(corrette, dtype=float)
+    if len(corrette) == 0:
+        return None
+    somme = numpy.zeros(len(corrette))
+    for i in range(corrette.shape[1]):
+        somme += corrette[:, i]
+    return calcola_indici_array(corrette[numpy.argsort(-somme, kind='stable')], ptg)
+# ----------------------------------------------------------------------
+
+
+def segna_righe(dbl, righe, numpy):
+    """segna_risposte of each of the parsed lines `righe` (see leggi_risposte),
+    all at once on the tables of compila_chiavi when `numpy` is given."""
+    if numpy is None or VERBOSE or not righe:
+        return [segna_risposte(dbl, x[0], x[3], x[5], x[6]) for x in righe]
+    chiavi, cidx, codici = controlla_risposte(dbl, righe, numpy)
+    n = codici.shape[1]
+    colonna = numpy.arange(n)
+    punti = chiavi['punti'][cidx[:, None], colonna, codici]
+    # the sums go question by question, as in segna_risposte
+    votoparziale = numpy.zeros(len(righe))
+    for i in range(n):
+        votoparziale += punti[:, i]
+    votoparziale = votoparziale.tolist()
+    corrette = numpy.take_along_axis(punti, chiavi['inverse'][cidx], axis=1).tolist()
+    domande = chiavi['righe'][cidx].tolist()
+    colonne = chiavi['colonne'][cidx[:, None], colonna, codici].tolist()
+    cer = ['0'] + list(lettere)
+    return [(votoparziale[r], corrette[r],
+             [(domande[r][i], cer[colonne[r][i]]) for i in range(n)])
+            for r in range(len(righe))]
+# ----------------------------------------------------------------------
+
+
+def correggi_incrementale(dbl, data, cache, chiave):
+    """Same as correggi, for the re-runs of `mark`. `cache` keeps the marks
+    of every answers line (by code and answers) and the __stats__ of the
+    previous run: only new or changed lines are marked, and __stats__ is
+    updated with the lines added or removed. `chiave` identifies the exam
+    DB; when it changes the cache starts again from scratch.
+    The new lines are marked together by segna_righe (with numpy, if any)."""
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if cache.get('chiave') != chiave:
+        cache.clear()
+        cache.update({'chiave': chiave, 'righe': {}, 'contate': {},
+                      'stats': None})
+    dbl['__stats_lista__'] = []
+    result = []
+    lista_corrette = []
+    ptg, pts, pte = dbl['__punti__']
+    sys.stderr.write("pts: %2.2f %2.2f %2.2f\n" % (ptg, pts, pte))
+    combina_voti = make_combina_voti(dbl['__formula__'])
+    righe = {}
+    contate = {}
+    lette = []
+    nuove = []
+    nuovi = []
+    for riga in leggi_risposte(dbl, data, lambda: segna_righe(dbl, nuove, numpy)):
+        h = hashlib.sha1(("%s:%s" % (riga[0], riga[3])).encode('utf-8')).hexdigest()
+        if h not in righe:
+            righe[h] = cache['righe'].get(h)
+            if righe[h] is None:
+                nuove += [riga]
+                nuovi += [h]
+        contate[h] = contate.get(h, 0) + 1
+        lette += [(h, riga)]
+    righe.update(zip(nuovi, segna_righe(dbl, nuove, numpy)))
+    for h, (codice, name, matr, risposte, voto, line_number, l) in lette:
+        votoparziale, corrette, conta = righe[h]
+        votototale = combina_voti(votoparziale, voto)
+        result += [(codice, name, matr, votoparziale, voto, votototale)]
+        dbl['__stats_lista__'] += [(votoparziale, voto, votototale)]
+        lista_corrette += [corrette]
+    if cache['stats'] is not None:
+        dbl['__stats__'] = cache['stats']
+    for h in cache['contate']:
+        if contate.get(h, 0) != cache['contate'][h]:
+            conta_risposte(dbl['__stats__'], cache['righe'][h][2],
+                           contate.get(h, 0) - cache['contate'][h])
+    for h in contate:
+        if h not in cache['contate']:
+            conta_risposte(dbl['__stats__'], righe[h][2], contate[h])
+    sys.stderr.write("# marked %i new or changed lines (%i lines in all)\n" %
+                     (len(nuove), len(result)))
+    cache.update({'righe': righe, 'contate': contate,
+                  'stats': dbl['__stats__']})
+    if numpy is None or VERBOSE:
+        riordina_somme(lista_corrette)
+        dbl['__indici__'] = calcola_indici(lista_corrette, ptg)
+    else:
+        dbl['__indici__'] = calcola_indici_ordinati(lista_corrette, ptg, numpy)
     return result
 # ----------------------------------------------------------------------
 
 
+# cache file of correggi_incrementale: header (with the sha1 of the data)
+# and the pickled cache
+EXAM_MARK_CACHE_MAGIC = b'MCQMARK\n'
+EXAM_MARK_CACHE_VERSION = 1
+EXAM_MARK_CACHE_HEADER = struct.Struct('<8sI20s')
+
+
+def load_mark_cache(filename):
+    """the cache of correggi_incrementale in `filename`, or an empty one if
+    it does not exist or it is not valid"""
+    try:
+        with open(filename, 'rb') as fd:
+            data = fd.read()
+    except IOError:
+        return {}
+    if len(data) >= EXAM_MARK_CACHE_HEADER.size:
+        magic, version, digest = EXAM_MARK_CACHE_HEADER.unpack_from(data, 0)
+        data = data[EXAM_MARK_CACHE_HEADER.size:]
+        if magic == EXAM_MARK_CACHE_MAGIC and version == EXAM_MARK_CACHE_VERSION \
+                and hashlib.sha1(data).digest() == digest:
+            try:
+                cache = pickle.loads(data)
+                if isinstance(cache, dict):
+                    return cache
+            except Exception:
+                pass
+    sys.stderr.write("WARNING: `%s` is not a valid mark cache: ignored.\n" % filename)
+    return {}
+
+
+def save_mark_cache(filename, cache):
+    data = pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(filename + '.tmp', 'wb') as fd:
+        fd.write(EXAM_MARK_CACHE_HEADER.pack(EXAM_MARK_CACHE_MAGIC, EXAM_MARK_CACHE_VERSION,
+                                             hashlib.sha1(data).digest()))
+        fd.write(data)
+    os.replace(filename + '.tmp', filename)
+# ----------------------------------------------------------------------
+
+
 def calcola_indici(li, ptg):
     n = len(li)
     if n == 0:
@@ -2043,6 +2738,22 @@ def calcola_indici(li, ptg):
 # ----------------------------------------------------------------------
 
 
+def calcola_indici_array(li, ptg):
+    n = len(li)
+    if n == 0:
+        return None
+    quota = max(int(0.27 * n), 1)  # 27% ?
+    if int(0.27 * n) == 0:
+        sys.stderr.write("WARNING: quota == 0 => quota = 1 \n")
+    giuste = (li == ptg)
+    numc_UG = giuste[:quota].sum(axis=0).tolist()
+    numc_LG = giuste[-quota:].sum(axis=0).tolist()
+    numc = giuste.sum(axis=0).tolist()
+    return [((numc_UG[i] - numc_LG[i]) * 1.0 / quota, numc[i] * 1.0 / n)
+            for i in range(li.shape[1])]
+# ----------------------------------------------------------------------
+
+
 def display(li):
     result = ''
     for r in li:
@@ -2473,6 +3184,183 @@ def exit_on_error(s):
         sys.stderr.write(s)
         sys.exit(1)
 # ----------------------------------------------------------------------
+
+def xelatex_command(texfile, batch=False):
+    # -recorder: the .fls file lists the inputs, for the build manifest
+    texfile = "-recorder " + texfile
+    if batch:
+        texfile = "-interaction=batchmode " + texfile
+    if UNSAFE_DVIPDFMX:
+        return "xelatex -output-driver=\"xdvipdfmx -i %s -E\" %s" % \
+            (UNSAFE_DVIPDFMX, texfile)
+    return "xelatex %s" % texfile
+
+
+def file_digest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def aux_state(base):
+    return [file_digest(base + x) if os.path.exists(base + x) else None
+            for x in BUILD_AUX_FILES]
+
+
+def build_inputs(base, texfile):
+    """the files read by the last xelatex run (from the .fls file), except
+    the ones it writes too, such as the .aux"""
+    if not os.path.exists(base + '.fls'):
+        return []
+    inputs, outputs = set([os.path.abspath(texfile)]), set()
+    for l in open(base + '.fls', errors='replace'):
+        if l.startswith('INPUT '):
+            inputs.add(os.path.abspath(l[6:].rstrip('\n')))
+        elif l.startswith('OUTPUT '):
+            outputs.add(os.path.abspath(l[7:].rstrip('\n')))
+    return sorted(inputs - outputs)
+
+
+def input_stamp(f, builddir, old=None):
+    """[size, mtime, sha1] of an input of a build: the sha1 only for the files
+    in `builddir` (the fonts, the .fmt and the other system files are checked
+    by size and mtime); `old` is the previous stamp, if any."""
+    stamp = [os.path.getsize(f), os.path.getmtime(f), None]
+    if os.path.commonpath([builddir, f]) == builddir:
+        if old and old[:2] == stamp[:2] and old[2]:
+            stamp[2] = old[2]
+        else:
+            stamp[2] = file_digest(f)
+    return stamp
+
+
+def build_uptodate(base, command):
+    """the manifest of the last build, with the stamps of the inputs updated,
+    if `command` and the inputs (by content) and outputs did not change
+    since then; otherwise None"""
+    try:
+        manifest = json.load(open(base + BUILD_MANIFEST))
+    except Exception:
+        return None
+    if manifest.get('command') != command or base + '.pdf' not in manifest['outputs']:
+        return None
+    for f, (size, mtime) in manifest['outputs'].items():
+        if not os.path.exists(f) or [os.path.getsize(f), os.path.getmtime(f)] != [size, mtime]:
+            return None
+    builddir = os.path.dirname(os.path.abspath(base))
+    for f, old in manifest['inputs'].items():
+        if not os.path.exists(f):
+            return None
+        stamp = input_stamp(f, builddir, old)
+        if stamp[:2] != old[:2] and (stamp[2] is None or stamp[2] != old[2]):
+            return None
+        manifest['inputs'][f] = stamp
+    return manifest
+
+
+def write_build_manifest(base, command, inputs):
+    """`inputs` are the stamps of the inputs, by file name"""
+    manifest = {'command': command, 'inputs': inputs, 'outputs': {}}
+    for f in [base + '.pdf'] + [base + x for x in BUILD_AUX_FILES]:
+        if os.path.exists(f):
+            manifest['outputs'][f] = [os.path.getsize(f), os.path.getmtime(f)]
+    with open(base + BUILD_MANIFEST, 'w') as fd:
+        json.dump(manifest, fd)
+
+
+def xelatex_build(texfile, batch=False):
+    """
+    Compile `texfile`, like latexmk: nothing is done if `texfile` and its
+    inputs did not change since the last successful build (see the
+    BUILD_MANIFEST file), except touching the PDF (as a new build would),
+    otherwise xelatex is run until the BUILD_AUX_FILES do not change any
+    more (at most XELATEX_MAX_PASSES times).
+    Return the exit status of xelatex.
+    """
+    base = os.path.splitext(texfile)[0]
+    command = xelatex_command(texfile, batch)
+    manifest = build_uptodate(base, command)
+    if manifest:
+        sys.stderr.write("`%s` is up to date: nothing to do.\n" % texfile)
+        os.utime(base + '.pdf')
+        write_build_manifest(base, command, manifest['inputs'])
+        return 0
+    if os.path.exists(base + BUILD_MANIFEST):
+        os.remove(base + BUILD_MANIFEST)
+    state = aux_state(base)
+    for i in range(XELATEX_MAX_PASSES):
+        if batch:
+            retval = subprocess.call(command, shell=True, stdout=subprocess.DEVNULL)
+        else:
+            retval = os.system(command)
+        if retval:
+            return retval
+        new_state = aux_state(base)
+        if new_state == state:
+            break
+        state = new_state
+    else:
+        sys.stderr.write("WARNING: `%s` still changing after %i XeLaTeX runs\n" %
+                         (" ".join([base + x for x in BUILD_AUX_FILES]), XELATEX_MAX_PASSES))
+    inputs = build_inputs(base, texfile)
+    if len(inputs) > 1:  # without the .fls file: always rebuild
+        builddir = os.path.dirname(os.path.abspath(base))
+        write_build_manifest(base, command, dict(
+            (f, input_stamp(f, builddir)) for f in inputs if os.path.exists(f)))
+    return 0
+
+
+def can_merge_pdfs():
+    """True if merge_pdfs can work: `qpdf` or else the pypdf module"""
+    import shutil
+    return bool(shutil.which('qpdf') or importlib.util.find_spec('pypdf'))
+
+
+def merge_pdfs(pdfs, pdffile):
+    """merge `pdfs` in order into `pdffile`, with qpdf or else pypdf"""
+    try:
+        retval = subprocess.call(['qpdf', '--empty', '--pages'] + pdfs + ['--', pdffile])
+        return 0 if retval == 3 else retval  # 3: warnings only
+    except OSError:
+        pass
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        sys.stderr.write("ERROR: `qpdf` or the pypdf module is needed to merge %s\n" %
+                         " ".join(pdfs))
+        return 1
+    writer = PdfWriter()
+    for f in pdfs:
+        writer.append(f)
+    writer.write(pdffile)
+    return 0
+
+
+def xelatex_shards(texfiles, pdffile):
+    """
+    Compile the shards `texfiles` of an exam in parallel (see xelatex_build)
+    and merge their PDFs into
+    `pdffile`. The shards (with their .aux, .lbl, .pos, .log, .fls) are
+    removed if everything is OK; otherwise they are kept, to look into.
+    """
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(len(texfiles)) as pool:
+        retvals = list(pool.map(lambda f: xelatex_build(f, batch=True), texfiles))
+    bases = [os.path.splitext(f)[0] for f in texfiles]
+    for b, retval in zip(bases, retvals):
+        if retval:
+            sys.stderr.write("XeLaTeX failed on `%s.tex`: check `%s.log`\n" % (b, b))
+            return retval
+    retval = merge_pdfs([b + '.pdf' for b in bases], pdffile)
+    if not retval:
+        for b in bases:
+            for ext in ['.tex', '.pdf', '.log', '.fls', BUILD_MANIFEST] + BUILD_AUX_FILES:
+                if os.path.exists(b + ext):
+                    os.remove(b + ext)
+    return retval
+# ----------------------------------------------------------------------
 # import sys
 # import os
 
@@ -2848,6 +3736,7 @@ class ExamFile:
         self.exam_pdf = self.basename + '_exam.pdf'
         self.exam_sols = self.basename + '_exam.sols'
         self.exam_stats_db = self.basename + '_exam_stats.db'
+        self.exam_mark_cache = self.basename + '_exam_mark.cache'
         self.exam_stats_tex = self.basename + '_stats.tex'
         self.exam_stats_pdf = self.basename + '_stats.pdf'
         self.answers = self.basename + '_answers.txt'
@@ -3331,21 +4220,17 @@ class uiMasterFile(uiShell):
             ->> make
 
         Compile (XeLaTeX-ing) the TeX file <main>.tex, and generates some
-        internal files necessary for the OMR scan:
+        internal files necessary for the OMR scan. XeLaTeX is run again only
+        while <main>.aux, <main>.lbl and <main>.pos change, and not at all if
+        <main>.tex and its inputs did not change since the last make:
 
             OUTPUT: <main>.pdf
-            INTERNAL: <main>.lbl, <main>.pos
+            INTERNAL: <main>.lbl, <main>.pos, <main>.fls, <main>.mcqbuild
         """
-        for i in range(2):
-            if UNSAFE_DVIPDFMX:
-                retval = os.system("xelatex -output-driver=\"xdvipdfmx -i %s -E\" %s" % \
-                ( UNSAFE_DVIPDFMX, self.EF.filename ) )
-            else:
-                retval = os.system("xelatex %s" % self.EF.filename)
-            if retval:
-                self.term.error(
-                    "Error: compilation FAILED!\nCheck logs, edit `%s` and re-run xelatex." % self.EF.filename)
-                return 2
+        if xelatex_build(self.EF.filename):
+            self.term.error(
+                "Error: compilation FAILED!\nCheck logs, edit `%s` and re-run xelatex." % self.EF.filename)
+            return 2
         self.term.msg("Compilation seems OK. Check `%s` please." %
                       self.EF.pdffile)
         return
@@ -3419,6 +4304,13 @@ class uiMasterFile(uiShell):
             OUTPUT: <main>_exam.pdf
             INTERNAL: <main>_exam.tex, <main>.xml, <main>_exam.db
             HUMAN-READABLE DEBUG: <main>_exam.sols
+
+        On a multi-core machine the copies are also split into shards
+        ``<main>_exam-<k>.tex`` (as many as ``MCQXELATEXJOBS``, default: the
+        number of CPUs), which are compiled in parallel and merged (with
+        `qpdf`, or the pypdf module) into <main>_exam.pdf. Then
+        <main>_exam.tex, with all the copies, is written but not compiled.
+        Without `qpdf` and pypdf, <main>_exam.tex is compiled as usual.
         """
         global SOLUTIONS_FILE, DB_FILE, DB_STATS_FILE, RG, RGC
         self.EF.refresh()
@@ -3441,27 +4333,32 @@ class uiMasterFile(uiShell):
         DB_STATS_FILE = open(self.EF.exam_stats_db, 'wb')
         output = open(self.EF.exam_tex, 'w')
         NUMBER_OF_COPIES = int(args.strip())
+        # with more CPUs, the copies are compiled in parallel in shards
+        shards = []
+        if DOLATEX and min(XELATEX_JOBS, NUMBER_OF_COPIES) > 1 and can_merge_pdfs():
+            shards = [open("%s_exam-%i.tex" % (self.EF.basename, k + 1), 'w')
+                      for k in range(min(XELATEX_JOBS, NUMBER_OF_COPIES))]
         try:
-            output.write(generate_copies(self.EF.data, NUMBER_OF_COPIES))
+            generate_copies(self.EF.data, NUMBER_OF_COPIES, output, shards)
             output.close()
+            for fd in shards:
+                fd.close()
         except Exception:
             self.term.error(
                 "ERROR: Failed exam... check logs above and fix-it!")
             return
-        for i in range(2):
-            if DOLATEX:
-                if UNSAFE_DVIPDFMX:
-                    retval = os.system("xelatex -output-driver=\"xdvipdfmx -i %s -E\" %s" % \
-                            (UNSAFE_DVIPDFMX, self.EF.exam_tex))
-                else:
-                    retval = os.system("xelatex %s" % self.EF.exam_tex)
-                # retval = os.system("xelatex %s" % self.EF.exam_tex)
-            else:
-                retval = os.system("touch %s" % self.EF.exam_pdf)
-            if retval:
-                self.term.error(
-                    "Error: XeLaTeX compilation FAILED. Check logs, edit `%s` and re-run xelatex and exam." % self.EF.filename)
-                return
+        if shards:
+            self.term.msg("Compiling %i copies in %i parallel XeLaTeX shards..." %
+                          (NUMBER_OF_COPIES, len(shards)))
+            retval = xelatex_shards([fd.name for fd in shards], self.EF.exam_pdf)
+        elif DOLATEX:
+            retval = xelatex_build(self.EF.exam_tex)
+        else:
+            retval = os.system("touch %s" % self.EF.exam_pdf)
+        if retval:
+            self.term.error(
+                "Error: XeLaTeX compilation FAILED. Check logs, edit `%s` and re-run xelatex and exam." % self.EF.filename)
+            return
         self.term.msg("DEBUG: human readable keys file: %s" %
                       (self.EF.exam_sols,))
         # generate xml
@@ -3527,9 +4424,14 @@ class uiMasterFile(uiShell):
         **WARNING:** Please scan the bubblesheets in GRAYSCALE format, not BW,
         to minimize OMR errors.
 
+        With a local omarscan.py, the result of each page is kept in
+        ``<main>_answers.journal`` until the end: if `omr` is interrupted,
+        running it again on the same files only processes the missing pages.
+
         OUTPUT::
 
             <main>_answers.txt  <main>_answers.pdf
+            INTERNAL: <main>_answers.journal, <main>_answers_pages/
         """
         args = args.strip()
         glob_args = []
@@ -3721,9 +4623,16 @@ class uiMasterFile(uiShell):
         The output file ``<main>_exam.txt`` is an anonymous version, with
         just the <CODE> and <TOTAL> columns, used to publish results on-line.
 
+        The marks of each answers line are kept in ``<main>_exam_mark.cache``,
+        so when `mark` is run again after fixing a few lines of the answersfile,
+        only the changed lines are marked again. The cache is discarded
+        when the answer keys change (i.e. after a new ``exam``), or when
+        it is damaged or written by another version of mcq.
+
         OUTPUT::
 
             <main>_exam.csv, <main>_exam.txt
+            INTERNAL: <main>_exam_mark.cache
         """
         if not os.path.exists(self.EF.exam_db):
             self.term.error(
@@ -3740,16 +4649,19 @@ class uiMasterFile(uiShell):
         except Exception:
             self.term.error("ERROR: failed to load answersfile `%s`" % args)
             return
-        DB_LIST = pickle.load(DB_FILE)
+        DB_LIST = load_exam_keys(DB_FILE)
         DB_FILE.close()
         num_exerm = number_of_items(DB_LIST)
         max_points = DB_LIST['__punti__'][0] * num_exerm
+        cache = load_mark_cache(self.EF.exam_mark_cache)
         try:
-            li = correggi(DB_LIST, data)
+            li = correggi_incrementale(
+                DB_LIST, data, cache, DB_LIST['__chiave__'])
         except Exception:
             self.term.error(
                 "ERROR: marking failed... check logs... and re-try.")
             return
+        save_mark_cache(self.EF.exam_mark_cache, cache)
         li = riarrangia(li, extract_target(data))
         riordina(li)
         output.write(display(li))
@@ -3800,17 +4712,10 @@ class uiMasterFile(uiShell):
         fd = open(self.EF.exam_stats_tex, 'w')
         fd.write(generate_stats_texfile(data, db))
         fd.close()
-        for i in range(2):
-            if UNSAFE_DVIPDFMX:
-                retval = os.system("xelatex -output-driver=\"xdvipdfmx -i %s -E\" %s" % \
-                        (UNSAFE_DVIPDFMX, self.EF.exam_stats_tex))
-            else:
-                retval = os.system("xelatex %s" % self.EF.exam_stats_tex)
-            # retval = os.system("xelatex %s" % self.EF.exam_stats_tex)
-            if retval:
-                self.term.error(
-                    "Error: STATS XeLaTeX compilation FAILED. Check logs and `%s`..." % self.EF.exam_stats_tex)
-                return
+        if xelatex_build(self.EF.exam_stats_tex):
+            self.term.error(
+                "Error: STATS XeLaTeX compilation FAILED. Check logs and `%s`..." % self.EF.exam_stats_tex)
+            return
         self.term.msg("Statistics file %s generated." %
                       self.EF.exam_stats_pdf)
         return
@@ -4211,16 +5116,10 @@ class uiChooser(uiShell):
 
             <file>.pdf
         """
-        for i in range(2):
-            if UNSAFE_DVIPDFMX:
-                retval = os.system("xelatex -output-driver=\"xdvipdfmx -i %s -E\" %s" % \
-                        (UNSAFE_DVIPDFMX, self.db.get('filename') ))
-            else:
-                retval = os.system("xelatex %s" % self.db.get('filename'))
-            if retval:
-                self.term.error(
-                    "Error: compilation FAILED!\nCheck logs, edit `%s` and re-run xelatex." % self.db.get('filename'))
-                return
+        if xelatex_build(self.db.get('filename')):
+            self.term.error(
+                "Error: compilation FAILED!\nCheck logs, edit `%s` and re-run xelatex." % self.db.get('filename'))
+            return
         bn, ext = os.path.splitext(self.db.get('filename'))
         pdffile = bn + '.pdf'
         self.term.msg("Compilation seems OK. Check `%s` please." % pdffile)
@@ -5063,7 +5962,7 @@ def main():
     data, output = get_opt()
     origdata = data
     if EVALUATE:
-        DB_LIST = pickle.load(DB_FILE)
+        DB_LIST = load_exam_keys(DB_FILE)
         DB_FILE.close()
         sys.stderr.write("Evaluating...\n")
         num_exerm = number_of_items(DB_LIST)
@@ -5095,7 +5994,7 @@ def main():
             data = convert_to_utf(data)
         output.write(generate_stats_texfile(data, db))
         return
-    output.write(generate_copies(data, NUMBER_OF_COPIES))
+    generate_copies(data, NUMBER_OF_COPIES, output)
     sys.stderr.write("Output written to file: %s\n" % output.name)
     try:
         lbldb = getdb_labels(BASENAMEFILE)
@@ -1,6 +1,15 @@
 #!/usr/bin/env python3
 r"""
 omarscan [--verbose] [--Debug] [--help] --xml=<file.xml> scannedsheets.pdf
+omarscan --serve=<port>
+
+--serve=<port>: local OMR service on http://localhost:<port>/, with the same
+  XML-RPC protocol of OMARSERVICE (use OMARSERVICE=http://localhost:<port>/
+  with mcq.py); the templates and the worker processes are kept between the
+  jobs, and http://localhost:<port>/progress/<job_id> streams the progress.
+  Large batches can be uploaded in parts (upload_status, upload_part,
+  upload_commit), and the annotated pdf downloaded in parts (get_result_info,
+  get_result_part), without holding them in memory.
 
 <-dlf> 2024-11-14
 Local OMRscan for MCQ-XeLaTeX
@@ -8,6 +17,22 @@ Local OMRscan for MCQ-XeLaTeX
 UBUNTU:
 apt install python3-opencv python3-pylibdmtx
 python -m pip install pypdf [--upgrade]
+python -m pip install pypdfium2 [optional: no gs and png files]
+
+ENVIRONMENT VARIABLES:
+OMR_WORKERS   [number of worker processes; default: number of cores]
+OMR_TEMPLATE_CACHE [directory of the template cache; empty: no cache]
+OMR_REPORT_JPEG [jpeg quality of the report pages; 0: lossless png; default: 75]
+OMR_REPORT_ANOMALIES [1: the report has only the pages with red/orange/blue marks]
+OMR_CHUNK_PAGES [more pages than this are processed in chunks; default: 200]
+OMR_DMTX_TIMEOUT [datamatrix decoding timeout, in ms, first pass; default: 300]
+OMR_TIMINGS   [1: write the time of each step (align, blobs, ...) of each page]
+OMR_SERVICE_PASSWORD [key of the HMAC of the jobs of --serve; default: as mcq.py]
+
+The result of each page is written, as soon as it is done, to the journal
+<main>_answers.journal, next to <main>_answers.txt (the annotated images in
+<main>_answers_pages/): if omarscan is interrupted, a new run on the same
+files, with the same settings, processes only the missing pages.
 
 (C)  DLFerrario http://www.dlfer.xyz/var/mcqxelatex.html
 """
@@ -22,28 +47,63 @@ import glob
 import subprocess
 import tempfile
 import shutil
+import hashlib
+import struct
+import json
+import importlib
 import defusedxml.ElementTree as ET
 
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
-from PIL import __version__ as PIL_version
-PIL_M_version= int( PIL_version.split(".")[0])
-
 import time
 import datetime
 from six.moves import range
 import socket
-
-
-import cv2 as cv
-from pylibdmtx import pylibdmtx
-from pylibdmtx import __version__ as DMTX_version
-import pypdf as pyPdf
+import multiprocessing
+import functools
+import threading
+import queue
+import collections
+import concurrent.futures
+import zipfile
+import io
+import hmac
+import pickle
+import socketserver
+import xmlrpc.server
+import xmlrpc.client
+
+
+class LazyModule:
+    """ a module imported when it is first used: the heavy ones are not
+    imported when omarscan is loaded (e.g. by mcq.py), only when a page
+    is processed """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+PIL = LazyModule("PIL")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont")
+cv = LazyModule("cv2")
+DMTX = LazyModule("pylibdmtx")
+pylibdmtx = LazyModule("pylibdmtx.pylibdmtx")
+pyPdf = LazyModule("pypdf")
+try:
+    # optional: in-process rasterization (otherwise gs + png files)
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
 
 
 #-----------------------------------------------------------------
 SELF_URL='https://www.dlfer.xyz/var/omarscan.py'
+SELF_FILE = os.path.abspath(__file__) # before any chdir (OMR changes the cwd)
 #-----------------------------------------------------------------
 A4_width = 210.0  # mm
 A4_height = 297.0  # mm
@@ -70,12 +130,38 @@ ISOPERIMETRIC_CONSTANT= 28 # >= 4
 VERBOSE = True
 VVERBOSE = False
 DEBUG=False
+STAGE_TIMINGS = os.environ.get('OMR_TIMINGS', '0') not in ('', '0')
 
 TMPBASE = 'omr-form'
 TMPTODOBASE = 'omr-marks-'
 FQDN = socket.gethostname() #'u53040a.matapp.unimib.it'
-MAX_PAGES = 999
+# larger batches are split in chunks of CHUNK_PAGES pages, to bound the
+# rasterized pages on disk
+CHUNK_PAGES = int(os.environ.get('OMR_CHUNK_PAGES', 200))
+PIPELINE_QUEUE = 2 # pages waiting between two stages of the pipeline (per worker)
 MOGRIFY=True
+# number of worker processes for the pages (0 or 1 = no pool)
+if 'OMR_WORKERS' in os.environ:
+    OMR_WORKERS = int(os.environ['OMR_WORKERS'])
+else:
+    OMR_WORKERS = os.cpu_count() or 1
+# rendered exam page + markers, keyed by the hash of <main>.pdf and <main>.xml
+if 'OMR_TEMPLATE_CACHE' in os.environ:
+    TEMPLATE_CACHE = os.environ['OMR_TEMPLATE_CACHE'] or None
+else:
+    TEMPLATE_CACHE = os.path.join(os.path.expanduser("~"), ".omarscan_cache")
+TEMPLATE_CACHE_VERSION = 1
+# pages of the pdf report: jpeg quality (0 = png, lossless), and if only
+# the pages with some anomaly (red, orange or blue marks) are kept
+REPORT_JPEG_QUALITY = int(os.environ.get('OMR_REPORT_JPEG', 75))
+REPORT_ANOMALIES_ONLY = os.environ.get('OMR_REPORT_ANOMALIES', '0') not in ('', '0')
+
+# local OMR service (--serve)
+SERVE_PORT = None
+SERVICE_PASSWORD = os.environ.get('OMR_SERVICE_PASSWORD', 'SECRET').encode('utf-8')
+SERVICE_TEMPLATES = 2 # templates (and pools of workers) kept
+SERVICE_JOBS = 20 # finished jobs kept, for get_result
+SERVICE_MAX_PART = 16 * 1024 * 1024 # bytes, largest upload/download part
 
 STDERR = sys.stderr
 
@@ -83,16 +169,20 @@ STDERR = sys.stderr
 
 #-----------------------------------------------------------------
 #--BEGINSIG--
-import base64;eval(compile(base64.b64decode(b'CmRlZiBjaGVja19zZWxmKCk6CiAgICByZXR1cm4gVHJ1ZQoKZGVmIGNoZWNrX3VwZGF0ZSgpOgogICAgcmV0dXJuIEZhbHNlCgpkZWYgZ2V0X29wdCgpOgogICAgZ2xvYmFsIFZFUkJPU0UsIERFQlVHLCBNT0dSSUZZCiAgICBpZiBub3QgY2hlY2tfc2VsZigpOgogICAgICAgIHN5cy5zdGRlcnIud3JpdGUoCiAgICAgICAgIlNlbGYtaW50ZWdyaXR5IGNoZWNrc3VtIGZhaWxlZCEgQWJvcnRpbmcuLi5cbkluc3RhbGwgYSBuZXcgY2xlYW4gdmVyc2lvbiFcbiIpCiAgICAgICAgc3lzLmV4aXQoMSkKICAgIHRyeToKICAgICAgaWYgY2hlY2tfdXBkYXRlKCk6CiAgICAgICAgdXNlcl9pbnB1dCA9IGlucHV0KCJcblxuICAgKioqQSBuZXcgdmVyc2lvbiBpcyBhdmFpbGFibGU6IHt9KioqXG5cbiAgICoqKlBsZWFzZSB1cGRhdGUgb21hcnNjYW4ucHkgQVNBUCEqKipcblxuUHJlc3MgPFJldHVybj4gdG8gY29udGludWUuLi4iLmZvcm1hdChTRUxGX1VSTCkpCiAgICBleGNlcHQgRXhjZXB0aW9uIGFzIGVycjoKICAgICAgICBzeXMuc3RkZXJyLndyaXRlKCJXQVJOSU5HOiBjaGVja191cGRhdGUgZmFpbGVkIHdpdGggZXJyb3Ige31cbiIuZm9ybWF0KGVycikgKQogICAgdHJ5OgogICAgICAgIG9wdHMsIGFyZ3MgPSBnZXRvcHQuZ2V0b3B0KHN5cy5hcmd2WzE6XSwgImh4OnZEbSIsIFsKICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAiaGVscCIsICJ4bWw9IiwgInZlcmJvc2UiLCdEZWJ1ZycsIm1vZ3JpZnkiXSkKICAgICMgZXhjZXB0IGdldG9wdC5HZXRvcHRFcnJvciwgZXJyOgogICAgZXhjZXB0OgogICAgICAgIFNUREVSUi53cml0ZSgiKioqR0VUT1BUIEVSUk9SKioqXG5bb3B0aW9uIC0taGVscCBmb3IgaGVscF1cbiIpCiAgICAgICAgc3lzLmV4aXQoMSkKICAgIGlmIGxlbihhcmdzKSA9PSAwOgogICAgICAgIHByaW50KF9fZG9jX18pCiAgICAgICAgcHJpbnRfdmVyc2lvbnMoKQogICAgICAgIHN5cy5leGl0KDEpCiAgICBIQVNYTUxGSUxFID0gRmFsc2UKICAgIGZvciBvLCBhIGluIG9wdHM6CiAgICAgICAgaWYgbyA9PSAiLXYiOgogICAgICAgICAgICBWRVJCT1NFID0gVHJ1ZQogICAgICAgIGVsaWYgbyA9PSAiLUQiOgogICAgICAgICAgICBERUJVRyA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItbSIsIi0tbW9ncmlmeSIpOgogICAgICAgICAgICBNT0dSSUZZID0gVHJ1ZQogICAgICAgIGVsaWYgbyBpbiAoIi1oIiwgIi0taGVscCIpOgogICAgICAgICAgICBwcmludChfX2RvY19fKQogICAgICAgICAgICBwcmludF92ZXJzaW9ucygpCiAgICAgICAgICAgIHN5cy5leGl0KCkKICAgICAgICBlbGlmIG8gaW4gKCcteCcsICctLXhtbCcpOgogICAgICAgICAgICBYTUxGSUxFID0gYQogICAgICAgICAgICBIQVNYTUxGSUxFID0gVHJ1ZQogICAgaWYgSEFTWE1MRklMRSBhbmQgb3MucGF0aC5leGlzdHMoWE1MRklMRSk6CiAgICAgICAgcmV0dXJuIChvcy5wYXRoLmFic3BhdGgoWE1MRklMRSksIFtvcy5wYXRoLmFic3BhdGgoeCkgZm9yIHggaW4gYXJnc10pCiAgICBlbHNlOgogICAgICAgIHJhaXNlIEV4Y2VwdGlvbigieG1sIGZpbGUgbm90IGZvdW5kIVxuIikKCmRlZiBjaGVja191cGRhdGUoKToKICAgIGltcG9ydCBvcywgZGF0ZXRpbWUKICAgIHNlbGZfbmFtZSA9IG9zLnBhdGguc3BsaXQob3MucGF0aC5yZWFscGF0aChfX2ZpbGVfXykpWzFdCiAgICBsYXN0X21vZGlmaWVkX2RhdGUgPSBnZXRfcmVtb3RlX2xhc3RfY29tbWl0KHNlbGZfbmFtZSkKICAgIHRoaXNfc2NyaXB0X2RhdGUgPSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZSgnMjAyNC0xMS0xNCcsICclWS0lbS0lZCcpCiAgICByZXR1cm4gKGxhc3RfbW9kaWZpZWRfZGF0ZSAtIHRoaXNfc2NyaXB0X2RhdGUpLmRheXMgPiAwIApkZWYgY2hlY2tfc2VsZigpOgogaW1wb3J0IG9zLCBoYXNobGliLCByZSwgc3lzLCBkYXRldGltZQogTUVfYmFzZSxNRV9leHQ9b3MucGF0aC5zcGxpdGV4dChvcy5wYXRoLmFic3BhdGgoX19maWxlX18pKQogTUU9TUVfYmFzZSsnLnB5JwogaWYgKGRhdGV0aW1lLmRhdGV0aW1lLnRvZGF5KCkgLSBkYXRldGltZS5kYXRldGltZS5zdHJwdGltZSgnMjAyNC0xMS0xNCcsICclWS0lbS0lZCcpKS5kYXlzPiA3MjA6CiAgICAgc3lzLnN0ZGVyci53cml0ZSgiXG4gPj4+V0FSTklORyEhISBWZXJ5IG9sZCBzY3JpcHQhIENoZWNrIGlmIHlvdSBjYW4gZG93bmxvYWQgYSBuZXcgb25lITw8PFxuXG4iKQogICAgIGlucHV0KCdQcmVzcyA8UmV0dXJuPiB0byBDb250aW51ZS4uLicpCiBpZiBzeXMudmVyc2lvbl9pbmZvWzBdID4gMjoKICAgYWxsPW9wZW4oTUUsJ3InLGVuY29kaW5nPSd1dGYtOCcpLnJlYWQoKQogICBkZWYgbXlfaGFzaChpbnB1dF9jb250ZW50KToKICAgICByZXR1cm4gaGFzaGxpYi5zaGEyMjQoaW5wdXRfY29udGVudC5lbmNvZGUoZW5jb2Rpbmc9J3V0Zi04JykpLmhleGRpZ2VzdCgpCiBlbHNlOgogICBhbGw9b3BlbihNRSwncicpLnJlYWQoKQogICBkZWYgbXlfaGFzaChpbnB1dF9jb250ZW50KToKICAgICByZXR1cm4gaGFzaGxpYi5zaGEyMjQoaW5wdXRfY29udGVudCkuaGV4ZGlnZXN0KCkKIHA9YWxsLmluZGV4KCJcbiIpCiByZWc9cmUuY29tcGlsZSgiIy0tQkVHSU4iKyJTSUctLXwjLS1FTkQiKyJTSUctLSIscmUuTSBhbmQgcmUuRE9UQUxMICkKIGJvZHlfZmlyc3QsaGlkZGVuLGJvZHlfbGFzdD1yZXM9cmVnLnNwbGl0KGFsbFtwKzE6XSkKIGw9bXlfaGFzaChib2R5X2ZpcnN0LnN0cmlwKCkgKyBib2R5X2xhc3Quc3RyaXAoKSkKIGV4cGVjdF9sPScwMTgwZDVmMmM5MDZlODEwMjRmYTY1MzMxMDU3N2M3NmFmYTIyNTJjNjBjOTUxYTZlYTYxYWQ0MycKIGlmIGwgIT0gZXhwZWN0X2w6CiAgcmV0dXJuIEZhbHNlCiBlbHNlOgogIHJldHVybiBUcnVlCg==').decode('utf-8'),'<string>','exec'))
+import base64;eval(compile(base64.b64decode(b'CmRlZiBjaGVja19zZWxmKCk6CiAgICByZXR1cm4gVHJ1ZQoKZGVmIGNoZWNrX3VwZGF0ZSgpOgogICAgcmV0dXJuIEZhbHNlCgpkZWYgZ2V0X29wdCgpOgogICAgZ2xvYmFsIFZFUkJPU0UsIERFQlVHLCBNT0dSSUZZLCBTRVJWRV9QT1JUCiAgICBpZiBub3QgY2hlY2tfc2VsZigpOgogICAgICAgIHN5cy5zdGRlcnIud3JpdGUoCiAgICAgICAgIlNlbGYtaW50ZWdyaXR5IGNoZWNrc3VtIGZhaWxlZCEgQWJvcnRpbmcuLi5cbkluc3RhbGwgYSBuZXcgY2xlYW4gdmVyc2lvbiFcbiIpCiAgICAgICAgc3lzLmV4aXQoMSkKICAgIHRyeToKICAgICAgaWYgY2hlY2tfdXBkYXRlKCk6CiAgICAgICAgdXNlcl9pbnB1dCA9IGlucHV0KCJcblxuICAgKioqQSBuZXcgdmVyc2lvbiBpcyBhdmFpbGFibGU6IHt9KioqXG5cbiAgICoqKlBsZWFzZSB1cGRhdGUgb21hcnNjYW4ucHkgQVNBUCEqKipcblxuUHJlc3MgPFJldHVybj4gdG8gY29udGludWUuLi4iLmZvcm1hdChTRUxGX1VSTCkpCiAgICBleGNlcHQgRXhjZXB0aW9uIGFzIGVycjoKICAgICAgICBzeXMuc3RkZXJyLndyaXRlKCJXQVJOSU5HOiBjaGVja191cGRhdGUgZmFpbGVkIHdpdGggZXJyb3Ige31cbiIuZm9ybWF0KGVycikgKQogICAgdHJ5OgogICAgICAgIG9wdHMsIGFyZ3MgPSBnZXRvcHQuZ2V0b3B0KHN5cy5hcmd2WzE6XSwgImh4OnZEbXM6IiwgWwogICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICJoZWxwIiwgInhtbD0iLCAidmVyYm9zZSIsJ0RlYnVnJywibW9ncmlmeSIsInNlcnZlPSJdKQogICAgIyBleGNlcHQgZ2V0b3B0LkdldG9wdEVycm9yLCBlcnI6CiAgICBleGNlcHQ6CiAgICAgICAgU1RERVJSLndyaXRlKCIqKipHRVRPUFQgRVJST1IqKipcbltvcHRpb24gLS1oZWxwIGZvciBoZWxwXVxuIikKICAgICAgICBzeXMuZXhpdCgxKQogICAgZm9yIG8sIGEgaW4gb3B0czoKICAgICAgICBpZiBvIGluICgiLXMiLCAiLS1zZXJ2ZSIpOgogICAgICAgICAgICBTRVJWRV9QT1JUID0gaW50KGEpCiAgICAgICAgICAgIHJldHVybiAoTm9uZSwgW10pCiAgICBpZiBsZW4oYXJncykgPT0gMDoKICAgICAgICBwcmludChfX2RvY19fKQogICAgICAgIHByaW50X3ZlcnNpb25zKCkKICAgICAgICBzeXMuZXhpdCgxKQogICAgSEFTWE1MRklMRSA9IEZhbHNlCiAgICBmb3IgbywgYSBpbiBvcHRzOgogICAgICAgIGlmIG8gPT0gIi12IjoKICAgICAgICAgICAgVkVSQk9TRSA9IFRydWUKICAgICAgICBlbGlmIG8gPT0gIi1EIjoKICAgICAgICAgICAgREVCVUcgPSBUcnVlCiAgICAgICAgZWxpZiBvIGluICgiLW0iLCItLW1vZ3JpZnkiKToKICAgICAgICAgICAgTU9HUklGWSA9IFRydWUKICAgICAgICBlbGlmIG8gaW4gKCItaCIsICItLWhlbHAiKToKICAgICAgICAgICAgcHJpbnQoX19kb2NfXykKICAgICAgICAgICAgcHJpbnRfdmVyc2lvbnMoKQogICAgICAgICAgICBzeXMuZXhpdCgpCiAgICAgICAgZWxpZiBvIGluICgnLXgnLCAnLS14bWwnKToKICAgICAgICAgICAgWE1MRklMRSA9IGEKICAgICAgICAgICAgSEFTWE1MRklMRSA9IFRydWUKICAgIGlmIEhBU1hNTEZJTEUgYW5kIG9zLnBhdGguZXhpc3RzKFhNTEZJTEUpOgogICAgICAgIHJldHVybiAob3MucGF0aC5hYnNwYXRoKFhNTEZJTEUpLCBbb3MucGF0aC5hYnNwYXRoKHgpIGZvciB4IGluIGFyZ3NdKQogICAgZWxzZToKICAgICAgICByYWlzZSBFeGNlcHRpb24oInhtbCBmaWxlIG5vdCBmb3VuZCFcbiIpCgpkZWYgY2hlY2tfdXBkYXRlKCk6CiAgICBpbXBvcnQgb3MsIGRhdGV0aW1lCiAgICBzZWxmX25hbWUgPSBvcy5wYXRoLnNwbGl0KG9zLnBhdGgucmVhbHBhdGgoX19maWxlX18pKVsxXQogICAgbGFzdF9tb2RpZmllZF9kYXRlID0gZ2V0X3JlbW90ZV9sYXN0X2NvbW1pdChzZWxmX25hbWUpCiAgICB0aGlzX3NjcmlwdF9kYXRlID0gZGF0ZXRpbWUuZGF0ZXRpbWUuc3RycHRpbWUoJzIwMjQtMTEtMTQnLCAnJVktJW0tJWQnKQogICAgcmV0dXJuIChsYXN0X21vZGlmaWVkX2RhdGUgLSB0aGlzX3NjcmlwdF9kYXRlKS5kYXlzID4gMCAKZGVmIGNoZWNrX3NlbGYoKToKIGltcG9ydCBvcywgaGFzaGxpYiwgcmUsIHN5cywgZGF0ZXRpbWUKIE1FX2Jhc2UsTUVfZXh0PW9zLnBhdGguc3BsaXRleHQob3MucGF0aC5hYnNwYXRoKF9fZmlsZV9fKSkKIE1FPU1FX2Jhc2UrJy5weScKIGlmIChkYXRldGltZS5kYXRldGltZS50b2RheSgpIC0gZGF0ZXRpbWUuZGF0ZXRpbWUuc3RycHRpbWUoJzIwMjQtMTEtMTQnLCAnJVktJW0tJWQnKSkuZGF5cz4gNzIwOgogICAgIHN5cy5zdGRlcnIud3JpdGUoIlxuID4+PldBUk5JTkchISEgVmVyeSBvbGQgc2NyaXB0ISBDaGVjayBpZiB5b3UgY2FuIGRvd25sb2FkIGEgbmV3IG9uZSE8PDxcblxuIikKICAgICBpbnB1dCgnUHJlc3MgPFJldHVybj4gdG8gQ29udGludWUuLi4nKQogaWYgc3lzLnZlcnNpb25faW5mb1swXSA+IDI6CiAgIGFsbD1vcGVuKE1FLCdyJyxlbmNvZGluZz0ndXRmLTgnKS5yZWFkKCkKICAgZGVmIG15X2hhc2goaW5wdXRfY29udGVudCk6CiAgICAgcmV0dXJuIGhhc2hsaWIuc2hhMjI0KGlucHV0X2NvbnRlbnQuZW5jb2RlKGVuY29kaW5nPSd1dGYtOCcpKS5oZXhkaWdlc3QoKQogZWxzZToKICAgYWxsPW9wZW4oTUUsJ3InKS5yZWFkKCkKICAgZGVmIG15X2hhc2goaW5wdXRfY29udGVudCk6CiAgICAgcmV0dXJuIGhhc2hsaWIuc2hhMjI0KGlucHV0X2NvbnRlbnQpLmhleGRpZ2VzdCgpCiBwPWFsbC5pbmRleCgiXG4iKQogcmVnPXJlLmNvbXBpbGUoIiMtLUJFR0lOIisiU0lHLS18Iy0tRU5EIisiU0lHLS0iLHJlLk0gYW5kIHJlLkRPVEFMTCApCiBib2R5X2ZpcnN0LGhpZGRlbixib2R5X2xhc3Q9cmVzPXJlZy5zcGxpdChhbGxbcCsxOl0pCiBsPW15X2hhc2goYm9keV9maXJzdC5zdHJpcCgpICsgYm9keV9sYXN0LnN0cmlwKCkpCiBleHBlY3RfbD0nNzQ2ZjIzYzcwYWIzNTliNjNhZjY1YTkxMTEyMmNhOThjY2YyMjRjZDEyZWZmOTA0YThiYWE0YzYnCiBpZiBsICE9IGV4cGVjdF9sOgogIHJldHVybiBGYWxzZQogZWxzZToKICByZXR1cm4gVHJ1ZQo=').decode('utf-8'),'<string>','exec'))
 #--ENDSIG--
 #-----------------------------------------------------------------
 
 def print_versions():
     STDERR.write("python version: %s\n" % sys.version)
-    STDERR.write("PIL version: %s\n" % PIL_version)
+    STDERR.write("PIL version: %s\n" % PIL.__version__)
     STDERR.write("OpenCV version: %s\n" % cv.__version__)
-    STDERR.write("pylibdmtx version: %s\n" % DMTX_version )
+    STDERR.write("pylibdmtx version: %s\n" % DMTX.__version__ )
     STDERR.write("pyPdf version: %s\n" % pyPdf.__version__)
+    if pdfium is not None:
+        STDERR.write("pypdfium2 version: %s\n" % getattr(pdfium, "V_PYPDFIUM2", "?"))
+    else:
+        STDERR.write("pypdfium2 not found: using %s\n" % GHOSTSCRIPT_COMMAND)
 
 #-----------------------------------------------------------------
 def txt2py(t, s):
@@ -215,6 +305,16 @@ def roundxy(pt):
     return (Round(pt[0]), Round(pt[1]))
 
 
+def kdtree(points):
+    """ the KD-tree of points, or None if there is no scipy (optional,
+    and imported only here: it is slow) """
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        return None
+    return cKDTree(points)
+
+
 def EuclDist(pt, qt):
     return math.sqrt((pt[0] - qt[0])**2 + (pt[1] - qt[1])**2)
 
@@ -228,10 +328,54 @@ def is_hrule(rect, width):
     return (rect[2] > width * 0.5) and (rect[3] < 0.1 * width)
 
 
+# coarse-to-fine alignment: scale of the downsampled image, and margin of
+# the regions (in pixels of the downsampled image) where the rules are refined
+ALIGN_SCALE = 0.25
+ALIGN_MARGIN = 3
+
+
 def mySmooth(img):
     return cv.GaussianBlur(img, (BLUR_RADIUS, BLUR_RADIUS),0)
 
 
+class PagePrep:
+    """ the images derived from a page, computed once (when needed) and
+    shared by the steps of the OMR: the blurred page and its Otsu binary """
+    def __init__(self, image):
+        self.image = image
+        self._blurred = None
+        self._binary = None
+
+    def blurred(self):
+        if self._blurred is None:
+            self._blurred = mySmooth(self.image)
+        return self._blurred
+
+    def binary(self):
+        """ the blurred page with the Otsu threshold: dark = 0, light = 255 """
+        if self._binary is None:
+            ret, self._binary = cv.threshold(self.blurred(), 128, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+        return self._binary
+
+
+class StageTimer:
+    """ the time of each step of a page, written if STAGE_TIMINGS """
+    def __init__(self):
+        self.timings = []
+        self.last_time = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.timings.append((stage, now - self.last_time))
+        self.last_time = now
+
+    def dump(self, name):
+        if STAGE_TIMINGS:
+            STDERR.write("timings %s: %s (total=%.1f ms)\n" % (name,
+                ", ".join("%s=%.1f ms" % (stage, t * 1000.0) for stage, t in self.timings),
+                sum(t for stage, t in self.timings) * 1000.0))
+
+
 #-----------------------------------------------------------------
 def get_ULUR(bp):
     uri = [x[0]+x[1] for x in bp]
@@ -278,6 +422,24 @@ def Avg(img):
     disc_mask = cv.circle ( disc_mask , disc_center, disc_radius , 255 , -1 )  
     result  = cv.mean(img, mask= disc_mask)
     return result[0]
+
+
+def bubble_sample_index(labelslist, LL, picsize):
+    """ flat indices of the pixels averaged by Avg() around each bubble
+    (the inscribed disc of the 2LL x 2LL square): one row for each bubble """
+    picwidth, picheight = picsize
+    disc_mask = np.zeros((2 * LL, 2 * LL), dtype=np.uint8)
+    disc_mask = cv.circle(disc_mask, (LL, LL), LL, 255, -1)
+    dy, dx = np.nonzero(disc_mask)
+    centers = np.array([roundxy(r[2]) for r in labelslist], dtype=np.intp).reshape(-1, 2)
+    cols = np.clip(centers[:, 0:1] - LL + dx[np.newaxis, :], 0, picwidth - 1)
+    rows = np.clip(centers[:, 1:2] - LL + dy[np.newaxis, :], 0, picheight - 1)
+    return rows * picwidth + cols
+
+
+def bubbles_darkness(image, sample_index):
+    """ Avg() of all the bubbles at once """
+    return np.ravel(image)[sample_index].mean(axis=1)
     
 
 def FindContours(image):
@@ -302,20 +464,64 @@ def Round(x):
     return int( round(x) )
 
 #-----------------------------------------------------------------
-def align_markers(image):
+def find_hrules(image, width=None, smooth=True, bw=None):
+    """ the (UL, UR) corners of the horizontal rules of image; width is the
+    width of the page (if image is a part of it). bw is the (inverted)
+    binary image, if already computed """
     threshval = 128
     threshval = 0 
-    img_height,img_width = image.shape
-    ret, bw = cv.threshold(mySmooth(image), threshval, 255, cv.THRESH_BINARY_INV + cv.THRESH_OTSU)
+    if width is None:
+        width = image.shape[1]
+    if bw is None:
+        if smooth:
+            image = mySmooth(image)
+        ret, bw = cv.threshold(image, threshval, 255, cv.THRESH_BINARY_INV + cv.THRESH_OTSU)
     contours_poly = FindContours(bw) 
-    ii = 0
     possible_markers = []
     for x in contours_poly:
         rect= cv.boundingRect(x)
-        if is_hrule(rect, img_width):
-            ii += 1
+        if is_hrule(rect, width):
             boxpoints = cv.boxPoints(cv.minAreaRect(x))
             possible_markers.append(get_ULUR(boxpoints))
+    return possible_markers
+
+
+def align_markers(image, prep=None):
+    img_height,img_width = image.shape
+    bw = None
+    if prep is not None:
+        bw = cv.bitwise_not(prep.binary())
+    return pick_markers(find_hrules(image, bw=bw), img_width, img_height)
+
+
+def align_markers_coarse(image):
+    """ the same as align_markers, but faster: the rules are found on the
+    image downsampled by ALIGN_SCALE, and then refined at full resolution
+    only in a small region around each of them """
+    img_height,img_width = image.shape
+    small = cv.resize(image, None, fx=ALIGN_SCALE, fy=ALIGN_SCALE, interpolation=cv.INTER_AREA)
+    margin = Round(ALIGN_MARGIN / ALIGN_SCALE)
+    possible_markers = []
+    for (ul, ur) in find_hrules(small, smooth=False):
+        xs = [ul[0] / ALIGN_SCALE, ur[0] / ALIGN_SCALE]
+        ys = [ul[1] / ALIGN_SCALE, ur[1] / ALIGN_SCALE]
+        x0, x1 = max(Round(min(xs)) - margin, 0), min(Round(max(xs)) + margin, img_width)
+        y0, y1 = max(Round(min(ys)) - margin, 0), min(Round(max(ys)) + margin, img_height)
+        fine = find_hrules(image[y0:y1, x0:x1], img_width)
+        if len(fine) == 0:
+            continue
+        # the longest one, if there are more
+        pl, pr = max(fine, key=lambda m: abs(m[1][0] - m[0][0]))
+        possible_markers.append(((pl[0] + x0, pl[1] + y0), (pr[0] + x0, pr[1] + y0)))
+    if len(possible_markers) < 2:
+        if VERBOSE:
+            STDERR.write("coarse alignment failed: trying at full resolution...\n")
+        return align_markers(image)
+    return pick_markers(possible_markers, img_width, img_height)
+
+
+def pick_markers(possible_markers, img_width, img_height):
+    """ the top and bottom rules """
     markfoot = [(0, 0), (img_width, 0)]
     markhead = [(0, img_height), (img_width, img_height)]
     for (pl, pr) in possible_markers:
@@ -342,16 +548,40 @@ def align_markers(image):
 
 
 def decode_datamatrix(candidate):
-    # CV_8UC3
-    res = pylibdmtx.decode( ( 
+    """ a first pass on the shrunk image, with a short timeout; a second
+    one at full resolution only if the first one fails """
+    # CV_8UC1 or CV_8UC3
+    for timeout, shrink in ((DMTX_TIMEOUT, DMTX_SHRINK), (DMTX_RETRY_TIMEOUT, 1)):
+        res = pylibdmtx.decode( ( 
                     candidate.tobytes(),
                     candidate.shape[1], 
-                    candidate.shape[0]  )
+                    candidate.shape[0]  ),
+                    timeout=timeout, shrink=shrink, max_count=1
                     )
-    if len(res)==1:
-        return res[0].data.decode()
-    else:
-        return [] 
+        if len(res)==1:
+            return res[0].data.decode()
+        if VVERBOSE:
+            STDERR.write("decode_datamatrix: failed with shrink=%i\n" % shrink)
+        if shrink == 1:
+            break
+    return [] 
+
+
+def timed_decode_datamatrix(candidate):
+    start_time = time.time()
+    dm = decode_datamatrix(candidate)
+    return dm, time.time() - start_time
+
+
+DECODE_POOL = None
+
+def decode_pool():
+    """ the threads decoding the datamatrix codes while the marks are
+    detected (libdmtx runs without the GIL); one pool per process """
+    global DECODE_POOL
+    if DECODE_POOL is None or DECODE_POOL[0] != os.getpid():
+        DECODE_POOL = (os.getpid(), concurrent.futures.ThreadPoolExecutor(DECODE_THREADS))
+    return DECODE_POOL[1]
 
 #-----------------------------------------------------------------
 
@@ -378,29 +608,79 @@ def get_markpoints(image, minarea, maxarea, minradius, maxradius ):
 
 #-----------------------------------------------------------------
 def contour_filled_value(img, contour):
-    cimg = np.zeros_like(img)
-    cv.drawContours(cimg, [contour], 0 , color=255, thickness=-1)
-    return np.mean(img[cimg==255]) 
+    # the mask of the bounding box only
+    x, y, w, h = cv.boundingRect(contour)
+    cimg = np.zeros((h, w), dtype=np.uint8)
+    cv.drawContours(cimg, [contour], 0 , color=255, thickness=-1, offset=(-x, -y))
+    return np.mean(img[y:y+h, x:x+w][cimg==255]) 
 #-----------------------------------------------------------------
-def get_blobs(image, minarea, maxarea  ):
-    threshval = 128
-    ret, bw_image = cv.threshold(image, threshval, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
-    possible_markpoints = []
-    possible_contours = []
-    possible_radii = [] 
-    # try to find all minimally nested contours. 
-    retvalues = cv.findContours(bw_image,
+def bubble_rois(labelslist, margin, picsize):
+    """ the bounding boxes (x0, y0, x1, y1) of the groups of bubbles
+    (UID, ans, ...), enlarged by margin, merged when they overlap """
+    groups = {}
+    for r in labelslist:
+        groups.setdefault(r[0], []).append(r[2])
+    rois = []
+    for gr in groups:
+        pts = np.array(groups[gr], dtype=np.float64)
+        rois.append([max(Round(pts[:, 0].min() - margin), 0),
+                     max(Round(pts[:, 1].min() - margin), 0),
+                     min(Round(pts[:, 0].max() + margin), picsize[0]),
+                     min(Round(pts[:, 1].max() + margin), picsize[1])])
+    merged = True
+    while merged:
+        merged = False
+        for a in rois:
+            for b in rois:
+                if a is not b and a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    a[:] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    rois.remove(b)
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(a) for a in rois]
+
+
+def find_contours_tree(image, offset=(0, 0)):
+    retvalues = cv.findContours(image,
                             cv.RETR_TREE,
-                            cv.CHAIN_APPROX_SIMPLE
+                            cv.CHAIN_APPROX_SIMPLE,
+                            offset=offset
                             )
     if len(retvalues) == 2:
         contours = retvalues[0]
-        hierarchy = retvalues[1][0]
+        hierarchy = retvalues[1]
     elif len(retvalues) == 3:
         contours = retvalues[1] 
-        hierarchy = retvalues[2][0]
+        hierarchy = retvalues[2]
     else:
         raise Exception("Well, cv.findContours returned unknown list...")
+    if hierarchy is None: # no contours
+        return [], []
+    return list(contours), hierarchy[0]
+
+
+def get_blobs(image, minarea, maxarea, rois=None, bw_image=None):
+    """ the filled blobs of image; if rois is given, only those inside the
+    regions (x0, y0, x1, y1). bw_image is the Otsu binary of image, if
+    already computed """
+    threshval = 128
+    if bw_image is None:
+        ret, bw_image = cv.threshold(image, threshval, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    possible_markpoints = []
+    possible_contours = []
+    possible_radii = [] 
+    # try to find all minimally nested contours. 
+    if rois is None:
+        contours, hierarchy = find_contours_tree(bw_image)
+    else:
+        contours, hierarchy = [], []
+        for (x0, y0, x1, y1) in rois:
+            c, h = find_contours_tree(np.ascontiguousarray(bw_image[y0:y1, x0:x1]), (x0, y0))
+            # the indices of the hierarchy are relative to the roi
+            hierarchy += [[-1, -1, -1, x[3] + len(contours) if x[3] >= 0 else -1] for x in h]
+            contours += c
     if DEBUG:
         STDERR.write("get_blobs: Found {} contours...\n".format(len(contours))) 
     contours_area = [None]*len(contours)
@@ -467,8 +747,195 @@ GHOSTSCRIPT_EXTRACT_COMMAND_ARGS = "-dSAFER -dBATCH -dNOPAUSE -r200 -sDEVICE=png
 
 ENHANCE_CONTRAST_COMMAND = "/usr/bin/mogrify"
 ENHANCE_CONTRAST_ARGS = "-auto-level -sigmoidal-contrast 9x60%%"
+# the same curve, computed in memory (False = fork mogrify on each png)
+NATIVE_CONTRAST = True
+SIGMOIDAL_CONTRAST = 9.0
+SIGMOIDAL_MIDPOINT = 0.60
+
+RASTER_DPI = 200 # same as -r200 above
+# datamatrix decoding: timeout (ms) and shrink factor of the first pass, and
+# timeout of the second pass, at full resolution
+DMTX_TIMEOUT = int(os.environ.get('OMR_DMTX_TIMEOUT', 300))
+DMTX_SHRINK = 2
+DMTX_RETRY_TIMEOUT = 2000
+DECODE_THREADS = 2
+
+
+#-----------------------------------------------------------------
+def render_pdf_pages(pdffile, last_page=None, first_page=1):
+    """ yield the pages of pdffile as grayscale images, with pypdfium2 """
+    pdf = pdfium.PdfDocument(pdffile)
+    try:
+        n = len(pdf)
+        if last_page is not None:
+            n = min(n, last_page)
+        for i in range(first_page-1, n):
+            page = pdf[i]
+            # no antialiasing, as -dTextAlphaBits=1 -dGraphicsAlphaBits=1
+            bitmap = page.render(scale=RASTER_DPI / 72.0, grayscale=True,
+                                 no_smoothtext=True, no_smoothpath=True)
+            img = bitmap.to_numpy()
+            if len(img.shape) == 3:
+                img = img[:, :, 0]
+            yield np.ascontiguousarray(img, dtype=np.uint8)
+            bitmap.close()
+            page.close()
+    finally:
+        pdf.close()
+
+
+#-----------------------------------------------------------------
+def template_cache_file(pdffile, xml):
+    h = hashlib.sha256()
+    h.update(("omarscan-template:%i:%i:%s\n" % (TEMPLATE_CACHE_VERSION, RASTER_DPI,
+        "pdfium" if pdfium is not None else "gs")).encode('utf-8'))
+    for f in (pdffile, xml):
+        with open(f, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b''):
+                h.update(chunk)
+    return os.path.join(TEMPLATE_CACHE, h.hexdigest() + ".npz")
+
+
+def load_template_cache(cachefile):
+    """ return (img, align_markers) or None """
+    if not os.path.exists(cachefile):
+        return None
+    try:
+        with np.load(cachefile) as data:
+            img = data['img']
+            markers = [[tuple(float(x) for x in p) for p in m] for m in data['align_markers']]
+    except Exception as err:
+        STDERR.write("WARNING: template cache %s not valid (%s)\n" % (cachefile, err))
+        return None
+    if VERBOSE:
+        STDERR.write("template loaded from cache %s...\n" % cachefile)
+    return img, markers
 
 
+def save_template_cache(cachefile, img, markers):
+    try:
+        if not os.path.isdir(TEMPLATE_CACHE):
+            os.makedirs(TEMPLATE_CACHE)
+        tmpfile = cachefile + ".%i.tmp.npz" % os.getpid()
+        np.savez_compressed(tmpfile, img=img, align_markers=np.array(markers, dtype=np.float64))
+        os.replace(tmpfile, cachefile)
+    except Exception as err:
+        STDERR.write("WARNING: template cache %s not saved (%s)\n" % (cachefile, err))
+
+#-----------------------------------------------------------------
+def sigmoidal(a, b, x):
+    return 1.0 / (1.0 + np.exp(a * (b - x)))
+
+
+@functools.lru_cache(maxsize=None)
+def contrast_lut(lo, hi):
+    """ 256-entry lookup table of -auto-level (lo,hi -> 0,255)
+    followed by -sigmoidal-contrast 9x60% (as ImageMagick: scaled sigmoid) """
+    a, b = SIGMOIDAL_CONTRAST, SIGMOIDAL_MIDPOINT
+    x = np.clip((np.arange(256, dtype=np.float64) - lo) / max(hi - lo, 1), 0.0, 1.0)
+    y = (sigmoidal(a, b, x) - sigmoidal(a, b, 0.0)) / \
+        (sigmoidal(a, b, 1.0) - sigmoidal(a, b, 0.0))
+    return np.clip(np.rint(y * 255.0), 0, 255).astype(np.uint8)
+
+
+def enhance_contrast(img):
+    """ in-memory equivalent of mogrify ENHANCE_CONTRAST_ARGS """
+    lo, hi, _, _ = cv.minMaxLoc(img)
+    return cv.LUT(img, contrast_lut(int(lo), int(hi)))
+
+#-----------------------------------------------------------------
+def save_report_image(pilimg, base):
+    """ save the annotated page as jpeg (or png, if lossless) """
+    if REPORT_JPEG_QUALITY > 0:
+        f = base + ".jpg"
+        pilimg.save(f, "JPEG", quality=REPORT_JPEG_QUALITY)
+    else:
+        f = base + ".png"
+        pilimg.save(f, "PNG")
+    return f
+
+
+def pdf_string(t):
+    return "(%s)" % t.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+class ReportWriter:
+    """ pdf report written page by page: the image of each page goes
+    to the file as soon as it is added (jpeg as it is, png as its zlib
+    data), and only the object offsets are kept in memory """
+    def __init__(self, outputfile, info):
+        self.outputfile = outputfile
+        self.fd = open(outputfile, "wb")
+        self.offsets = [None, None] # 1: catalog, 2: page tree
+        self.pages = []
+        self.fd.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.info = self.add_object("<< %s >>" % " ".join(
+            "/%s %s" % (k, pdf_string(v)) for k, v in info))
+
+    def add_object(self, body, stream=None, num=None):
+        if num is None:
+            self.offsets.append(None)
+            num = len(self.offsets)
+        self.offsets[num-1] = self.fd.tell()
+        if stream is None:
+            self.fd.write(("%i 0 obj\n%s\nendobj\n" % (num, body)).encode('latin-1'))
+        else:
+            self.fd.write(("%i 0 obj\n<< %s /Length %i >>\nstream\n" %
+                           (num, body, len(stream))).encode('latin-1'))
+            self.fd.write(stream)
+            self.fd.write(b"\nendstream\nendobj\n")
+        return num
+
+    def add_page(self, imagefile):
+        with Image.open(imagefile) as pilimg:
+            (width, height), mode, fmt = pilimg.size, pilimg.mode, pilimg.format
+        colors = {'L': 1, 'RGB': 3}[mode]
+        colorspace = {1: "/DeviceGray", 3: "/DeviceRGB"}[colors]
+        with open(imagefile, "rb") as fd:
+            data = fd.read()
+        if fmt == "JPEG":
+            imgfilter = "/Filter /DCTDecode"
+        elif fmt == "PNG":
+            # the IDAT chunks are already a zlib stream, with png predictors
+            idat = []
+            pos = 8
+            while pos < len(data):
+                length, tag = struct.unpack(">I4s", data[pos:pos+8])
+                if tag == b"IDAT":
+                    idat.append(data[pos+8:pos+8+length])
+                pos += 12 + length
+            data = b"".join(idat)
+            imgfilter = ("/Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors %i "
+                         "/BitsPerComponent 8 /Columns %i >>" % (colors, width))
+        else:
+            raise Exception("Unsupported report image: %s" % imagefile)
+        image = self.add_object("/Type /XObject /Subtype /Image /Width %i /Height %i "
+            "/ColorSpace %s /BitsPerComponent 8 %s" % (width, height, colorspace, imgfilter), data)
+        # the pages have the size of the paper, at RASTER_DPI
+        w, h = width * 72.0 / RASTER_DPI, height * 72.0 / RASTER_DPI
+        content = self.add_object("", ("q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (w, h)).encode('latin-1'))
+        self.pages.append(self.add_object(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+            "/Resources << /XObject << /Im0 %i 0 R >> >> /Contents %i 0 R >>" % (w, h, image, content)))
+
+    def close(self):
+        self.add_object("<< /Type /Pages /Kids [%s] /Count %i >>" % (
+            " ".join("%i 0 R" % p for p in self.pages), len(self.pages)), num=2)
+        self.add_object("<< /Type /Catalog /Pages 2 0 R >>", num=1)
+        xref = self.fd.tell()
+        self.fd.write(("xref\n0 %i\n0000000000 65535 f \n" % (len(self.offsets)+1)).encode('latin-1'))
+        for offset in self.offsets:
+            self.fd.write(("%010i 00000 n \n" % offset).encode('latin-1'))
+        self.fd.write(("trailer\n<< /Size %i /Root 1 0 R /Info %i 0 R >>\nstartxref\n%i\n%%%%EOF\n" %
+                       (len(self.offsets)+1, self.info, xref)).encode('latin-1'))
+        self.fd.close()
+
+    def abort(self):
+        """ the report is not finished: no half-written pdf is left """
+        self.fd.close()
+        if os.path.exists(self.outputfile):
+            os.remove(self.outputfile)
+
 #-----------------------------------------------------------------
 def listify(s):
     return s.split()
@@ -483,15 +950,18 @@ class OMR:
         self.tempdir = tempfile.mkdtemp('_tmp')
         self.cwdir = os.getcwd()
         os.chdir(self.tempdir)
-        if VERBOSE:
-            STDERR.write("extracting image from pdf file %s...\n\n" % pdffile)
-            STDERR.write("executing command %s...\n\n" %
-                         ([ GHOSTSCRIPT_COMMAND ]  + listify(  GHOSTSCRIPT_COMMAND_ARGS  % TMPBASE) + [ pdffile ] ))
-        retval = subprocess.call([ GHOSTSCRIPT_COMMAND ]  + listify(  GHOSTSCRIPT_COMMAND_ARGS  % 
-            TMPBASE  ) + [ pdffile ] , shell=False, stdout=STDERR, stderr=STDERR, stdin=None, close_fds=True)
-        self.img = cv.imread(TMPBASE+"-001.png", 0)
+        cached = None
+        if TEMPLATE_CACHE:
+            cachefile = template_cache_file(pdffile, xml)
+            cached = load_template_cache(cachefile)
+        if cached is not None:
+            self.img, markers = cached
+        else:
+            self.img = self.RenderTemplate(pdffile)
+            markers = align_markers(self.img, PagePrep(self.img))
+            if TEMPLATE_CACHE:
+                save_template_cache(cachefile, self.img, markers)
         self.img_height, self.img_width  = self.img.shape
-        self.img_smooth = mySmooth(self.img) 
         self.labelsdb = xml2db(xml)
         self.UIDlength = 0
         self.anslength = 0
@@ -515,7 +985,17 @@ class OMR:
         ]
         tmpvalues.sort()
         self.bubbleradius = tmpvalues[-1] *0.50 ## radius in pixel
-        self.align_markers = align_markers(self.img)
+        # the disc masks of the bubbles are computed once, here
+        self.sample_LL = Round(self.bubbleradius *1.2 )
+        self.sample_index = bubble_sample_index(
+            self.labelslist, self.sample_LL, (self.img_width, self.img_height))
+        # spatial index of the bubble centers, for find_closest
+        self.bubble_centers = np.array([r[2] for r in self.labelslist],
+                                       dtype=np.float64).reshape(-1, 2)
+        self.bubble_tree = None
+        if len(self.labelslist) > 0:
+            self.bubble_tree = kdtree(self.bubble_centers)
+        self.align_markers = markers
         self.barcodeLR = (Round(
             self.align_markers[0][1][0]+1.0*self.mm_x), Round(self.align_markers[0][1][1]-1*self.mm_y))
         self.barcodeUL = (
@@ -539,10 +1019,27 @@ class OMR:
             STDERR.write("maxradius=\t\t%f px = %f mm\n" %
                          (self.maxradius, self.maxradius / self.mm_x))
         self.miny, self.maxy = self.align_markers[0][0][1], self.align_markers[1][0][1]
+        # the blobs are looked for only around the groups of bubbles
+        self.blob_rois = bubble_rois(self.labelslist, 2 * self.maxradius + BLUR_RADIUS,
+                                     (self.img_width, self.img_height))
         self.afterimgs = []
+        self.pid = os.getpid()
         if VERBOSE:
             STDERR.write("Init complete...\n\n")
 
+    def RenderTemplate(self, pdffile):
+        """ first page of the exam pdf, as a grayscale image """
+        if VERBOSE:
+            STDERR.write("extracting image from pdf file %s...\n\n" % pdffile)
+        if pdfium is not None:
+            return next(render_pdf_pages(pdffile, last_page=1))
+        if VERBOSE:
+            STDERR.write("executing command %s...\n\n" %
+                         ([ GHOSTSCRIPT_COMMAND ]  + listify(  GHOSTSCRIPT_COMMAND_ARGS  % TMPBASE) + [ pdffile ] ))
+        retval = subprocess.call([ GHOSTSCRIPT_COMMAND ]  + listify(  GHOSTSCRIPT_COMMAND_ARGS  % 
+            TMPBASE  ) + [ pdffile ] , shell=False, stdout=STDERR, stderr=STDERR, stdin=None, close_fds=True)
+        return cv.imread(TMPBASE+"-001.png", 0)
+
     def get_allbubblesimg(self):
         other_image = cv.cvtColor(self.img, cv.COLOR_GRAY2RGB)  # fino a che PIL non riesce...
         for r in self.labelslist:
@@ -552,6 +1049,9 @@ class OMR:
         return other_image
 
     def __del__(self):
+        if os.getpid() != self.pid:
+            # a copy living in a worker process: the tempdir is not ours.
+            return
         os.chdir(self.cwdir)
         if VERBOSE:
             STDERR.write("Removing temp directory %s...\n" % self.tempdir)
@@ -571,7 +1071,7 @@ class OMR:
 
     def CorrectlyAlign(self, image):
         markers_orig = self.align_markers
-        markers_scan = align_markers(image)
+        markers_scan = align_markers_coarse(image)
         mymap = find_affine_transform(markers_scan, markers_orig)
         warp_dst = cv.warpAffine(image, mymap, (self.img_width, self.img_height))
         return warp_dst
@@ -583,33 +1083,41 @@ class OMR:
         return img_barcode
 
     def find_closest(self, p):
-        minpoint_ii = 0
-        mindist = EuclDist(p, self.labelslist[0][2])
-        for ii in range(len(self.labelslist)):
-            thisdist = EuclDist(p, self.labelslist[ii][2])
-            if thisdist < mindist:
-                mindist = thisdist
-                minpoint_ii = ii
-        return (self.labelslist[minpoint_ii], mindist)
-
-    def get_marklabels(self, imagefile):
+        return self.find_closest_all([p])[0]
+
+    def find_closest_all(self, points):
+        """ [(closest bubble, distance)] for all the points, in one query """
+        if len(points) == 0:
+            return []
+        pts = np.array(points, dtype=np.float64).reshape(-1, 2)
+        if self.bubble_tree is not None:
+            dists, idx = self.bubble_tree.query(pts)
+        else:
+            # points x bubbles distance matrix: argmin takes the first minimum
+            dd = np.hypot(pts[:, np.newaxis, 0] - self.bubble_centers[np.newaxis, :, 0],
+                          pts[:, np.newaxis, 1] - self.bubble_centers[np.newaxis, :, 1])
+            idx = np.argmin(dd, axis=1)
+            dists = dd[np.arange(len(pts)), idx]
+        return [(self.labelslist[ii], float(dist)) for ii, dist in zip(idx, dists)]
+
+    def get_marklabels(self, imagefile, image=None, timer=None):
         if VVERBOSE:
             STDERR.write("getting marklabels on : %s\n" % str(imagefile))
-        marked_image = self.Load(imagefile)
+        if timer is None:
+            timer = StageTimer()
+        if image is None:
+            marked_image = self.Load(imagefile)
+            timer.lap('load')
+        else:
+            marked_image = image
         temp = self.CorrectlyAlign(marked_image) # temp is greyscale
+        page = PagePrep(temp)
+        timer.lap('align')
         color_image = ( cv.cvtColor(temp, cv.COLOR_GRAY2BGR) ) 
-        img_barcode = self.GetDataMatrix(color_image)
-        dm = decode_datamatrix(img_barcode)
-        if VVERBOSE:
-            STDERR.write("decode_datamatrix: %s\n" % str(dm))
-        # begin added new... 2014-02-18
-        if dm:
-            color_image = cv.rectangle(color_image, self.barcodeUL,
-                      self.barcodeLR, (0, 255, 0), 2)
-        else:
-            color_image = cv.rectangle(color_image, self.barcodeUL,
-                      self.barcodeLR, (0, 0, 255), 3)
-        # end added new ...
+        # the (greyscale) barcode is decoded in a thread, while the marks are detected
+        img_barcode = np.ascontiguousarray(self.GetDataMatrix(temp))
+        decoding = decode_pool().submit(timed_decode_datamatrix, img_barcode)
+        anomalies = 0 # red, orange and blue marks
         # now mark the align markers with small squares of size LL pixels
         LL =  2 
         for x in self.align_markers:
@@ -619,12 +1127,13 @@ class OMR:
                           (px+LL, py+LL), (255, 15, 0), 1)
 
         # find the marked labels by averaging, first
-        LL = Round(self.bubbleradius *1.2 )
+        LL = self.sample_LL
         filled_bubbles = []
         unfilled_bubbles = [] 
-        for r in self.labelslist:
+        darkness = bubbles_darkness(page.image, self.sample_index)
+        timer.lap('darkness')
+        for r, aa in zip(self.labelslist, darkness):
             px, py = roundxy(r[2])
-            aa = ( Avg(GetSubRect(temp, (px-LL, py-LL, 2 * LL, 2 *  LL))))  # __HERE__
             if aa < FILLED_THRES:
                 filled_bubbles.append(r)
                 if DEBUG: 
@@ -637,15 +1146,17 @@ class OMR:
                     STDERR.write(
                             "NOT Appending bubble %s\n with avg=%g\n" % (str(r),aa) )
         markpoints, contours , markpoint_radii = get_blobs(
-            mySmooth(temp), self.minarea, self.maxarea )
+            page.blurred(), self.minarea, self.maxarea, self.blob_rois, page.binary() )
+        timer.lap('blobs')
         circle_radius = self.bubbleradius*1.2
         result = []
         int_radius=Round(self.bubbleradius * 2 )
+        closest_all = self.find_closest_all(markpoints)
         for p_i in range(len(markpoints)):
             p=markpoints[p_i]
             p_contour=contours[p_i]
             if p[1] > self.miny and p[1] < self.maxy:
-                closest, error = self.find_closest(p)
+                closest, error = closest_all[p_i]
                 if DEBUG:
                     STDERR.write("markpoints: p={}; closest={}; error={}\n".format( p, closest, error) ) 
                 if error < 1.3*circle_radius:
@@ -664,11 +1175,13 @@ class OMR:
                             # RED: too big circle 
                             cv.circle(color_image, roundxy(p), Round( markpoint_radii[p_i] ) , (0, 0, 255), 3 )
                             filled_bubbles.remove(closest)
+                            anomalies += 1
                             if DEBUG:
                                 STDERR.write("matching bubbles with blobs: TOO BIG with radius {}: {}\n".format(markpoint_radii[p_i], closest) )
                         elif markpoint_radii[p_i] <= self.minradius :
                             # ORANGE: too small circle
                             cv.circle(color_image, roundxy(p), Round( markpoint_radii[p_i] ) + 3 , (0, 140, 255), 3 )
+                            anomalies += 1
                             if DEBUG:
                                 STDERR.write("matching bubbles with blobs: TOO SMALL with radius {}: {}\n".format(markpoint_radii[p_i], closest) )
                         else:
@@ -677,6 +1190,7 @@ class OMR:
                         # BLUE: closest was not filled? => too small filled mean. 
                         cv.circle(color_image, roundxy(p), Round(
                            circle_radius ), (255, 35 , 35), 3)
+                        anomalies += 1
                         if DEBUG:
                             STDERR.write("matching bubbles with blobs: UNFILLED with radius {}: {}\n".format(markpoint_radii[p_i], closest) )
                         unfilled_bubbles.append(closest) 
@@ -698,36 +1212,73 @@ class OMR:
             cv.circle(color_image, roundxy(r[2]), int_radius , (203, 192, 255), 3) #pink
             if VVERBOSE:
                 STDERR.write("matching bubbles with blobs: WARNING! Appending remaining filled bubble: %s\n" % str(r))
-        return dm, result, color_image
-
-    def Run(self, imagefile):
-        dm, res, img = self.get_marklabels(imagefile)
+        timer.lap('match')
+        dm, decode_time = decoding.result()
+        timer.lap('datamatrix')
+        if VERBOSE:
+            STDERR.write("decode_datamatrix: %s (%.3f sec)\n" % (str(dm), decode_time))
+        # begin added new... 2014-02-18
+        if dm:
+            color_image = cv.rectangle(color_image, self.barcodeUL,
+                      self.barcodeLR, (0, 255, 0), 2)
+        else:
+            color_image = cv.rectangle(color_image, self.barcodeUL,
+                      self.barcodeLR, (0, 0, 255), 3)
+            anomalies += 1
+        # end added new ...
+        return dm, result, color_image, anomalies
+
+    def RunPage(self, imagefile, image=None):
+        """ process one page: return the answers line and the annotated image
+        (it does not touch self, so that it can run in a worker process).
+        If image is None, the page is loaded from imagefile. """
+        timer = StageTimer()
+        dm, res, img, anomalies = self.get_marklabels(imagefile, image, timer)
         _, tmpimagefile = os.path.split(imagefile)
-        if VVERBOSE:
-            STDERR.write("converting file %s to pdf...\n" % imagefile)
-        img = cv.cvtColor(img, cv.COLOR_BGR2RGB)
-        pilimg = Image.fromarray(img)
-        pilimg.save("omr_%s.pdf" % tmpimagefile)
-        self.afterimgs.append("omr_%s.pdf" % tmpimagefile)
+        if REPORT_ANOMALIES_ONLY and not anomalies:
+            afterimg = None # not in the report
+        else:
+            if VVERBOSE:
+                STDERR.write("saving the annotated image of %s...\n" % imagefile)
+            img = cv.cvtColor(img, cv.COLOR_BGR2RGB)
+            pilimg = Image.fromarray(img)
+            # in a worker process the cwd is not the tempdir: name it
+            afterimg = os.path.basename(save_report_image(pilimg, os.path.join(
+                self.tempdir, "omr_%s" % os.path.splitext(tmpimagefile)[0])))
+            timer.lap('save')
+        timer.dump(tmpimagefile)
         uid, ans = check_marked_items(get_marked_items(
             res), self.UIDlength, self.anslength)
-        return "%(dm)s:\t:%(uid)s:%(ans)s:" % {'dm': dm, 'uid': uid, 'ans': ans}
+        return ("%(dm)s:\t:%(uid)s:%(ans)s:" % {'dm': dm, 'uid': uid, 'ans': ans}, afterimg)
+
+    def Run(self, imagefile):
+        line, afterimg = self.RunPage(imagefile)
+        if afterimg is not None:
+            self.afterimgs.append(afterimg)
+        return line
 
-    def ExtractPNG(self, pdffile):
+    def ExtractPNG(self, pdffile, first_page=1, last_page=None):
         base, ext = os.path.splitext(os.path.basename(pdffile))
+        pagerange = []
+        if first_page > 1 or last_page is not None:
+            # a chunk: gs counts the output pages from 1, again
+            base += "-p%i" % first_page
+            pagerange = ["-dFirstPage=%i" % first_page]
+            if last_page is not None:
+                pagerange.append("-dLastPage=%i" % last_page)
         if VERBOSE:
             STDERR.write("Extracting pngs from %s...\n" % pdffile)
         if VERBOSE:
             STDERR.write("Executing command %s...\n\n" % (
                 # [GHOSTSCRIPT_COMMAND] + listify( GHOSTSCRIPT_EXTRACT_COMMAND_ARGS % (TMPTODOBASE+base)) + [ pdffile ]  ) )
-                [GHOSTSCRIPT_COMMAND] + listify( GHOSTSCRIPT_EXTRACT_COMMAND_ARGS ) + [\
+                [GHOSTSCRIPT_COMMAND] + listify( GHOSTSCRIPT_EXTRACT_COMMAND_ARGS ) + pagerange + [\
         "-sOutputFile=%s-%%03d.png" % (TMPTODOBASE+base), pdffile ]  ) )
-        retval = subprocess.call([GHOSTSCRIPT_COMMAND] + listify(  GHOSTSCRIPT_EXTRACT_COMMAND_ARGS ) + [\
+        retval = subprocess.call([GHOSTSCRIPT_COMMAND] + listify(  GHOSTSCRIPT_EXTRACT_COMMAND_ARGS ) + pagerange + [\
             "-sOutputFile=%s-%%03d.png" % (TMPTODOBASE+base), pdffile ]  , shell=False , stdout=STDERR, stderr=STDERR, stdin=None, close_fds=True)
         result = [os.path.abspath(x) for x in glob.glob(
             "%s*.png" % (TMPTODOBASE+base))]
         for x in sorted(result):
-            if MOGRIFY and ENHANCE_CONTRAST_COMMAND:
+            if MOGRIFY and ENHANCE_CONTRAST_COMMAND and not NATIVE_CONTRAST:
                 if VERBOSE:
                     STDERR.write("enhancing image: '%s'...\n" % str(x)) 
                                  # str( [ENHANCE_CONTRAST_COMMAND]  + listify( ENHANCE_CONTRAST_ARGS % (x,) )) )
@@ -735,22 +1286,56 @@ class OMR:
                 + [x], shell=False, stdout=STDERR, stderr=STDERR, stdin=None, close_fds=True)
         result.sort()
         return result
+
+    def IterPages(self, pdffile, first_page=1, last_page=None):
+        """ yield (pagename, image) for each page of pdffile. With pypdfium2
+        the pages are rasterized in memory, one at a time; otherwise they are
+        extracted by gs to png files, and image is None (loaded later). """
+        if pdfium is None or (MOGRIFY and not NATIVE_CONTRAST):
+            # mogrify works only on files...
+            for x in self.ExtractPNG(pdffile, first_page, last_page):
+                if MOGRIFY and NATIVE_CONTRAST:
+                    yield (x, enhance_contrast(self.Load(x)))
+                else:
+                    yield (x, None)
+            return
+        base, ext = os.path.splitext(os.path.basename(pdffile))
+        if VERBOSE:
+            STDERR.write("Rasterizing pages of %s...\n" % pdffile)
+        ii = first_page - 1
+        for img in render_pdf_pages(pdffile, last_page, first_page):
+            ii += 1
+            if MOGRIFY:
+                img = enhance_contrast(img)
+            # same names as the gs output files
+            yield ("%s-%03d.png" % (TMPTODOBASE+base, ii), img)
 #-----------------------------------------------------------------
 
     def GetReport(self, outputfile):
-        ALLBUBBLES = 'omr_allbubbles.pdf'
         if VERBOSE:
             STDERR.write("creating file %s ... \n" %
                          os.path.abspath(outputfile))
+        output = self.NewReport(outputfile)
+        for f in self.afterimgs:
+            self.AddReportPage(output, f)
+        self.WriteReport(output, outputfile)
+        return
+
+    def GetAllBubblesPage(self):
+        ALLBUBBLES = 'omr_allbubbles'
         img = self.get_allbubblesimg()
         pilimg = Image.frombytes("RGB", GetSize(img), (img.tobytes()))
         pilfont_size = Round(GetSize(img)[1] / 50.0)
-        pilfont = ImageFont.truetype(
-            "/usr/share/fonts/libertine/LinBiolinum_R.otf", pilfont_size)
+        try:
+            pilfont = ImageFont.truetype(
+                "/usr/share/fonts/libertine/LinBiolinum_R.otf", pilfont_size)
+        except OSError:
+            # no Linux Libertine here
+            pilfont = ImageFont.load_default()
         pildraw = ImageDraw.Draw(pilimg)
         y_offset = 2*pilfont_size
         for string_to_write in ["OMaRScan", "[@%s - %s]" % (FQDN, datetime.datetime.now().strftime("%a %Y-%m-%d, %X"))]:
-            if PIL_M_version > 8:
+            if int(PIL.__version__.split(".")[0]) > 8:
                 # damn the changes in names.
                 string_size = pildraw.textlength(string_to_write, font=pilfont)
                 x_offset = Round((GetSize(img)[0] - string_size)/2.0)
@@ -760,100 +1345,785 @@ class OMR:
             y_offset += pilfont_size
             pildraw.text((x_offset, y_offset), string_to_write,
                          font=pilfont, fill=(0, 0, 240))
-        pilimg.save(ALLBUBBLES)
+        ALLBUBBLES = os.path.basename(save_report_image(
+            pilimg, os.path.join(self.tempdir, ALLBUBBLES)))
         if VERBOSE:
             STDERR.write("created file %s ... \n" %
-                         os.path.abspath(ALLBUBBLES))
-        output = pyPdf.PdfWriter()
-        infoDict = output._info.get_object()
-        infoDict.update({
-            pyPdf.generic.NameObject('/Title'): pyPdf.generic.create_string_object(u'OMaRScan processed pages'),
-            pyPdf.generic.NameObject('/Author'): pyPdf.generic.create_string_object(u'PIL+GhostScript+pyPdf'),
-            pyPdf.generic.NameObject('/Subject'): pyPdf.generic.create_string_object(u'Marked Bubble Sheets'),
-            pyPdf.generic.NameObject('/Creator'): pyPdf.generic.create_string_object(u'OMaRScan')
-        })
-        for f in ([ALLBUBBLES] + self.afterimgs):
-            if VERBOSE:
-                STDERR.write("Adding page %s ...\n" % f )
-            f = os.path.join(self.tempdir, f)
-            page = pyPdf.PdfReader(open(f, "rb")).pages[0]
-            output.add_page(page)
-        outputStream = open(outputfile, "wb")
-        output.write(outputStream)
-        outputStream.close()
+                         os.path.join(self.tempdir, ALLBUBBLES))
+        return ALLBUBBLES
+
+    def NewReport(self, outputfile):
+        """ a new report, with the all-bubbles page only """
+        output = ReportWriter(outputfile, [
+            ('Title', u'OMaRScan processed pages'),
+            ('Author', u'PIL+GhostScript+pyPdf'),
+            ('Subject', u'Marked Bubble Sheets'),
+            ('Creator', u'OMaRScan')
+        ])
+        try:
+            self.AddReportPage(output, self.GetAllBubblesPage())
+        except BaseException:
+            output.abort()
+            raise
+        return output
+
+    def AddReportPage(self, output, f):
+        if VERBOSE:
+            STDERR.write("Adding page %s ...\n" % f )
+        output.add_page(os.path.join(self.tempdir, f))
+
+    def WriteReport(self, output, outputfile):
+        output.close()
         if VERBOSE:
             STDERR.write("Done! file %s created.\n" % outputfile)
         return
 #-----------------------------------------------------------------
+# worker pool: the template state built once in OMR.__init__ (labelslist,
+# align markers, bubble radius, ...) is read-only, and it is handed to
+# each worker process once: when the pool starts (make_pool(omr, ...)), or,
+# with the pool of the service, started before any template is known
+# (make_pool(None, ...)), from the file of save_worker_template, at the
+# first page of that template.
+# The pools are forked before any thread is started (the pipeline, the
+# service): forking a process with running threads can deadlock.
+WORKER_OMR = collections.OrderedDict() # the templates, by their tempdir
+
+def init_worker(omr):
+    if omr is not None:
+        WORKER_OMR[omr.tempdir] = omr
+
+
+def save_worker_template(omr, filename):
+    omr.templatefile = filename
+    with open(filename + ".tmp", "wb") as fd:
+        pickle.dump(omr, fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + ".tmp", filename)
+
+
+def worker_job(omr, job):
+    return (omr.tempdir, getattr(omr, 'templatefile', None), job)
+
+
+def run_worker(job):
+    key, templatefile, job = job
+    omr = WORKER_OMR.get(key)
+    if omr is None:
+        with open(templatefile, "rb") as fd:
+            omr = pickle.load(fd)
+        WORKER_OMR[key] = omr
+        while len(WORKER_OMR) > SERVICE_TEMPLATES:
+            WORKER_OMR.popitem(last=False)
+    return omr.RunPage(*job)
+
+
+def page_runs(first, last, skip):
+    """ the runs [a, b] of consecutive pages in [first, last] not in skip """
+    runs = []
+    for p in range(first, last+1):
+        if p in skip:
+            continue
+        if runs and runs[-1][1] == p-1:
+            runs[-1][1] = p
+        else:
+            runs.append([p, p])
+    return runs
+
+
+def iter_jobs(omr, pdfs, statusfile=STDERR, number_of_pages=0, pages=None, start=0, stop=None, skip=()):
+    """ yield the ((file index, page), (pagename, image)) jobs of all the
+    pdfs/images, lazily. With pages (the number of pages of each file),
+    only the pages with index in [start, stop) of the whole batch, and
+    not in skip (the pages already done). """
+    if pages is None:
+        pages = get_pages_per_file(pdfs)
+    numx = 0
+    offset = 0
+    for i, f in enumerate(pdfs):
+        # the pages of f are offset+1, ..., offset+pages[i]
+        first, last = max(start-offset, 0) + 1, pages[i]
+        if stop is not None:
+            last = min(last, stop-offset)
+        offset += pages[i]
+        runs = page_runs(first, last, set(p for (j, p) in skip if j == i))
+        if not runs:
+            continue
+        if os.path.splitext(f)[1].lower() == '.pdf':
+            for a, b in runs:
+                for p, job in enumerate(omr.IterPages(f, a, b), a):
+                    numx += 1
+                    yield ((i, p), job)
+        else:
+            numx += 1
+            yield ((i, 1), (f, None))
+        statusfile.write("ETA:?? sec (extracted %i/%i)\n" %
+                         (numx, number_of_pages))
+        statusfile.flush()
+    statusfile.write("ETA:?? sec (extraction finished)\n")
+    statusfile.flush()
 
 
-def get_number_of_pages(pdfs):
-    result = 0
+def prefetch(iterable, maxsize):
+    """ iterate over iterable in a background thread, at most maxsize
+    items ahead of the consumer (first stage of the pipeline). When the
+    consumer stops (close() of this generator, or an exception), the
+    thread stops too, and the items not consumed are dropped. """
+    todo = queue.Queue(maxsize)
+    stop = threading.Event()
+    def put(item):
+        while not stop.is_set():
+            try:
+                todo.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def producer():
+        try:
+            for x in iterable:
+                if not put((True, x)):
+                    return
+            put((False, None))
+        except Exception as err:
+            put((False, err))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, x = todo.get()
+            if not ok:
+                if x is not None:
+                    raise x
+                return
+            yield x
+    finally:
+        stop.set()
+        while True:
+            try:
+                todo.get_nowait()
+            except queue.Empty:
+                break
+        thread.join()
+
+
+def make_pool(omr, workers):
+    """ the pool of workers of the template omr (None: see run_worker),
+    to be made before starting any thread """
+    global DECODE_POOL
+    if DECODE_POOL is not None and DECODE_POOL[0] == os.getpid():
+        # idle threads, left by the pages processed here
+        DECODE_POOL[1].shutdown(wait=True)
+        DECODE_POOL = None
+    if VERBOSE:
+        STDERR.write("Starting a pool of %i workers...\n" % workers)
+    return multiprocessing.Pool(workers, initializer=init_worker, initargs=(omr,))
+
+
+def run_pages(omr, todo, workers=1, pool=None):
+    """ yield (pageid, (line, afterimg)) for each (pageid, job) in todo,
+    in the same order (second stage of the pipeline). The pages are
+    processed by the pool of `workers` processes, if given (made by
+    make_pool(omr, ...), and left running), otherwise here. """
+    if pool is None:
+        for pageid, job in todo:
+            if VVERBOSE:
+                STDERR.write("omr.RunPage(%s)\n" % job[0])
+            yield pageid, omr.RunPage(*job)
+        return
+    # a window of pages in the workers: the page order is kept, and
+    # only a bounded number of images is alive at any time
+    pending = collections.deque()
+    for pageid, job in todo:
+        pending.append((pageid, pool.apply_async(run_worker, (worker_job(omr, job),))))
+        if len(pending) >= PIPELINE_QUEUE * workers:
+            pageid, result = pending.popleft()
+            yield pageid, result.get()
+    while pending:
+        pageid, result = pending.popleft()
+        yield pageid, result.get()
+
+
+class ReportMerger(threading.Thread):
+    """ last stage of the pipeline: the annotated pages are appended to
+    the report while the next pages are processed """
+    def __init__(self, omr, maxsize, outputfile):
+        threading.Thread.__init__(self, daemon=True)
+        self.omr = omr
+        self.todo = queue.Queue(maxsize)
+        self.error = None
+        self.stopped = False
+        self.outputfile = outputfile
+        self.output = omr.NewReport(outputfile)
+        self.start()
+
+    def run(self):
+        while True:
+            f = self.todo.get()
+            if f is None:
+                return
+            if self.error is None and not self.stopped:
+                try:
+                    self.omr.AddReportPage(self.output, f)
+                except Exception as err:
+                    self.error = err
+
+    def add(self, f):
+        self.todo.put(f)
+
+    def finish(self):
+        self.todo.put(None)
+        self.join()
+        if self.error is not None:
+            self.output.abort()
+            raise self.error
+        self.omr.WriteReport(self.output, self.outputfile)
+
+    def abort(self):
+        """ stop (the pages still queued are dropped) and remove the report """
+        self.stopped = True
+        self.todo.put(None)
+        self.join()
+        self.output.abort()
+
+#-----------------------------------------------------------------
+
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+JOURNAL_VERSION = 2
+
+
+def journal_file(xml):
+    """ <main>_answers.journal, for the template <main>.xml """
+    return os.path.splitext(os.path.abspath(xml))[0] + "_answers.journal"
+
+
+def journal_settings(xml, outputtype):
+    """ everything that changes the result of a page: the pages of a
+    journal written with other settings are not reused """
+    base = os.path.splitext(xml)[0]
+    return {
+        'omarscan': file_hash(SELF_FILE),
+        'xml': file_hash(xml),
+        'pdf': file_hash(base + ".pdf") if os.path.exists(base + ".pdf") else None,
+        'outputtype': outputtype,
+        'raster': ["pdfium" if pdfium is not None else "gs", RASTER_DPI, GHOSTSCRIPT_EXTRACT_COMMAND_ARGS],
+        'contrast': [MOGRIFY, NATIVE_CONTRAST, ENHANCE_CONTRAST_COMMAND, ENHANCE_CONTRAST_ARGS,
+                     SIGMOIDAL_CONTRAST, SIGMOIDAL_MIDPOINT],
+        'blobs': [BLUR_RADIUS, MINRADIUS_RATIO, MAXRADIUS_RATIO, MINAREA_RATIO, MAXAREA_RATIO,
+                  FILLED_THRES, FILLED_THRES_CONTOUR, ISOPERIMETRIC_CONSTANT],
+        'align': [ALIGN_SCALE, ALIGN_MARGIN],
+        'dmtx': [DMTX_TIMEOUT, DMTX_SHRINK, DMTX_RETRY_TIMEOUT],
+        'report': [REPORT_JPEG_QUALITY, REPORT_ANOMALIES_ONLY],
+    }
+
+
+class PageJournal:
+    """ the result line and the annotated image of each page, saved as
+    soon as the page is done, keyed by the hash of its file and the page
+    number: <main>_answers.journal (json lines; the first one has the
+    journal_settings) and <main>_answers_pages/ """
+    def __init__(self, filename, settings, pdfs):
+        self.filename = os.path.abspath(filename)
+        self.pagesdir = os.path.splitext(self.filename)[0] + "_pages"
+        self.keys = [file_hash(f) for f in pdfs]
+        header = ["omarscan-journal", JOURNAL_VERSION, settings]
+        self.done = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, encoding='utf-8') as fd:
+                entries = fd.read().splitlines()
+            if entries and self.parse(entries[0]) == header:
+                for entry in entries[1:]:
+                    x = self.parse_page(entry)
+                    if x is not None: # the last one can be truncated
+                        key, page, line, afterimg = x
+                        self.done[(key, page)] = (line, afterimg)
+        if not self.done:
+            self.remove()
+            os.makedirs(self.pagesdir)
+        # rewritten with the valid entries only: the next one is not
+        # appended to a truncated line
+        with open(self.filename + ".tmp", "w", encoding='utf-8') as fd:
+            fd.write(json.dumps(header) + "\n")
+            for (key, page), (line, afterimg) in self.done.items():
+                fd.write(json.dumps([key, page, line, afterimg]) + "\n")
+        os.replace(self.filename + ".tmp", self.filename)
+        self.fd = open(self.filename, "a", encoding='utf-8')
+        if self.done and VERBOSE:
+            STDERR.write("Found %i pages already done in %s...\n" % (len(self.done), self.filename))
+
+    def parse(self, entry):
+        try:
+            return json.loads(entry)
+        except ValueError:
+            return None
+
+    def parse_page(self, entry):
+        """ [key, page, line, afterimg] of a page entry, or None """
+        x = self.parse(entry)
+        if isinstance(x, list) and len(x) == 4 and isinstance(x[0], str) and \
+                isinstance(x[1], int) and isinstance(x[2], str) and \
+                (x[3] is None or isinstance(x[3], str)):
+            return x
+        return None
+
+    def get(self, pageid):
+        """ (line, afterimg) of the page (file index, page), or None """
+        i, page = pageid
+        x = self.done.get((self.keys[i], page))
+        if x is None:
+            return None
+        line, afterimg = x
+        if afterimg is not None:
+            afterimg = os.path.join(self.pagesdir, afterimg)
+        return line, afterimg
+
+    def add(self, pageid, line, afterimg, tempdir):
+        """ save the page; return the new path of afterimg """
+        i, page = pageid
+        key = self.keys[i]
+        if afterimg is not None:
+            # out of the tempdir, which is removed at the end
+            name = "%s-%s" % (key[:12], afterimg)
+            shutil.move(os.path.join(tempdir, afterimg), os.path.join(self.pagesdir, name))
+            afterimg = name
+        self.done[(key, page)] = (line, afterimg)
+        self.fd.write(json.dumps([key, page, line, afterimg]) + "\n")
+        self.fd.flush()
+        return self.get(pageid)[1]
+
+    def close(self):
+        self.fd.close()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        if os.path.isdir(self.pagesdir):
+            shutil.rmtree(self.pagesdir)
+
+
+def get_pages_per_file(pdfs):
+    result = []
     for f in pdfs:
         if os.path.splitext(f)[1].lower() == '.pdf':
             fd = open(f, 'rb')
-            result += len( pyPdf.PdfReader(fd).pages ) 
+            result.append(len( pyPdf.PdfReader(fd).pages ))
             fd.close()
         else:
-            result += 1
+            result.append(1)
     return result
 
 
+def get_number_of_pages(pdfs):
+    return sum(get_pages_per_file(pdfs))
+
+
 #-----------------------------------------------------------------
 
-def main(xml, pdfs, pdfoutput="/tmp/omr-output.pdf", statusfile=STDERR, outputtype="TXT"):
+def make_progress(statusfile, number_of_pages, done=0):
+    """ return a function to be called when a page is done, writing the ETA """
+    start_time = time.time()
+    state = {'numi': done, 'ETA': 0}
+    def progress():
+        state['numi'] += 1
+        # pages are counted when done, so it is the aggregate throughput
+        state['ETA'] = (time.time()-start_time) * \
+            (number_of_pages - state['numi']) * 1.0 / (state['numi'] - done)
+        statusfile.write("ETA:%i sec [%i/%i]\n" % (int(state['ETA']), state['numi'], number_of_pages))
+        statusfile.flush()
+        return int(state['ETA'])
+    return progress
+
+
+def run_chunk(omr, pdfs, pages, start, stop, workers, statusfile, progress, journal, report, pool=None):
+    """ process the pages [start, stop) of the batch, skipping those in the
+    journal: return the answers lines of all of them, in order """
+    pageids = [(i, p) for i in range(len(pdfs)) for p in range(1, pages[i]+1)][start:stop]
+    skip = set(x for x in pageids if journal.get(x) is not None)
+    # pipeline: rasterizing the next pages, detecting the marks and adding
+    # the annotated pages to the report run at the same time, with bounded
+    # queues in between.
+    maxqueue = PIPELINE_QUEUE * max(workers, 1)
+    todo = prefetch(iter_jobs(omr, pdfs, statusfile, stop-start-len(skip), pages, start, stop, skip), maxqueue)
+    results = run_pages(omr, todo, workers=workers, pool=pool)
+    lines = []
+    try:
+        for pageid in pageids:
+            if pageid in skip:
+                line, afterimg = journal.get(pageid)
+            else:
+                doneid, (line, afterimg) = next(results)
+                if doneid != pageid:
+                    raise Exception("Wait: this should not happen... (page %s != %s)" % (doneid, pageid))
+                afterimg = journal.add(pageid, line, afterimg, omr.tempdir)
+                progress()
+            lines.append(line)
+            if afterimg is not None:
+                omr.afterimgs.append(afterimg)
+                report.add(afterimg)
+    finally:
+        # (also on errors: the prefetch thread is stopped)
+        results.close()
+        todo.close()
+    return lines
+
+
+def main(xml, pdfs, pdfoutput="/tmp/omr-output.pdf", statusfile=STDERR, outputtype="TXT", workers=None,
+         omr=None, pool=None, journal=None):
+    """ the OMR of the pages of pdfs (pdf or image files), with the template
+    xml (and the exam pdf with the same name); omr and pool, if given, are
+    an OMR(xml) and its make_pool, already running. The journal file is
+    journal_file(xml), if not given. """
     STDERR.write(" ¯\_(ツ)_/¯ OMaRscan starting w/ python version: {}\n".format(sys.version))
     print_versions()
-    number_of_pages = get_number_of_pages(pdfs)
+    pages = get_pages_per_file(pdfs)
+    number_of_pages = sum(pages)
     statusfile.write("ETA:?? sec (%i pages)\n" % number_of_pages)
     statusfile.flush()
-    if number_of_pages > MAX_PAGES:
-        statusfile.write("FAIL: Panic! Aborting! Too many images=%i > %i!!!\n" % (
-            number_of_pages, MAX_PAGES))
-        statusfile.flush()
-        raise Exception("Too many images! (%i>%i)" %
-                        (number_of_pages, MAX_PAGES))
     if VERBOSE:
         STDERR.write(
             "Beginning with xml-file %s and %i images...\ninitializing (extracting images)...\n" % (xml, len(pdfs)))
-    omr = OMR(xml)
-    todo = []
-    for f in pdfs:
-        if os.path.splitext(f)[1].lower() == '.pdf':
-            images = omr.ExtractPNG(f)
-            todo += images
-        else:
-            todo.append(f)
-        statusfile.write("ETA:?? sec (extracted %i/%i)\n" %
-                         (len(todo), number_of_pages))
-        statusfile.flush()
-    res = ""
-    statusfile.write("ETA:?? sec (extraction finished)\n")
-    statusfile.flush()
+    xml = os.path.abspath(xml)
+    pdfs = [os.path.abspath(f) for f in pdfs]
+    journal = PageJournal(journal or journal_file(xml), journal_settings(xml, outputtype), pdfs)
+    if omr is None:
+        omr = OMR(xml)
+    omr.afterimgs = []
+    done = len([p for i in range(len(pdfs)) for p in range(1, pages[i]+1)
+                if journal.get((i, p)) is not None])
+    if workers is None:
+        workers = OMR_WORKERS
+    workers = min(workers, number_of_pages - done)
     if VERBOSE:
-        STDERR.write("Processing %i images ...\n" % len(todo))
-    start_time = time.time()
-    numi = 0
-    for f in todo:
-        if VVERBOSE:
-            STDERR.write("omr.Run(%s)\n" % f)
-        res += "%s\n" % omr.Run(f)
-        numi += 1
-        ETA = (time.time()-start_time) * \
-            (len(todo)*1.0/numi - 1) # + 1+len(todo)/2
-        statusfile.write("ETA:%i sec [%i/%i]\n" % (int(ETA), numi, len(todo)))
-        statusfile.flush()
+        STDERR.write("Processing %i images with %i workers...\n" % (number_of_pages - done, workers))
+    # one pool for all the chunks (if it is not given), forked before the
+    # threads of the pipeline
+    own_pool = None
+    if pool is None and workers > 1:
+        pool = own_pool = make_pool(omr, workers)
+    report = None
+    try:
+        report = ReportMerger(omr, PIPELINE_QUEUE * max(workers, 1), pdfoutput)
+        progress = make_progress(statusfile, number_of_pages, done)
+        lines = []
+        for start in range(0, number_of_pages, CHUNK_PAGES):
+            stop = min(start + CHUNK_PAGES, number_of_pages)
+            if VERBOSE and number_of_pages > CHUNK_PAGES:
+                STDERR.write("Processing pages %i-%i...\n" % (start+1, stop))
+            lines += run_chunk(omr, pdfs, pages, start, stop, workers,
+                               statusfile, progress, journal, report, pool)
+            # the rasterized pages of the chunk are not needed any more
+            for x in glob.glob(os.path.join(omr.tempdir, TMPTODOBASE + "*.png")):
+                os.remove(x)
+    except BaseException:
+        if report is not None:
+            report.abort()
+        if own_pool is not None:
+            # the pages in the workers are not needed (and a worker may be dead)
+            own_pool.terminate()
+            own_pool.join()
+        journal.close()
+        raise
+    if own_pool is not None:
+        own_pool.close()
+        own_pool.join()
     if VERBOSE:
         STDERR.write("Fin!\n\n")
-    statusfile.write("(now writing OMR report):%i sec \n" % int(ETA))
+    statusfile.write("(now writing OMR report):0 sec \n")
     statusfile.flush()
-    omr.GetReport(pdfoutput)
-    return res
+    try:
+        report.finish()
+    finally:
+        journal.close() # kept, if the report failed
+    journal.remove()
+    return "".join("%s\n" % line for line in lines)
+
+
+#-----------------------------------------------------------------
+# local OMR service: the same add_to_queue/check_status/get_result protocol
+# of OMARSERVICE (see mcq.py), on localhost. The jobs are processed one at
+# a time, by a thread; the last templates (OMR objects) are kept, and one
+# pool of workers, started with the service.
+
+class JobStatus:
+    """ the statusfile of a job: the lines written by main """
+    def __init__(self, cond):
+        self.cond = cond
+        self.lines = ["waiting in the queue...\n"]
+        self.done = False
+        self.result = None
+        self.partial = ""
+
+    def write(self, t):
+        with self.cond:
+            self.partial += t
+            while "\n" in self.partial:
+                line, self.partial = self.partial.split("\n", 1)
+                self.lines.append(line + "\n")
+            self.cond.notify_all()
+
+    def flush(self):
+        pass
+
+    def finish(self, result=None, error=None):
+        with self.cond:
+            if error is not None:
+                self.lines.append("FAIL: %s\n" % error)
+            self.result = result
+            self.done = True
+            self.cond.notify_all()
+
+
+class OMRService:
+    def __init__(self, workers=None, pool=None):
+        """ pool: make_pool(None, workers), if workers > 1 """
+        self.workers = workers or OMR_WORKERS
+        self.pool = pool
+        self.cwdir = os.getcwd()
+        # uploads (in parts) and results are kept on disk
+        self.spooldir = tempfile.mkdtemp('_omrservice')
+        self.cond = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.templates = collections.OrderedDict()
+        self.todo = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def check_outputtype(self, outputtype):
+        """ only the TXT output can be produced here (see main) """
+        if outputtype != 'TXT':
+            raise xmlrpc.client.Fault(1, "output type %r is not supported by the local OMR service: only 'TXT'" % (outputtype,))
+
+    def add_to_queue(self, data, digest):
+        if isinstance(digest, list):
+            # [digest, outputtype]
+            self.check_outputtype(digest[1] if len(digest) > 1 else 'TXT')
+            digest = digest[0]
+        data = data.data
+        if not hmac.compare_digest(hmac.new(SERVICE_PASSWORD, data, digestmod=hashlib.sha256).hexdigest(), digest):
+            return "FAIL: wrong digest"
+        return self.new_job(hashlib.sha256(data).hexdigest(), io.BytesIO(data))
+
+    def new_job(self, key, zipdata):
+        job_id = "%s-%s" % (datetime.datetime.now().strftime("%Y%m%d%H%M%S"), key[:16])
+        with self.cond:
+            self.jobs[job_id] = JobStatus(self.cond)
+            while len(self.jobs) > SERVICE_JOBS:
+                old_id = next(iter(self.jobs))
+                if not self.jobs[old_id].done:
+                    break
+                old_job = self.jobs.pop(old_id)
+                if old_job.result is not None and os.path.exists(old_job.result[1]):
+                    os.remove(old_job.result[1])
+        self.todo.put((job_id, zipdata))
+        return job_id
+
+    def upload_dir(self, upload_id):
+        if not all(c in "0123456789abcdef" for c in upload_id) or len(upload_id) != 64:
+            raise Exception("wrong upload id")
+        return os.path.join(self.spooldir, "upload-" + upload_id)
+
+    def upload_status(self, upload_id):
+        """ the parts of the upload (its id is the sha256 of the zip)
+        already received: the others are missing, and can be resumed """
+        d = self.upload_dir(upload_id)
+        if not os.path.isdir(d):
+            return []
+        return sorted(int(x[5:]) for x in os.listdir(d) if x.startswith("part-") and x[5:].isdigit())
+
+    def upload_part(self, upload_id, index, data):
+        d = self.upload_dir(upload_id)
+        if len(data.data) > SERVICE_MAX_PART:
+            return "FAIL: part too large"
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        f = os.path.join(d, "part-%06i" % index)
+        with open(f + ".tmp", "wb") as fd:
+            fd.write(data.data)
+        os.replace(f + ".tmp", f)
+        return True
+
+    def upload_commit(self, upload_id, number_of_parts, digest, outputtype='TXT'):
+        """ join the parts, checking the sha256 and the hmac of the whole
+        zip, and queue the job """
+        self.check_outputtype(outputtype)
+        d = self.upload_dir(upload_id)
+        if self.upload_status(upload_id) != list(range(number_of_parts)):
+            return "FAIL: missing parts"
+        zipname = d + ".zip"
+        h = hashlib.sha256()
+        hm = hmac.new(SERVICE_PASSWORD, digestmod=hashlib.sha256)
+        with open(zipname, "wb") as out:
+            for i in range(number_of_parts):
+                with open(os.path.join(d, "part-%06i" % i), "rb") as fd:
+                    for chunk in iter(lambda: fd.read(1 << 20), b''):
+                        h.update(chunk)
+                        hm.update(chunk)
+                        out.write(chunk)
+        shutil.rmtree(d)
+        if h.hexdigest() != upload_id or not hmac.compare_digest(hm.hexdigest(), digest):
+            os.remove(zipname)
+            return "FAIL: wrong digest"
+        return self.new_job(upload_id, zipname)
+
+    def check_status(self, job_id):
+        if job_id not in self.jobs:
+            return "FAIL: unknown job %s" % job_id
+        job = self.jobs[job_id]
+        with self.cond:
+            if job.done and job.result is not None:
+                return "DONE"
+            return job.lines[-1]
+
+    def wait_status(self, job_id, since=0, timeout=30.0):
+        """ the status lines of the job after the first since, as soon as
+        there are some (or after timeout): (lines, since, done) """
+        job = self.jobs[job_id]
+        with self.cond:
+            self.cond.wait_for(lambda: job.done or len(job.lines) > since, timeout)
+            return job.lines[since:], len(job.lines), job.done
+
+    def get_result(self, job_id):
+        txt, pdf = self.jobs[job_id].result
+        with open(pdf, "rb") as fd:
+            return txt, xmlrpc.client.Binary(fd.read())
+
+    def get_result_info(self, job_id):
+        """ the answers and the size of the annotated pdf """
+        txt, pdf = self.jobs[job_id].result
+        return txt, os.path.getsize(pdf)
+
+    def get_result_part(self, job_id, offset, size):
+        txt, pdf = self.jobs[job_id].result
+        with open(pdf, "rb") as fd:
+            fd.seek(offset)
+            return xmlrpc.client.Binary(fd.read(min(size, SERVICE_MAX_PART)))
+
+    def get_template(self, xml):
+        key = file_hash(xml) + file_hash(os.path.splitext(xml)[0] + ".pdf")
+        if key in self.templates:
+            self.templates.move_to_end(key)
+            omr = self.templates[key]
+            os.chdir(omr.tempdir)
+            return omr, self.pool
+        while len(self.templates) >= SERVICE_TEMPLATES:
+            # (first: OMR.__del__ changes the directory)
+            old_key, old_omr = self.templates.popitem(last=False)
+            if getattr(old_omr, 'templatefile', None) and os.path.exists(old_omr.templatefile):
+                os.remove(old_omr.templatefile)
+            del old_omr
+        omr = OMR(xml)
+        omr.cwdir = self.cwdir # the job directory is removed
+        if self.pool is not None:
+            save_worker_template(omr, os.path.join(self.spooldir, "template-%s.pickle" % key))
+        self.templates[key] = omr
+        return omr, self.pool
+
+    def run(self):
+        while True:
+            job_id, zipdata = self.todo.get()
+            job = self.jobs[job_id]
+            jobdir = tempfile.mkdtemp('_omrjob')
+            try:
+                # xml, exam pdf, scans: in this order, as sent by mcq.py
+                zf = zipfile.ZipFile(zipdata)
+                names = zf.namelist()
+                files = []
+                for i, name in enumerate(names):
+                    base = os.path.basename(name)
+                    f = os.path.join(jobdir, base if i < 2 else "scan-%03d-%s" % (i, base))
+                    with zf.open(name) as src, open(f, "wb") as fd:
+                        shutil.copyfileobj(src, fd)
+                    files.append(f)
+                zf.close()
+                xml = files[0]
+                if len(files) < 3 or os.path.splitext(xml)[1] != '.xml':
+                    raise Exception("wrong job: %s" % names)
+                omr, pool = self.get_template(xml)
+                pdfoutput = os.path.join(self.spooldir, "%s.pdf" % job_id)
+                txt = main(xml, files[2:], pdfoutput=pdfoutput, statusfile=job,
+                           workers=self.workers, omr=omr, pool=pool,
+                           journal=os.path.join(self.spooldir, "%s.journal" % job_id))
+                job.finish((txt, pdfoutput))
+            except Exception as err:
+                STDERR.write("job %s failed: %s\n" % (job_id, err))
+                job.finish(error=err)
+            finally:
+                os.chdir(self.cwdir)
+                shutil.rmtree(jobdir, ignore_errors=True)
+                if isinstance(zipdata, str):
+                    os.remove(zipdata)
+
+
+class ServiceRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
+    rpc_paths = () # any path, as in OMARSERVICE urls
+    protocol_version = "HTTP/1.1" # the clients keep the connection open
+
+    def do_GET(self):
+        """ /progress/<job_id>: the status lines of the job, streamed """
+        path = self.path.strip("/").split("/")
+        if len(path) != 2 or path[0] != "progress" or path[1] not in self.server.service.jobs:
+            self.close_connection = True
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Connection", "close") # the end of the stream
+        self.end_headers()
+        self.close_connection = True
+        since, done = 0, False
+        while not done:
+            lines, since, done = self.server.service.wait_status(path[1], since)
+            self.wfile.write("".join(lines).encode('utf-8'))
+            self.wfile.flush()
+
+
+class ServiceServer(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+def service_server(service, port):
+    """ the XML-RPC server of service, on localhost:port (0: any free port) """
+    server = ServiceServer(("127.0.0.1", port), requestHandler=ServiceRequestHandler,
+                           logRequests=VVERBOSE, allow_none=True)
+    server.service = service
+    for name in ("add_to_queue", "check_status", "get_result", "wait_status",
+                 "upload_status", "upload_part", "upload_commit", "get_result_info", "get_result_part"):
+        server.register_function(getattr(service, name), name)
+    return server
+
+
+def serve(port, workers=None):
+    workers = workers or OMR_WORKERS
+    # the pool first, before the threads of the service
+    pool = make_pool(None, workers) if workers > 1 else None
+    service = OMRService(workers, pool)
+    server = service_server(service, port)
+    STDERR.write("OMaRScan service on http://localhost:%i/ ...\n" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(service.spooldir, ignore_errors=True)
 
 
 #-----------------------------------------------------------------
 if __name__ == '__main__':
     xml, pdfs = get_opt()
-    print(main(xml, pdfs))
+    if SERVE_PORT is not None:
+        serve(SERVE_PORT)
+    else:
+        print(main(xml, pdfs))
 
 
@@ -0,0 +1,242 @@
+"""
+the answer keys file of `exam` (ExamKeysWriter, ExamKeys, and the pickled
+dict of the older versions) and the marking engines of `mark`: the
+numpy tables and the incremental marking must give the same marks and
+stats as correggi_righe.
+"""
+import copy
+import hashlib
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs'))
+
+import mcq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PUNTI = (1.0, -0.25, 0.0)
+NUMQ = 4
+# answers of each question of the exam file: the first one is right,
+# and the last one of question 3 has its own points
+RISPOSTE = [3, 2, 4, 3]
+PUNTI_SPECIALI = {3: 0.5}
+
+
+def exam_keys(numero_copie=6, seed=1):
+    """ the answer keys of `numero_copie` copies, as generate_copies:
+    (meta, [(codice, perm_esercizi, ese_perm, dbsols)]) """
+    rg = random.Random(seed)
+    meta = {'__punti__': PUNTI, '__formula__': '', '__variantlabel__': False,
+            '__stats__': [dict([('0', 0)] + [(mcq.lettere[x], 0) for x in range(RISPOSTE[i])])
+                          for i in range(NUMQ)]}
+    meta['__stats_punti__'] = copy.deepcopy(meta['__stats__'])
+    copie = []
+    for n in range(numero_copie):
+        perm = list(range(NUMQ))
+        rg.shuffle(perm)
+        ese_perm, dbsols = [], []
+        for i in range(NUMQ):
+            eseperm = list(range(RISPOSTE[perm[i]]))
+            rg.shuffle(eseperm)
+            sol = {mcq.lettere[eseperm.index(0)]: 'giusta'}
+            if perm[i] in PUNTI_SPECIALI:
+                sol[mcq.lettere[eseperm.index(RISPOSTE[perm[i]] - 1)]] = PUNTI_SPECIALI[perm[i]]
+            ese_perm += [eseperm]
+            dbsols += [sol]
+        copie += [("C%02i" % (n * 5 % numero_copie), perm, ese_perm, dbsols)]
+    return meta, copie
+
+
+def write_exam_keys(filename, meta, copie):
+    with open(filename, 'wb') as fd:
+        keys = mcq.ExamKeysWriter(fd, NUMQ, max(RISPOSTE))
+        for codice, perm, ese_perm, dbsols in copie:
+            keys.add(codice, perm, ese_perm, dbsols)
+        keys.finish(copy.deepcopy(meta))
+
+
+def old_exam_keys(meta, copie):
+    """ the pickled dict of the older versions of `exam` """
+    dbl = copy.deepcopy(meta)
+    dbl['__permutations__'] = {}
+    for codice, perm, ese_perm, dbsols in copie:
+        dbl[codice] = dbsols
+        dbl['__permutations__'][codice] = {'perm_esercizi': perm, 'ese_perm': ese_perm}
+    return dbl
+
+
+def answers_lines(copie, seed=2, righe=12):
+    """ answers of the copies: valid ones, blank ones and a comment """
+    rg = random.Random(seed)
+    result = ["# a comment"]
+    for r in range(righe):
+        codice, perm, ese_perm, dbsols = copie[r % len(copie)]
+        risposte = "".join(rg.choice('0' + mcq.lettere[:len(ese_perm[i])]) for i in range(NUMQ))
+        result += ["%s:NAME %i:%06i:%s:%i" % (codice, r, r, risposte, r % 3)]
+    return result
+
+
+class KeysTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.meta, self.copie = exam_keys()
+        self.filename = os.path.join(self.tmpdir, 'test_exam.db')
+        write_exam_keys(self.filename, self.meta, self.copie)
+        self.fds = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            fd.close()
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, filename=None):
+        fd = open(filename or self.filename, 'rb')
+        self.fds += [fd]
+        return mcq.load_exam_keys(fd)
+
+
+class TestExamKeys(KeysTestCase):
+
+    def test_round_trip(self):
+        dbl = self.load()
+        self.assertIsInstance(dbl, mcq.ExamKeys)
+        self.assertEqual(sorted(dbl['__permutations__']), sorted(x[0] for x in self.copie))
+        for codice, perm, ese_perm, dbsols in self.copie:
+            self.assertIn(codice, dbl)
+            self.assertEqual(dbl[codice], dbsols)
+            self.assertEqual(dbl['__permutations__'][codice],
+                             {'perm_esercizi': perm, 'ese_perm': ese_perm})
+        for k in self.meta:
+            self.assertEqual(dbl[k], self.meta[k])
+        self.assertEqual(mcq.number_of_items(dbl), NUMQ)
+        self.assertNotIn('C99', dbl)
+        self.assertNotIn('C99', dbl['__permutations__'])
+        with self.assertRaises(KeyError):
+            dbl['C99']
+        # as the stats DB: the `__...__` items only
+        stats = pickle.loads(pickle.dumps(dbl))
+        self.assertEqual(stats['__punti__'], PUNTI)
+        self.assertNotIn(self.copie[0][0], stats)
+
+    def test_chiave(self):
+        chiave = self.load()['__chiave__']
+        other = os.path.join(self.tmpdir, 'other_exam.db')
+        write_exam_keys(other, self.meta, self.copie)
+        self.assertEqual(self.load(other)['__chiave__'], chiave)
+        write_exam_keys(other, self.meta, exam_keys(seed=3)[1])
+        self.assertNotEqual(self.load(other)['__chiave__'], chiave)
+
+    def test_old_pickle(self):
+        old = os.path.join(self.tmpdir, 'old_exam.db')
+        data = pickle.dumps(old_exam_keys(self.meta, self.copie))
+        with open(old, 'wb') as fd:
+            fd.write(data)
+        dbl = self.load(old)
+        self.assertIsInstance(dbl, dict)
+        self.assertEqual(dbl['__chiave__'], hashlib.sha1(data).hexdigest())
+        keys = self.load()
+        for codice, perm, ese_perm, dbsols in self.copie:
+            self.assertEqual(dbl[codice], keys[codice])
+            self.assertEqual(dbl['__permutations__'][codice], keys['__permutations__'][codice])
+
+
+class TestMarking(KeysTestCase):
+
+    def setUp(self):
+        KeysTestCase.setUp(self)
+        self.data = "\n".join(answers_lines(self.copie)) + "\n"
+
+    def correggi_righe(self, data):
+        dbl = old_exam_keys(self.meta, self.copie)
+        return mcq.correggi_righe(dbl, data), dbl
+
+    def assertSameMarks(self, got, expected):
+        (result, dbl), (result_righe, dbl_righe) = got, expected
+        self.assertEqual(result, result_righe)
+        self.assertEqual(dbl['__stats__'], dbl_righe['__stats__'])
+        self.assertEqual(dbl['__stats_lista__'], dbl_righe['__stats_lista__'])
+        self.assertEqual(dbl['__indici__'], dbl_righe['__indici__'])
+
+    @unittest.skipUnless(numpy is not None, "numpy is not installed")
+    def test_correggi_array(self):
+        for dbl in (self.load(), old_exam_keys(self.meta, self.copie)):
+            with self.subTest(keys=type(dbl).__name__):
+                result = mcq.correggi_array(dbl, self.data, numpy)
+                self.assertSameMarks((result, dbl), self.correggi_righe(self.data))
+
+    @unittest.skipUnless(numpy is not None, "numpy is not installed")
+    def test_segna_righe(self):
+        dbl = self.load()
+        righe = list(mcq.leggi_risposte(dbl, self.data))
+        self.assertEqual(mcq.segna_righe(dbl, righe, numpy), mcq.segna_righe(dbl, righe, None))
+        self.assertEqual(mcq.segna_righe(dbl, [], numpy), [])
+
+    def test_correggi_incrementale(self):
+        cache = {}
+        dbl = self.load()
+        chiave = dbl['__chiave__']
+        result = mcq.correggi_incrementale(dbl, self.data, cache, chiave)
+        self.assertSameMarks((result, dbl), self.correggi_righe(self.data))
+        # a line changed, one removed, one added twice
+        lines = self.data.splitlines()
+        codice, name, matr, risposte, voto = lines[1].split(":")
+        lines[1] = ":".join([codice, name, matr, risposte[::-1], voto])
+        del lines[4]
+        lines += [lines[2].replace("NAME", "OTHER")] * 2
+        data = "\n".join(lines)
+        segnate = []
+        segna_righe = mcq.segna_righe
+
+        def conta_segnate(dbl, righe, numpy):
+            segnate.extend(righe)
+            return segna_righe(dbl, righe, numpy)
+        mcq.segna_righe = conta_segnate
+        try:
+            dbl = self.load()
+            result = mcq.correggi_incrementale(dbl, data, cache, chiave)
+        finally:
+            mcq.segna_righe = segna_righe
+        self.assertSameMarks((result, dbl), self.correggi_righe(data))
+        # the unchanged lines (and the added ones, same code and answers
+        # as an old one) are not marked again
+        if risposte[::-1] != risposte:
+            self.assertEqual([x[6] for x in segnate], [lines[1]])
+        else:
+            self.assertEqual(segnate, [])
+        # other keys: from scratch
+        result = mcq.correggi_incrementale(self.load(), data, cache, 'other')
+        self.assertEqual(cache['chiave'], 'other')
+        self.assertEqual(result, self.correggi_righe(data)[0])
+
+    def test_mark_cache(self):
+        cache = {}
+        mcq.correggi_incrementale(self.load(), self.data, cache, 'chiave')
+        filename = os.path.join(self.tmpdir, 'test_mark.cache')
+        self.assertEqual(mcq.load_mark_cache(filename), {})
+        mcq.save_mark_cache(filename, cache)
+        self.assertEqual(mcq.load_mark_cache(filename), cache)
+        self.assertFalse(os.path.exists(filename + '.tmp'))
+        # a corrupted cache is ignored
+        with open(filename, 'r+b') as fd:
+            fd.seek(-1, os.SEEK_END)
+            last = fd.read(1)
+            fd.seek(-1, os.SEEK_END)
+            fd.write(bytes([last[0] ^ 1]))
+        self.assertEqual(mcq.load_mark_cache(filename), {})
+        with open(filename, 'wb') as fd:
+            fd.write(b'MCQ')
+        self.assertEqual(mcq.load_mark_cache(filename), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+the uploads and downloads in parts of mcq.py (ssclient_upload,
+ssclient_download) against the local OMR service of omarscan.py, on a
+free port of localhost.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs'))
+
+import six.moves.xmlrpc_client
+import mcq
+import omarscan
+
+PART = 1000 # bytes: small parts, to have many of them
+
+
+class RecordingProxy:
+    """ a ServerProxy that remembers the (name, args) of its calls """
+    def __init__(self, url):
+        self.proxy = six.moves.xmlrpc_client.ServerProxy(url, allow_none=True)
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.proxy, name)
+
+        def call(*args):
+            self.calls.append((name, args))
+            return method(*args)
+        return call
+
+
+class TestServiceClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = omarscan.OMRService(1)
+        cls.server = omarscan.service_server(cls.service, 0)
+        cls.url = "http://127.0.0.1:%i/" % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.service.spooldir, ignore_errors=True)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (mcq.OMARSERVICE_PART, mcq.ZIPPASSWORD)
+        mcq.OMARSERVICE_PART = PART
+        mcq.ZIPPASSWORD = omarscan.SERVICE_PASSWORD
+        self.proxy = RecordingProxy(self.url)
+
+    def tearDown(self):
+        mcq.OMARSERVICE_PART, mcq.ZIPPASSWORD = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def zipfile(self, size):
+        """ not a real zip: the jobs fail, after the upload """
+        f = os.path.join(self.tmpdir, 'job.zip')
+        with open(f, 'wb') as fd:
+            fd.write(os.urandom(size))
+        return f
+
+    def parts(self, name):
+        return [args[1] for (n, args) in self.proxy.calls if n == name]
+
+    def wait(self, job_id):
+        since, done = 0, False
+        while not done:
+            lines, since, done = self.service.wait_status(job_id, since)
+
+    def test_upload_in_parts(self):
+        job_id = mcq.ssclient_upload(self.proxy, self.zipfile(5 * PART + 10))
+        self.assertIn(job_id, self.service.jobs)
+        self.assertEqual(self.parts('upload_part'), list(range(6)))
+        self.wait(job_id)
+
+    def test_upload_resumed(self):
+        zipname = self.zipfile(4 * PART)
+        with open(zipname, 'rb') as fd:
+            data = fd.read()
+        upload_id = omarscan.hashlib.sha256(data).hexdigest()
+        # an interrupted upload: parts 0 and 2 only
+        for i in (0, 2):
+            self.proxy.upload_part(upload_id, i, six.moves.xmlrpc_client.Binary(data[i*PART:(i+1)*PART]))
+        self.assertEqual(self.proxy.upload_status(upload_id), [0, 2])
+        self.proxy.calls = []
+        job_id = mcq.ssclient_upload(self.proxy, zipname)
+        self.assertIn(job_id, self.service.jobs)
+        self.assertEqual(self.parts('upload_part'), [1, 3])
+        self.wait(job_id)
+
+    def test_commit_mismatch(self):
+        zipname = self.zipfile(3 * PART)
+        mcq.ZIPPASSWORD = b'WRONG'
+        self.assertEqual(mcq.ssclient_upload(self.proxy, zipname), "FAIL: wrong digest")
+        # the parts are gone: a new upload starts from scratch
+        with open(zipname, 'rb') as fd:
+            data = fd.read()
+        upload_id = omarscan.hashlib.sha256(data).hexdigest()
+        self.assertEqual(self.proxy.upload_status(upload_id), [])
+        # a part too few
+        for i in range(2):
+            self.proxy.upload_part(upload_id, i, six.moves.xmlrpc_client.Binary(data[i*PART:(i+1)*PART]))
+        self.assertEqual(self.proxy.upload_commit(upload_id, 3, "", 'TXT'), "FAIL: missing parts")
+        # the parts of another zip
+        self.proxy.upload_part(upload_id, 2, six.moves.xmlrpc_client.Binary(data[:PART]))
+        mcq.ZIPPASSWORD = omarscan.SERVICE_PASSWORD
+        self.assertEqual(self.proxy.upload_commit(upload_id, 3, "", 'TXT'), "FAIL: wrong digest")
+
+    def test_download_in_parts(self):
+        pdf = os.path.join(self.service.spooldir, 'test-download.pdf')
+        data = os.urandom(3 * PART + 1)
+        with open(pdf, 'wb') as fd:
+            fd.write(data)
+        job = omarscan.JobStatus(self.service.cond)
+        job.finish(("answers\n", pdf))
+        self.service.jobs['test-download'] = job
+        outputfile = os.path.join(self.tmpdir, 'report.pdf')
+        self.assertEqual(mcq.ssclient_download(self.proxy, 'test-download', outputfile), "answers\n")
+        with open(outputfile, 'rb') as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertEqual([args[1] for (n, args) in self.proxy.calls if n == 'get_result_part'],
+                         [0, PART, 2 * PART, 3 * PART])
+
+
+if __name__ == '__main__':
+    unittest.main()
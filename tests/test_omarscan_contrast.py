@@ -0,0 +1,92 @@
+"""
+enhance_contrast (in memory) against saved values, and against the
+mogrify command it replaces: skipped when ImageMagick is not installed.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs'))
+
+import numpy as np
+import omarscan
+from omarscan import cv
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs', 'scan-try2.pdf')
+
+
+# -auto-level -sigmoidal-contrast 9x60% of a small page (levels 20..240)
+SMALL_PAGE = [[20, 40, 60, 80], [100, 120, 140, 160], [180, 200, 220, 240]]
+SMALL_PAGE_CONTRAST = [[0, 1, 5, 12], [27, 55, 99, 152], [198, 230, 247, 255]]
+# the lookup table for the levels 0..255, every 16 levels
+FULL_RANGE_LUT = [0, 1, 2, 5, 10, 17, 30, 49, 76, 110, 147, 181, 209, 229, 242, 250]
+
+
+def mogrify_command():
+    if os.path.exists(omarscan.ENHANCE_CONTRAST_COMMAND):
+        return omarscan.ENHANCE_CONTRAST_COMMAND
+    return shutil.which('mogrify')
+
+
+def sample_pages():
+    """ a synthetic page with every gray level between two limits (so that
+    -auto-level stretches it), and the first page of the sample scan """
+    ramp = np.tile(np.arange(17, 236, dtype=np.uint8), (300, 4))
+    ramp[100:140, 200:400] = 17
+    pages = [('ramp', ramp)]
+    if omarscan.pdfium is not None and os.path.exists(SAMPLE_PDF):
+        pages += [('scan', next(omarscan.render_pdf_pages(SAMPLE_PDF, last_page=1)))]
+    return pages
+
+
+class TestContrastValues(unittest.TestCase):
+
+    def test_lut(self):
+        lut = omarscan.contrast_lut(0, 255)
+        self.assertEqual(lut.dtype, np.uint8)
+        self.assertEqual(lut[::16].tolist(), FULL_RANGE_LUT)
+        self.assertEqual(int(lut[255]), 255)
+        self.assertTrue((np.diff(lut.astype(int)) >= 0).all())
+
+    def test_small_page(self):
+        img = np.array(SMALL_PAGE, dtype=np.uint8)
+        self.assertEqual(omarscan.enhance_contrast(img).tolist(), SMALL_PAGE_CONTRAST)
+
+    def test_flat_page(self):
+        # no range to stretch: no division by zero
+        img = np.full((3, 4), 128, dtype=np.uint8)
+        self.assertEqual(omarscan.enhance_contrast(img).shape, (3, 4))
+
+
+@unittest.skipUnless(mogrify_command(), "ImageMagick (mogrify) is not installed")
+class TestContrastParity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def mogrify(self, name, img):
+        f = os.path.join(self.tmpdir, name + '.png')
+        cv.imwrite(f, img)
+        subprocess.check_call([mogrify_command()] + omarscan.listify(omarscan.ENHANCE_CONTRAST_ARGS) + [f])
+        return cv.imread(f, cv.IMREAD_GRAYSCALE)
+
+    def test_same_as_mogrify(self):
+        for name, img in sample_pages():
+            with self.subTest(page=name):
+                expected = self.mogrify(name, img)
+                got = omarscan.enhance_contrast(img)
+                self.assertEqual(got.shape, expected.shape)
+                # ImageMagick computes in 16 bits: at most one level of rounding
+                diff = np.abs(got.astype(int) - expected.astype(int))
+                self.assertLessEqual(int(diff.max()), 1)
+                self.assertLess(float((diff > 0).mean()), 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
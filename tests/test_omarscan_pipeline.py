@@ -0,0 +1,304 @@
+"""
+the helpers of the OMR pipeline of omarscan.main: the pages of a chunk,
+the prefetching thread, the pool of workers and their templates, the
+journal of the pages done, and the report written page by page.
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs'))
+
+import omarscan
+
+
+class FakeOMR:
+    """ IterPages of the pages of the pdfs (without rasterizing them) """
+    def __init__(self):
+        self.calls = []
+
+    def IterPages(self, f, first, last):
+        self.calls.append((os.path.basename(f), first, last))
+        for p in range(first, last+1):
+            yield ("%s-%i" % (os.path.basename(f), p), None)
+
+
+class TestChunks(unittest.TestCase):
+
+    def test_page_runs(self):
+        self.assertEqual(omarscan.page_runs(1, 5, set()), [[1, 5]])
+        self.assertEqual(omarscan.page_runs(1, 5, {1, 3}), [[2, 2], [4, 5]])
+        self.assertEqual(omarscan.page_runs(2, 7, {5, 6, 7}), [[2, 4]])
+        self.assertEqual(omarscan.page_runs(1, 3, {1, 2, 3}), [])
+        self.assertEqual(omarscan.page_runs(4, 3, set()), [])
+
+    def jobs(self, **kwargs):
+        omr = FakeOMR()
+        status = io.StringIO()
+        jobs = list(omarscan.iter_jobs(omr, ['a.pdf', 'b.pdf', 'c.png'], status,
+                                       pages=[3, 4, 1], **kwargs))
+        self.assertTrue(status.getvalue().endswith("(extraction finished)\n"))
+        return [pageid for pageid, job in jobs], omr.calls
+
+    def test_iter_jobs(self):
+        self.assertEqual(self.jobs(), ([(0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3), (1, 4), (2, 1)],
+                                       [('a.pdf', 1, 3), ('b.pdf', 1, 4)]))
+        # the pages [2, 6) of the batch
+        self.assertEqual(self.jobs(start=2, stop=6), ([(0, 3), (1, 1), (1, 2), (1, 3)],
+                                                      [('a.pdf', 3, 3), ('b.pdf', 1, 3)]))
+        self.assertEqual(self.jobs(start=3, stop=3), ([], []))
+        self.assertEqual(self.jobs(start=7), ([(2, 1)], []))
+        # the pages done are not rasterized
+        self.assertEqual(self.jobs(start=2, stop=8, skip={(1, 2), (2, 1)}),
+                         ([(0, 3), (1, 1), (1, 3), (1, 4)],
+                          [('a.pdf', 3, 3), ('b.pdf', 1, 1), ('b.pdf', 3, 4)]))
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def pages(self, closed, n=None, error=None):
+        """ n pages (forever, if None), then error """
+        try:
+            p = 0
+            while n is None or p < n:
+                p += 1
+                yield p
+            if error is not None:
+                raise error
+        finally:
+            closed.append(True)
+
+    def test_all(self):
+        closed = []
+        self.assertEqual(list(omarscan.prefetch(self.pages(closed, 10), 2)), list(range(1, 11)))
+        self.assertEqual(closed, [True])
+
+    def test_close(self):
+        closed = []
+        threads = threading.active_count()
+        todo = omarscan.prefetch(self.pages(closed), 2)
+        self.assertEqual([next(todo) for i in range(3)], [1, 2, 3])
+        self.assertGreater(threading.active_count(), threads)
+        todo.close()
+        # the producer is stopped (and joined), its pages closed
+        self.assertEqual(closed, [True])
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_error(self):
+        closed = []
+        todo = omarscan.prefetch(self.pages(closed, 3, ValueError("bad page")), 2)
+        self.assertEqual([next(todo) for i in range(3)], [1, 2, 3])
+        with self.assertRaisesRegex(ValueError, "bad page"):
+            next(todo)
+        self.assertEqual(closed, [True])
+
+
+class FakeTemplate:
+    """ a template that can be pickled: RunPage tells where it ran """
+    def __init__(self, tempdir):
+        self.tempdir = tempdir
+
+    def RunPage(self, imagefile, image=None):
+        return ("%s:%s:%i" % (self.tempdir, imagefile, os.getpid()), None)
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        omarscan.WORKER_OMR.clear()
+
+    def tearDown(self):
+        omarscan.WORKER_OMR.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def template(self, name):
+        omr = FakeTemplate(name)
+        omarscan.save_worker_template(omr, os.path.join(self.tmpdir, name + ".pickle"))
+        return omr
+
+    def test_run_worker(self):
+        omrs = [self.template("t%i" % i) for i in range(omarscan.SERVICE_TEMPLATES + 1)]
+        self.assertTrue(os.path.exists(omrs[0].templatefile))
+        line, afterimg = omarscan.run_worker(omarscan.worker_job(omrs[0], ("p1",)))
+        self.assertEqual(line, "t0:p1:%i" % os.getpid())
+        # loaded once: the file is not needed any more
+        os.remove(omrs[0].templatefile)
+        omarscan.run_worker(omarscan.worker_job(omrs[0], ("p2",)))
+        # only the last SERVICE_TEMPLATES are kept
+        for omr in omrs[1:]:
+            omarscan.run_worker(omarscan.worker_job(omr, ("p1",)))
+        self.assertEqual(list(omarscan.WORKER_OMR), [omr.tempdir for omr in omrs[1:]])
+
+    def run_pool(self, omr, pool):
+        todo = [((0, p), ("p%i" % p,)) for p in range(1, 21)]
+        try:
+            results = list(omarscan.run_pages(omr, iter(todo), workers=2, pool=pool))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual([pageid for pageid, x in results], [pageid for pageid, job in todo])
+        for (pageid, job), (doneid, (line, afterimg)) in zip(todo, results):
+            tempdir, page, pid = line.split(":")
+            self.assertEqual((tempdir, page), (omr.tempdir, job[0]))
+            self.assertNotEqual(int(pid), os.getpid())
+
+    def test_pool_of_template(self):
+        omr = FakeTemplate("t0")
+        self.run_pool(omr, omarscan.make_pool(omr, 2))
+
+    def test_pool_of_service(self):
+        # started before the template is known: from its file
+        pool = omarscan.make_pool(None, 2)
+        self.run_pool(self.template("t1"), pool)
+
+    def test_no_pool(self):
+        omr = FakeTemplate("t0")
+        results = list(omarscan.run_pages(omr, iter([((0, 1), ("p1",))])))
+        self.assertEqual(results, [((0, 1), ("t0:p1:%i" % os.getpid(), None))])
+
+
+class TestPageJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pdfs = []
+        for name in ('a.pdf', 'b.pdf'):
+            f = os.path.join(self.tmpdir, name)
+            with open(f, 'w') as fd:
+                fd.write(name)
+            self.pdfs.append(f)
+        self.filename = os.path.join(self.tmpdir, 'exam_answers.journal')
+        self.settings = {'outputtype': 'TXT', 'raster': [150]}
+        self.tempdir = os.path.join(self.tmpdir, 'tmp')
+        os.mkdir(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def journal(self, settings=None):
+        return omarscan.PageJournal(self.filename, settings or self.settings, self.pdfs)
+
+    def add(self, journal, pageid, line):
+        name = "omr_page-%i-%i.jpg" % pageid
+        with open(os.path.join(self.tempdir, name), 'w') as fd:
+            fd.write(line)
+        return journal.add(pageid, line, name, self.tempdir)
+
+    def test_resume(self):
+        journal = self.journal()
+        self.assertIsNone(journal.get((0, 1)))
+        afterimg = self.add(journal, (0, 1), "line 1")
+        self.assertEqual(os.path.dirname(afterimg), journal.pagesdir)
+        journal.add((1, 2), "line 2", None, self.tempdir)
+        journal.close()
+        journal = self.journal()
+        self.assertEqual(journal.get((0, 1)), ("line 1", afterimg))
+        self.assertTrue(os.path.exists(afterimg))
+        self.assertEqual(journal.get((1, 2)), ("line 2", None))
+        self.assertIsNone(journal.get((1, 1)))
+        journal.close()
+
+    def test_stale_header(self):
+        journal = self.journal()
+        afterimg = self.add(journal, (0, 1), "line 1")
+        journal.close()
+        # other settings: the pages are done again
+        journal = self.journal({'outputtype': 'TXT', 'raster': [300]})
+        self.assertIsNone(journal.get((0, 1)))
+        self.assertFalse(os.path.exists(afterimg))
+        journal.close()
+        # another file at the same place
+        with open(self.pdfs[0], 'w') as fd:
+            fd.write('changed')
+        journal = self.journal()
+        self.assertIsNone(journal.get((0, 1)))
+        journal.close()
+
+    def test_truncated_and_wrong_entries(self):
+        journal = self.journal()
+        journal.add((0, 1), "line 1", None, self.tempdir)
+        journal.add((0, 2), "line 2", None, self.tempdir)
+        journal.close()
+        key = journal.keys[0]
+        with open(self.filename, 'a') as fd:
+            fd.write(json.dumps({'not': 'a page'}) + "\n")
+            fd.write(json.dumps([key, 3]) + "\n")
+            fd.write(json.dumps([key, 4, "line 4", None])[:-5])
+        journal = self.journal()
+        self.assertEqual(journal.get((0, 2)), ("line 2", None))
+        self.assertIsNone(journal.get((0, 4)))
+        journal.add((0, 4), "line 4", None, self.tempdir)
+        journal.close()
+        # the truncated line is gone, not glued to the new one
+        journal = self.journal()
+        self.assertEqual([journal.get((0, p)) for p in (1, 2, 3, 4)],
+                         [("line 1", None), ("line 2", None), None, ("line 4", None)])
+        journal.close()
+        with open(self.filename) as fd:
+            self.assertEqual(len(fd.read().splitlines()), 4)
+
+
+
+class FakeReportOMR:
+    """ the report methods of OMR: the pages named "bad" fail """
+    def NewReport(self, outputfile):
+        return omarscan.ReportWriter(outputfile, [('Title', 'test')])
+
+    def AddReportPage(self, output, f):
+        if os.path.basename(f) == "bad":
+            raise ValueError("bad page")
+        output.add_page(f)
+
+    def WriteReport(self, output, outputfile):
+        output.close()
+
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.page = os.path.join(self.tmpdir, 'omr_page.png')
+        omarscan.Image.new('RGB', (30, 40), (255, 0, 0)).save(self.page)
+        self.outputfile = os.path.join(self.tmpdir, 'report.pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_finish(self):
+        report = omarscan.ReportMerger(FakeReportOMR(), 2, self.outputfile)
+        for i in range(3):
+            report.add(self.page)
+        report.finish()
+        with open(self.outputfile, 'rb') as fd:
+            data = fd.read()
+        self.assertTrue(data.startswith(b'%PDF-1.4'))
+        self.assertTrue(data.endswith(b'%%EOF\n'))
+        self.assertIn(b'/Count 3', data)
+
+    def test_failed_page(self):
+        report = omarscan.ReportMerger(FakeReportOMR(), 2, self.outputfile)
+        report.add(self.page)
+        report.add(os.path.join(self.tmpdir, 'bad'))
+        report.add(self.page)
+        with self.assertRaisesRegex(ValueError, "bad page"):
+            report.finish()
+        self.assertTrue(report.output.fd.closed)
+        self.assertFalse(os.path.exists(self.outputfile))
+
+    def test_abort(self):
+        report = omarscan.ReportMerger(FakeReportOMR(), 2, self.outputfile)
+        report.add(self.page)
+        report.abort()
+        self.assertFalse(report.is_alive())
+        self.assertTrue(report.output.fd.closed)
+        self.assertFalse(os.path.exists(self.outputfile))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+one job of the local OMR service, with a pool of worker processes: the
+annotated pages are saved in the tempdir of the template (not in the
+directory the service was started from), and end in the report.
+"""
+import hashlib
+import hmac
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+DOCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs')
+sys.path.insert(0, DOCS)
+
+import omarscan
+
+EXAMPLE_PDF = os.path.join(DOCS, 'example.pdf')
+
+# a minimal template: two UID bubbles and two answers
+TEMPLATE_XML = """<OMRdata>
+<head>
+<item n="paperwidth" type="float">210.0</item>
+<item n="paperheight" type="float">297.0</item>
+<item n="bubblewidth" type="float">3.5</item>
+<item n="bubbleheight" type="float">3.5</item>
+</head>
+<UID>
+<item n="1:0" type="coord">60.0,200.0</item>
+<item n="1:1" type="coord">60.0,195.0</item>
+</UID>
+<ans>
+<item n="1:A" type="coord">100.0,150.0</item>
+<item n="1:B" type="coord">106.0,150.0</item>
+</ans>
+</OMRdata>
+"""
+
+
+def job_zip(xml, pdf, scans):
+    """ the zip of a job, as sent by mcq.py: xml, exam pdf, scans """
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w') as zf:
+        for f in [xml, pdf] + scans:
+            zf.write(f, os.path.basename(f))
+    return out.getvalue()
+
+
+@unittest.skipUnless(omarscan.pdfium is not None, "pypdfium2 is not installed")
+class TestServiceWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (omarscan.TEMPLATE_CACHE, omarscan.decode_datamatrix)
+        omarscan.TEMPLATE_CACHE = None
+        # the sample pages carry no datamatrix (and libdmtx may be missing)
+        omarscan.decode_datamatrix = lambda candidate: []
+        self.cwd = os.getcwd()
+        self.rundir = os.path.join(self.tmpdir, 'run')
+        os.mkdir(self.rundir)
+        os.chdir(self.rundir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        omarscan.TEMPLATE_CACHE, omarscan.decode_datamatrix = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_job_with_two_workers(self):
+        xml = os.path.join(self.tmpdir, 'exam.xml')
+        with open(xml, 'w') as fd:
+            fd.write(TEMPLATE_XML)
+        pdf = os.path.join(self.tmpdir, 'exam.pdf')
+        shutil.copy(EXAMPLE_PDF, pdf)
+        data = job_zip(xml, pdf, [EXAMPLE_PDF])
+        # the pool first, before the threads of the service (as in serve)
+        pool = omarscan.make_pool(None, 2)
+        try:
+            service = omarscan.OMRService(2, pool)
+            digest = hmac.new(omarscan.SERVICE_PASSWORD, data, digestmod=hashlib.sha256).hexdigest()
+            job_id = service.add_to_queue(omarscan.xmlrpc.client.Binary(data), [digest, 'TXT'])
+            since, done = 0, False
+            while not done:
+                lines, since, done = service.wait_status(job_id, since, timeout=120.0)
+            self.assertEqual(service.check_status(job_id), "DONE")
+            txt, size = service.get_result_info(job_id)
+            pages = omarscan.get_pages_per_file([EXAMPLE_PDF])[0]
+            self.assertEqual(len(txt.splitlines()), pages)
+            self.assertGreater(size, 0)
+            # the report: the all-bubbles page, then the pages
+            report = service.get_result_part(job_id, 0, size).data
+            self.assertTrue(report.startswith(b'%PDF'))
+            self.assertEqual(os.listdir(self.rundir), [])
+        finally:
+            pool.terminate()
+            pool.join()
+            os.chdir(self.cwd)
+            shutil.rmtree(service.spooldir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()